@@ -3,22 +3,26 @@ import io
 import json
 import base64
 import ssl
+import socket
 import threading
 import asyncio
 import logging
 import re
 import uuid
+import zlib
 import copy
+import math
+import time
+import numpy as np
 import requests
-from concurrent.futures import TimeoutError as FutureTimeoutError
-from typing import List, Optional, Dict, Any, Set, Tuple
+from typing import List, Literal, Optional, Dict, Any, Awaitable, Callable, Iterable, Set, Tuple
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from dataclasses import dataclass
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Header, Query, Body, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from dotenv import load_dotenv
 from PIL import Image, UnidentifiedImageError
@@ -80,6 +84,23 @@ from reports.schemas import (
     ReportRunRequest,
     ReportUpdatePayload,
 )
+from exports import runner as export_runner
+from exports import service as export_service
+from exports.schemas import ExportJobCreate, ExportJobOut
+from trends import align as trend_align
+from trends import calculated as trend_calculated
+from trends import export as trend_export
+from trends import service as trend_service
+from realtime import codec as ws_codec
+from realtime.codec import WSFrame
+from realtime.cluster import LastValueBus, LeaderLease
+from realtime.commands import CommandPipeline, CommandRejected, CommandTimeout
+from realtime.history import HistoryStore
+from realtime.last_values import LastValueCache
+from realtime.mqtt_loop import AsyncioMqttConnection
+from realtime.replay import ReplayBuffer
+from realtime.stats import Counters
+from realtime.topic_index import TopicIndex
 
 load_dotenv()
 
@@ -303,7 +324,10 @@ async def start_report_scheduler():
     if not REPORTS_SCHEDULER_ENABLED:
         logger.info("Report scheduler deshabilitado (REPORTS_SCHEDULER_ENABLED=0)")
         return
-    asyncio.create_task(report_scheduler.scheduler_loop(lambda: trend_db_pool))
+    start_singleton(
+        "report-scheduler",
+        lambda: report_scheduler.scheduler_loop(lambda: trend_db_pool, calculated_definitions_for_company),
+    )
 
 
 # ---- Session helpers (WebSocket) ----
@@ -323,6 +347,13 @@ async def ensure_session_table(pool: asyncpg.pool.Pool) -> None:
                     last_seen TIMESTAMPTZ NOT NULL DEFAULT now()
                 );
                 CREATE INDEX IF NOT EXISTS {SESSION_TABLE_NAME}_empresa_idx ON {SESSION_TABLE_NAME}(empresa_id);
+                CREATE TABLE IF NOT EXISTS {SESSION_COUNT_TABLE_NAME} (
+                    empresa_id TEXT PRIMARY KEY,
+                    active INTEGER NOT NULL DEFAULT 0
+                );
+                INSERT INTO {SESSION_COUNT_TABLE_NAME} (empresa_id, active)
+                SELECT empresa_id, COUNT(*) FROM {SESSION_TABLE_NAME} GROUP BY empresa_id
+                ON CONFLICT (empresa_id) DO NOTHING;
                 """
             )
         session_table_ready = True
@@ -330,72 +361,197 @@ async def ensure_session_table(pool: asyncpg.pool.Pool) -> None:
         logger.warning("No se pudo asegurar la tabla de sesiones %s: %s", SESSION_TABLE_NAME, exc)
 
 
-async def cleanup_expired_sessions(pool: asyncpg.pool.Pool) -> int:
+def remember_session_count(empresa_id: str, active: Optional[int]) -> None:
+    if active is not None and SESSION_ADMISSION_CACHE_SECONDS > 0:
+        session_admission_cache[empresa_id] = (int(active), time.monotonic())
+
+
+def session_limit_reached_cached(empresa_id: str) -> bool:
+    """Rechazo sin ir a la base si hace poco la empresa ya estaba en el limite."""
+    if MAX_ACTIVE_SESSIONS_PER_COMPANY <= 0 or SESSION_ADMISSION_CACHE_SECONDS <= 0:
+        return False
+    cached = session_admission_cache.get(empresa_id)
+    if cached is None:
+        return False
+    active, fetched_at = cached
+    if time.monotonic() - fetched_at > SESSION_ADMISSION_CACHE_SECONDS:
+        session_admission_cache.pop(empresa_id, None)
+        return False
+    return active >= MAX_ACTIVE_SESSIONS_PER_COMPANY
+
+
+async def resync_session_counts(conn: asyncpg.Connection) -> None:
+    """Corrige contadores desviados (p. ej. tablas creadas antes de existir el contador)."""
+    async with conn.transaction():
+        # Con las filas contador bloqueadas ningun claim/drop las modifica entre el conteo y el
+        # UPDATE; el orden fijo evita deadlocks con otra limpieza concurrente
+        await conn.execute(
+            f"SELECT empresa_id FROM {SESSION_COUNT_TABLE_NAME} ORDER BY empresa_id FOR UPDATE"
+        )
+        await conn.execute(
+            f"""
+            UPDATE {SESSION_COUNT_TABLE_NAME} AS c
+            SET active = a.n
+            FROM (
+                SELECT c2.empresa_id,
+                       (SELECT COUNT(*) FROM {SESSION_TABLE_NAME} AS s WHERE s.empresa_id = c2.empresa_id) AS n
+                FROM {SESSION_COUNT_TABLE_NAME} AS c2
+            ) AS a
+            WHERE c.empresa_id = a.empresa_id AND c.active <> a.n
+            """
+        )
+
+
+async def cleanup_expired_sessions(pool: asyncpg.pool.Pool, empresa_id: Optional[str] = None) -> int:
+    """Elimina sesiones vencidas; con `empresa_id` solo las de esa empresa y sin resincronizar."""
     if SESSION_TTL_SECONDS <= 0:
         return 0
     await ensure_session_table(pool)
     cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_TTL_SECONDS)
     try:
         async with pool.acquire() as conn:
-            result = await conn.execute(f"DELETE FROM {SESSION_TABLE_NAME} WHERE last_seen < $1", cutoff)
+            # El contador de cada empresa baja en la misma sentencia que borra sus sesiones
+            deleted = await conn.fetchval(
+                f"""
+                WITH gone AS (
+                    DELETE FROM {SESSION_TABLE_NAME}
+                    WHERE last_seen < $1 AND ($2::text IS NULL OR empresa_id = $2::text)
+                    RETURNING empresa_id
+                ), per_company AS (
+                    SELECT empresa_id, COUNT(*) AS n FROM gone GROUP BY empresa_id
+                ), updated AS (
+                    UPDATE {SESSION_COUNT_TABLE_NAME} AS c
+                    SET active = GREATEST(c.active - p.n, 0)
+                    FROM per_company AS p
+                    WHERE c.empresa_id = p.empresa_id
+                )
+                SELECT COALESCE(SUM(n), 0) FROM per_company
+                """,
+                cutoff,
+                empresa_id,
+            )
+            if empresa_id is None:
+                await resync_session_counts(conn)
     except Exception as exc:
         logger.warning("No se pudo limpiar sesiones vencidas: %s", exc)
         return 0
-    try:
-        return int(result.split(" ")[-1])
-    except Exception:
-        return 0
+    if empresa_id is None:
+        session_admission_cache.clear()
+    else:
+        session_admission_cache.pop(empresa_id, None)
+    return int(deleted or 0)
 
 
 async def claim_session_slot(pool: asyncpg.pool.Pool, session_id: str, empresa_id: str, uid: str) -> Tuple[bool, Optional[str]]:
+    if session_limit_reached_cached(empresa_id):
+        return False, "Limite de usuarios activos superado"
     await ensure_session_table(pool)
-    cutoff = datetime.now(timezone.utc) - timedelta(seconds=SESSION_TTL_SECONDS) if SESSION_TTL_SECONDS > 0 else None
+    limit = MAX_ACTIVE_SESSIONS_PER_COMPANY if MAX_ACTIVE_SESSIONS_PER_COMPANY > 0 else None
+    row = await _claim_session_row(pool, session_id, empresa_id, uid, limit)
+    if row is not None and row["claimed"] is None and SESSION_CLEANUP_INTERVAL_SECONDS <= 0:
+        # Sin tarea de limpieza las sesiones vencidas solo se liberan aqui, al chocar con el limite
+        if await cleanup_expired_sessions(pool, empresa_id):
+            row = await _claim_session_row(pool, session_id, empresa_id, uid, limit)
+    if row is None:
+        return False, "No se pudo registrar la sesion"
+    if row["claimed"] is None:
+        remember_session_count(empresa_id, row["current"])
+        return False, "Limite de usuarios activos superado"
+    remember_session_count(empresa_id, row["claimed"])
+    session_last_seen[session_id] = datetime.now(timezone.utc)
+    return True, None
+
+
+async def _claim_session_row(
+    pool: asyncpg.pool.Pool, session_id: str, empresa_id: str, uid: str, limit: Optional[int]
+) -> Optional[asyncpg.Record]:
     try:
         async with pool.acquire() as conn:
-            async with conn.transaction():
-                if cutoff:
-                    await conn.execute(f"DELETE FROM {SESSION_TABLE_NAME} WHERE last_seen < $1", cutoff)
-                if MAX_ACTIVE_SESSIONS_PER_COMPANY > 0:
-                    count = await conn.fetchval(
-                        f"SELECT COUNT(*) FROM {SESSION_TABLE_NAME} WHERE empresa_id=$1",
-                        empresa_id,
-                    )
-                    if count >= MAX_ACTIVE_SESSIONS_PER_COMPANY:
-                        return False, "Limite de usuarios activos superado"
-                await conn.execute(
-                    f"""
+            # Una sola sentencia: el cupo se toma sobre la fila contador de la empresa (lock de fila
+            # breve, sin COUNT ni limpieza global) y la sesion se inserta solo si hubo cupo
+            row = await conn.fetchrow(
+                f"""
+                WITH slot AS (
+                    INSERT INTO {SESSION_COUNT_TABLE_NAME} AS c (empresa_id, active)
+                    VALUES ($2::text, 1)
+                    ON CONFLICT (empresa_id) DO UPDATE SET active = c.active + 1
+                    WHERE $4::int IS NULL OR c.active < $4::int
+                    RETURNING c.active
+                ), inserted AS (
                     INSERT INTO {SESSION_TABLE_NAME} (session_id, empresa_id, uid, created_at, last_seen)
-                    VALUES ($1, $2, $3, now(), now())
-                    """,
-                    session_id,
-                    empresa_id,
-                    uid,
+                    SELECT $1::uuid, $2::text, $3::text, now(), now() FROM slot
+                    RETURNING session_id
                 )
+                SELECT
+                    (SELECT active FROM slot) AS claimed,
+                    (SELECT active FROM {SESSION_COUNT_TABLE_NAME} WHERE empresa_id = $2) AS current
+                """,
+                session_id,
+                empresa_id,
+                uid,
+                limit,
+            )
     except Exception as exc:
         logger.warning("No se pudo reclamar cupo de sesion para %s/%s: %s", empresa_id, uid, exc)
-        return False, "No se pudo registrar la sesion"
-    return True, None
+        return None
+    return row
 
 
-async def touch_session(pool: asyncpg.pool.Pool, session_id: str) -> None:
-    if SESSION_TTL_SECONDS <= 0:
-        return
+def touch_session(session_id: str) -> None:
+    # Solo memoria: flush_session_heartbeats lo lleva a la base en lote
+    if session_id in session_last_seen:
+        session_last_seen[session_id] = datetime.now(timezone.utc)
+
+
+async def flush_session_heartbeats(pool: asyncpg.pool.Pool) -> int:
+    """Actualiza last_seen de todas las sesiones vivas de la instancia con un solo UPDATE."""
+    if SESSION_TTL_SECONDS <= 0 or not session_last_seen:
+        return 0
+    session_ids = list(session_last_seen.keys())
+    last_seen = [session_last_seen[session_id] for session_id in session_ids]
     try:
         async with pool.acquire() as conn:
-            await conn.execute(
-                f"UPDATE {SESSION_TABLE_NAME} SET last_seen = now() WHERE session_id = $1",
-                session_id,
+            result = await conn.execute(
+                f"""
+                UPDATE {SESSION_TABLE_NAME} AS s
+                SET last_seen = v.last_seen
+                FROM unnest($1::uuid[], $2::timestamptz[]) AS v(session_id, last_seen)
+                WHERE s.session_id = v.session_id AND s.last_seen < v.last_seen
+                """,
+                session_ids,
+                last_seen,
             )
     except Exception as exc:
-        logger.debug("No se pudo refrescar la sesion %s: %s", session_id, exc)
+        logger.warning("No se pudo refrescar %d sesiones: %s", len(session_ids), exc)
+        return 0
+    try:
+        return int(result.split(" ")[-1])
+    except Exception:
+        return 0
 
 
 async def drop_session(pool: asyncpg.pool.Pool, session_id: str) -> None:
+    session_last_seen.pop(session_id, None)
     try:
         async with pool.acquire() as conn:
-            await conn.execute(f"DELETE FROM {SESSION_TABLE_NAME} WHERE session_id = $1", session_id)
+            row = await conn.fetchrow(
+                f"""
+                WITH gone AS (
+                    DELETE FROM {SESSION_TABLE_NAME} WHERE session_id = $1 RETURNING empresa_id
+                )
+                UPDATE {SESSION_COUNT_TABLE_NAME} AS c
+                SET active = GREATEST(c.active - 1, 0)
+                FROM gone
+                WHERE c.empresa_id = gone.empresa_id
+                RETURNING c.empresa_id, c.active
+                """,
+                session_id,
+            )
     except Exception as exc:
         logger.debug("No se pudo eliminar la sesion %s: %s", session_id, exc)
+        return
+    if row is not None:
+        remember_session_count(row["empresa_id"], row["active"])
 
 
 def ensure_quote_admin_access(decoded: Dict[str, Any]) -> str:
@@ -638,6 +794,17 @@ firebase_app = None
 event_loop: Optional[asyncio.AbstractEventLoop] = None
 trend_db_pool: Optional[asyncpg.pool.Pool] = None
 session_cleanup_task: Optional[asyncio.Task] = None
+session_heartbeat_task: Optional[asyncio.Task] = None
+# Ultima actividad de las sesiones WS vivas de esta instancia; se escribe en lote cada intervalo
+session_last_seen: Dict[str, datetime] = {}
+# Sesiones activas por empresa segun la ultima respuesta de la base: (cantidad, time.monotonic())
+session_admission_cache: Dict[str, Tuple[int, float]] = {}
+last_value_prune_task: Optional[asyncio.Task] = None
+last_value_snapshot_task: Optional[asyncio.Task] = None
+export_db_pool: Optional[asyncpg.pool.Pool] = None
+export_worker_task: Optional[asyncio.Task] = None
+leader_lease: Optional[LeaderLease] = None
+last_value_bus: Optional[LastValueBus] = None
 session_table_ready = False
 REPORTS_SCHEDULER_ENABLED = coerce_bool(os.environ.get("REPORTS_SCHEDULER_ENABLED"), True)
 # ---- Config ----
@@ -675,6 +842,22 @@ MQTT_CA_CERT_PATH = os.getenv("MQTT_CA_CERT_PATH", "").strip()
 MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "webbridge-backend")
 MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", "30"))
 MQTT_BROKER_PROFILES_RAW = os.getenv("MQTT_BROKER_PROFILES", "").strip()
+# Conexiones de entrada por broker (los filtros se reparten por empresa) y conexion propia para comandos
+MQTT_CONNECTIONS = max(1, coerce_int(os.getenv("MQTT_CONNECTIONS"), 1))
+MQTT_MAX_CONNECTIONS_PER_BROKER = 16
+MQTT_COMMAND_CONNECTION = coerce_bool(os.getenv("MQTT_COMMAND_CONNECTION"), False)
+# asyncio: el socket MQTT se atiende en el event loop; thread: hilo loop_start de paho por broker
+MQTT_CLIENT_MODES = ("asyncio", "thread")
+MQTT_CLIENT_MODE_RAW = os.getenv("MQTT_CLIENT_MODE", "asyncio").strip().lower()
+MQTT_CLIENT_MODE = MQTT_CLIENT_MODE_RAW if MQTT_CLIENT_MODE_RAW in MQTT_CLIENT_MODES else "asyncio"
+# Suscribe solo los prefijos con clientes WS conectados en vez de TOPIC_BASE/#
+MQTT_DYNAMIC_SUBSCRIPTIONS = coerce_bool(os.getenv("MQTT_DYNAMIC_SUBSCRIPTIONS"), False)
+MQTT_UNSUBSCRIBE_GRACE_SECONDS = max(0, coerce_int(os.getenv("MQTT_UNSUBSCRIBE_GRACE_SECONDS"), 60))
+# Comandos (publish): se confirman al recibir PUBACK del broker
+MQTT_COMMAND_TIMEOUT_SECONDS = max(1, coerce_int(os.getenv("MQTT_COMMAND_TIMEOUT_SECONDS"), 5))
+MQTT_COMMAND_TIMEOUT_MAX_SECONDS = 30
+MQTT_MAX_INFLIGHT_COMMANDS = max(1, coerce_int(os.getenv("MQTT_MAX_INFLIGHT_COMMANDS"), 32))  # por broker
+MQTT_MAX_BATCH_COMMANDS = max(1, coerce_int(os.getenv("MQTT_MAX_BATCH_COMMANDS"), 50))
 
 # ---- Session tracking (WebSocket) ----
 SESSION_TABLE_NAME_RAW = os.getenv("SESSION_TABLE_NAME", "active_sessions").strip() or "active_sessions"
@@ -682,6 +865,44 @@ SESSION_TABLE_NAME = re.sub(r"[^A-Za-z0-9_]+", "", SESSION_TABLE_NAME_RAW) or "a
 SESSION_TTL_SECONDS = coerce_int(os.getenv("SESSION_TTL_SECONDS"), 300)  # 0 desactiva expiracion por TTL
 SESSION_CLEANUP_INTERVAL_SECONDS = coerce_int(os.getenv("SESSION_CLEANUP_INTERVAL_SECONDS"), 120)  # 0 desactiva tarea programada
 MAX_ACTIVE_SESSIONS_PER_COMPANY = coerce_int(os.getenv("MAX_ACTIVE_SESSIONS_PER_COMPANY"), 0)  # 0 = ilimitado
+SESSION_HEARTBEAT_FLUSH_SECONDS = max(1, coerce_int(os.getenv("SESSION_HEARTBEAT_FLUSH_SECONDS"), 30))
+SESSION_ADMISSION_CACHE_SECONDS = max(0, coerce_int(os.getenv("SESSION_ADMISSION_CACHE_SECONDS"), 5))  # 0 = sin cache
+SESSION_COUNT_TABLE_NAME = f"{SESSION_TABLE_NAME}_counts"
+
+# ---- WebSocket fan-out ----
+WS_SEND_QUEUE_SIZE = max(1, coerce_int(os.getenv("WS_SEND_QUEUE_SIZE"), 256))
+WS_SEND_TIMEOUT_SECONDS = max(1, coerce_int(os.getenv("WS_SEND_TIMEOUT_SECONDS"), 10))
+WS_SLOW_CLIENT_POLICY_RAW = (os.getenv("WS_SLOW_CLIENT_POLICY", "drop_oldest").strip().lower() or "drop_oldest")
+WS_SLOW_CLIENT_POLICIES = ("drop_oldest", "drop_newest", "disconnect")
+WS_SLOW_CLIENT_POLICY = WS_SLOW_CLIENT_POLICY_RAW if WS_SLOW_CLIENT_POLICY_RAW in WS_SLOW_CLIENT_POLICIES else "drop_oldest"
+WS_CONFLATE_DEFAULT_MS = max(0, coerce_int(os.getenv("WS_CONFLATE_DEFAULT_MS"), 0))  # 0 = sin conflacion
+WS_CONFLATE_MIN_MS = 50
+WS_CONFLATE_MAX_MS = 2000
+WS_MAX_SUBSCRIPTIONS = max(1, coerce_int(os.getenv("WS_MAX_SUBSCRIPTIONS"), 500))
+LAST_VALUE_MAX_PER_COMPANY = max(0, coerce_int(os.getenv("LAST_VALUE_MAX_PER_COMPANY"), 5000))  # 0 = sin limite
+LAST_VALUE_MAX_AGE_HOURS = max(0, coerce_int(os.getenv("LAST_VALUE_MAX_AGE_HOURS"), 24))  # 0 = sin vencimiento
+LAST_VALUE_MAX_COMPANIES = max(0, coerce_int(os.getenv("LAST_VALUE_MAX_COMPANIES"), 1000))  # 0 = sin limite
+LAST_VALUE_KNOWN_COMPANIES_ONLY = coerce_bool(os.getenv("LAST_VALUE_KNOWN_COMPANIES_ONLY"), False)
+LAST_VALUE_PRUNE_SECONDS = 60
+MQTT_LOG_SAMPLE_EVERY = max(1, coerce_int(os.getenv("MQTT_LOG_SAMPLE_EVERY"), 1000))  # log debug 1 de cada N mensajes
+LAST_VALUE_STALE_SECONDS = max(0, coerce_int(os.getenv("LAST_VALUE_STALE_SECONDS"), 300))  # 0 = nunca se marca
+WS_REPLAY_BUFFER_SIZE = max(0, coerce_int(os.getenv("WS_REPLAY_BUFFER_SIZE"), 1000))  # mensajes por empresa; 0 = sin reanudacion
+WS_REPLAY_MAX_COMPANIES = max(0, coerce_int(os.getenv("WS_REPLAY_MAX_COMPANIES"), 1000))  # 0 = sin limite
+WS_REPLAY_MAX_MB = max(0, coerce_int(os.getenv("WS_REPLAY_MAX_MB"), 64))  # 0 = sin limite
+WS_REPLAY_IDLE_MINUTES = max(0, coerce_int(os.getenv("WS_REPLAY_IDLE_MINUTES"), 60))  # 0 = no se eliminan
+HISTORY_HORIZON_MINUTES = max(0, coerce_int(os.getenv("HISTORY_HORIZON_MINUTES"), 30))  # 0 = sin historia en memoria
+HISTORY_MAX_POINTS_PER_TOPIC = max(1, coerce_int(os.getenv("HISTORY_MAX_POINTS_PER_TOPIC"), 720))
+HISTORY_MAX_TOPICS = max(0, coerce_int(os.getenv("HISTORY_MAX_TOPICS"), 20000))  # 0 = sin limite
+# Los mismos filtros que MQTT_TOPICS del worker de tendencias; vacio = sin historia en memoria
+HISTORY_TOPICS = [
+    item.strip()
+    for item in coerce_str(os.getenv("HISTORY_TOPICS") or os.getenv("MQTT_TOPICS"), "").split(",")
+    if item.strip()
+]
+# Igual que el worker de tendencias: planta usada cuando el topic no la indica
+DEFAULT_PLANTA_ID = os.getenv("DEFAULT_PLANTA_ID", "default").strip() or "default"
+# Identifica este proceso: las secuencias reinician con cada arranque
+WS_STREAM_EPOCH = uuid.uuid4().hex[:12]
 
 TOPIC_BASE = os.getenv("TOPIC_BASE", "scada/customers").strip()
 PUBLIC_ALLOWED_PREFIXES = [p.strip() for p in os.getenv("PUBLIC_ALLOWED_PREFIXES", "").split(",") if p.strip()]
@@ -693,13 +914,37 @@ FIREBASE_AUTH_TIMEOUT = float(os.getenv("FIREBASE_AUTH_TIMEOUT", "10"))
 IDENTITY_TOOLKIT_URL = "https://identitytoolkit.googleapis.com/v1/accounts:sendOobCode"
 
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+# Varios workers uvicorn (--workers N): tareas unicas por lease y ultimos valores compartidos via Postgres
+CLUSTER_MODE = coerce_bool(os.getenv("CLUSTER_MODE"), False)
+CLUSTER_LEASE_KEY = coerce_int(os.getenv("CLUSTER_LEASE_KEY"), 7302845171)
+CLUSTER_LEASE_CHECK_SECONDS = max(1, coerce_int(os.getenv("CLUSTER_LEASE_CHECK_SECONDS"), 10))
+CLUSTER_CHANNEL = coerce_str(os.getenv("CLUSTER_CHANNEL"), "bridge_last_values") or "bridge_last_values"
+CLUSTER_WARM_TIMEOUT_MS = max(0, coerce_int(os.getenv("CLUSTER_WARM_TIMEOUT_MS"), 300))  # 0 = sin pedir a otros workers
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
 TRENDS_FETCH_LIMIT = coerce_int(os.getenv("TRENDS_FETCH_LIMIT", "5000"), 5000)
 DEFAULT_TRENDS_RANGE_HOURS = coerce_int(os.getenv("DEFAULT_TRENDS_RANGE_HOURS", "24"), 24)
+TRENDS_MATRIX_MAX_TAGS = max(1, coerce_int(os.getenv("TRENDS_MATRIX_MAX_TAGS"), 50))
+TRENDS_MATRIX_MAX_POINTS = max(10, coerce_int(os.getenv("TRENDS_MATRIX_MAX_POINTS"), 10000))
+TRENDS_MATRIX_DEFAULT_POINTS = 1000
+TRENDS_MATRIX_MAX_ROWS_PER_TAG = max(1000, coerce_int(os.getenv("TRENDS_MATRIX_MAX_ROWS_PER_TAG"), 50000))
 DIAS_RETENCION_HISTORICO = coerce_int(os.getenv("DIAS_RETENCION_HISTORICO", "30"), 30)
 QUOTE_DB_MIN_POOL_SIZE = max(1, coerce_int(os.getenv("QUOTE_DB_MIN_POOL_SIZE", "1"), 1))
 QUOTE_DB_MAX_POOL_SIZE = max(QUOTE_DB_MIN_POOL_SIZE, coerce_int(os.getenv("QUOTE_DB_MAX_POOL_SIZE", "5"), 5))
 QUOTE_DB_TIMEOUT = max(1, coerce_int(os.getenv("QUOTE_DB_TIMEOUT", "10"), 10))
 
+# ---- Exportaciones asincronas ----
+EXPORT_JOBS_ENABLED = coerce_bool(os.getenv("EXPORT_JOBS_ENABLED"), True)
+EXPORT_JOBS_DB_POOL_SIZE = max(1, coerce_int(os.getenv("EXPORT_JOBS_DB_POOL_SIZE"), 2))
+EXPORT_JOBS_MAX_QUEUED_PER_COMPANY = max(1, coerce_int(os.getenv("EXPORT_JOBS_MAX_QUEUED_PER_COMPANY"), 5))
+EXPORT_STORAGE_DIR = Path(os.getenv("EXPORT_STORAGE_DIR") or (BASE_DIR / '..' / 'export_files')).expanduser().resolve()
+
+# ---- Snapshot de ultimos valores ----
+LAST_VALUE_SNAPSHOT_ENABLED = coerce_bool(os.getenv("LAST_VALUE_SNAPSHOT_ENABLED"), True)
+LAST_VALUE_SNAPSHOT_SECONDS = max(0, coerce_int(os.getenv("LAST_VALUE_SNAPSHOT_SECONDS"), 60))  # 0 = solo al apagar
+LAST_VALUE_SNAPSHOT_PATH = Path(
+    os.getenv("LAST_VALUE_SNAPSHOT_PATH") or (BASE_DIR / '..' / 'runtime_state' / 'last_values.msgpack')
+).expanduser().resolve()
+
 TRENDS_RESOLUTION_SECONDS: Dict[str, Optional[int]] = {
     "raw": None,
     "5m": 5 * 60,
@@ -726,6 +971,8 @@ class BrokerProfile:
     ca_cert_path: Optional[str]
     client_id: Optional[str]
     keepalive: int
+    connections: int = 1
+    command_connection: bool = False
 
     def client_identifier(self, base_client_id: str) -> str:
         if self.client_id:
@@ -734,19 +981,73 @@ class BrokerProfile:
             return base_client_id
         return f"{base_client_id}-{self.key}"
 
+    def connection_identifier(self, base_client_id: str, role: str) -> str:
+        # La primera conexion de entrada conserva el client id historico
+        client_id = self.client_identifier(base_client_id)
+        return client_id if role == "in0" else f"{client_id}-{role}"
+
+
+def filter_prefix(value: str) -> str:
+    """Prefijo de un filtro MQTT de la forma `a/b/#` (o `a/b`)."""
+    value = value.strip()
+    if value.endswith("#"):
+        value = value[:-1]
+    return value.rstrip("/")
+
+
+def prefix_filter(prefix: str) -> str:
+    return prefix + "/#" if prefix else "#"
+
+
+def minimal_prefix_cover(prefixes: Iterable[str]) -> Set[str]:
+    """Conjunto minimo de prefijos: uno cubierto por otro no necesita filtro propio."""
+    desired: Set[str] = set()
+    for prefix in sorted(set(prefixes), key=len):
+        if not any(not kept or prefix == kept or prefix.startswith(kept + "/") for kept in desired):
+            desired.add(prefix)
+    return desired
+
 
 class BrokerManager:
     def __init__(self, base_profile: Dict[str, Any], raw_profiles: str, topic_base: str,
-                 public_prefixes: List[str], default_client_id: str):
+                 public_prefixes: List[str], default_client_id: str,
+                 dynamic_subscriptions: bool = False, release_grace_seconds: float = 60,
+                 mode: str = "asyncio", max_inflight_commands: int = 32, client_suffix: str = ""):
         self.base_profile = dict(base_profile)
         self.raw_profiles = raw_profiles
         self.topic_base = topic_base
         self.public_prefixes = list(public_prefixes)
         self.default_client_id = default_client_id
+        # Con varios workers cada proceso necesita client ids propios (clean_session desconecta duplicados)
+        self.client_suffix = client_suffix
         self.profiles: Dict[str, BrokerProfile] = {}
-        self.clients: Dict[str, mqtt.Client] = {}
+        # Por broker: clientes de entrada (un shard de filtros cada uno) y cliente de comandos,
+        # que es el primero de entrada salvo que el perfil pida conexion propia
+        self.inbound_clients: Dict[str, List[mqtt.Client]] = {}
+        self.command_clients: Dict[str, mqtt.Client] = {}
         self.connected_events: Dict[str, threading.Event] = {}
+        # Modo asyncio: conexiones conducidas por el event loop, se inician en start()
+        self.mode = mode
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.connections: List[AsyncioMqttConnection] = []
+        self.async_connected: Dict[str, asyncio.Event] = {}
+        # Publicaciones confirmadas por PUBACK, con limite de comandos en vuelo por broker
+        self.max_inflight_commands = max_inflight_commands
+        self.pipelines: Dict[str, CommandPipeline] = {}
+        # Suscripciones dinamicas: referencias por prefijo y prefijos suscritos en el broker
+        self.dynamic_subscriptions = dynamic_subscriptions
+        self.release_grace_seconds = release_grace_seconds
+        self._sub_lock = threading.Lock()
+        # Una reconciliacion a la vez por broker, incluidas las llamadas subscribe/unsubscribe
+        self._reconcile_locks: Dict[str, threading.Lock] = {}
+        self._refcounts: Dict[str, Dict[str, int]] = {}
+        self._released_at: Dict[str, Dict[str, float]] = {}
+        self._active_filters: Dict[str, Set[str]] = {}
         self._parse_profiles()
+        if not dynamic_subscriptions:
+            static = [self.topic_base] + self.public_prefixes
+            for key in self.profiles:
+                self._active_filters[key] = minimal_prefix_cover(filter_prefix(p) for p in static)
         self._init_clients()
 
     def _parse_profiles(self) -> None:
@@ -793,6 +1094,11 @@ class BrokerManager:
                     client_id = None
             keepalive = coerce_int(payload.get("keepalive"), self.base_profile.get("keepalive") or MQTT_KEEPALIVE)
             keepalive = keepalive if keepalive > 0 else MQTT_KEEPALIVE
+            connections = coerce_int(payload.get("connections"), self.base_profile.get("connections") or 1)
+            connections = min(max(connections, 1), MQTT_MAX_CONNECTIONS_PER_BROKER)
+            command_connection = coerce_bool(
+                payload.get("commandConnection"), coerce_bool(self.base_profile.get("commandConnection"), False)
+            )
             parsed[key] = BrokerProfile(
                 key=key,
                 host=host,
@@ -804,6 +1110,8 @@ class BrokerManager:
                 ca_cert_path=ca_cert_path or None,
                 client_id=client_id,
                 keepalive=keepalive,
+                connections=connections,
+                command_connection=command_connection,
             )
         if DEFAULT_BROKER_KEY not in parsed:
             raise RuntimeError("Debe existir al menos el perfil MQTT 'default'")
@@ -813,10 +1121,24 @@ class BrokerManager:
 
     def _init_clients(self) -> None:
         for key, profile in self.profiles.items():
-            self._init_client(profile)
+            self._init_profile(profile)
 
-    def _init_client(self, profile: BrokerProfile) -> None:
-        client_id = profile.client_identifier(self.default_client_id)
+    def _init_profile(self, profile: BrokerProfile) -> None:
+        event = threading.Event()
+        self.connected_events[profile.key] = event
+        async_event = asyncio.Event()
+        self.async_connected[profile.key] = async_event
+        inbound: List[mqtt.Client] = []
+        self.inbound_clients[profile.key] = inbound
+        for shard in range(profile.connections):
+            command = shard == 0 and not profile.command_connection
+            inbound.append(self._init_client(profile, f"in{shard}", shard, command))
+        if profile.command_connection:
+            self._init_client(profile, "cmd", None, True)
+
+    def _init_client(self, profile: BrokerProfile, role: str, shard: Optional[int], command: bool) -> mqtt.Client:
+        client_id = profile.connection_identifier(self.default_client_id, role) + self.client_suffix
+        name = profile.key if role == "in0" else f"{profile.key}/{role}"
         client = mqtt.Client(client_id=client_id, clean_session=True)
         client.enable_logger()
         client.user_data_set({"broker_key": profile.key})
@@ -828,54 +1150,221 @@ class BrokerManager:
             client.tls_insecure_set(profile.tls_insecure)
         if profile.username:
             client.username_pw_set(profile.username, profile.password or None)
-        event = threading.Event()
-        self.connected_events[profile.key] = event
+        # La disponibilidad para publicar depende solo de la conexion de comandos
+        event = self.connected_events[profile.key] if command else None
+        async_event = self.async_connected[profile.key] if command else None
 
         def on_connect(client, userdata, flags, rc, properties=None):
             if rc == 0:
-                event.set()
-                logger.info("MQTT connected broker=%s host=%s", profile.key, profile.host)
-                base = self.topic_base if self.topic_base.endswith("#") else (self.topic_base.rstrip("/") + "/#")
-                client.subscribe(base, qos=1)
-                for p in self.public_prefixes:
-                    topic = p if p.endswith("#") else (p.rstrip("/") + "/#")
-                    client.subscribe(topic, qos=1)
+                if event is not None:
+                    event.set()
+                    if self.mode == "asyncio":
+                        async_event.set()
+                logger.info("MQTT connected broker=%s host=%s", name, profile.host)
+                if shard is None:
+                    return
+                # clean_session: tras reconectar hay que repetir los filtros del shard
+                prefixes = self._shard_filters(profile.key, shard)
+                if prefixes:
+                    client.subscribe([(prefix_filter(prefix), 1) for prefix in prefixes])
+                    history_store.resume(profile.key, prefixes)
             else:
-                logger.error("MQTT connection failed rc=%s broker=%s", rc, profile.key)
+                logger.error("MQTT connection failed rc=%s broker=%s", rc, name)
 
         def on_disconnect(client, userdata, rc):
             if rc != 0:
-                logger.warning("MQTT disconnected broker=%s rc=%s", profile.key, rc)
+                logger.warning("MQTT disconnected broker=%s rc=%s", name, rc)
             else:
-                logger.info("MQTT disconnected broker=%s", profile.key)
-            event.clear()
+                logger.info("MQTT disconnected broker=%s", name)
+            if event is not None:
+                event.clear()
+                if self.mode == "asyncio":
+                    async_event.clear()
+            if shard is not None:
+                # Mensajes perdidos mientras no hubo conexion: la historia en memoria tiene un hueco
+                history_store.pause(profile.key, self._shard_filters(profile.key, shard))
 
         client.on_connect = on_connect
         client.on_disconnect = on_disconnect
-        client.on_message = self._make_on_message(profile.key)
+        if shard is not None:
+            client.on_message = self._make_on_message(profile.key)
+        if command:
+            pipeline = CommandPipeline(client, self.max_inflight_commands)
+            client.on_publish = pipeline.on_publish
+            self.pipelines[profile.key] = pipeline
+            self.command_clients[profile.key] = client
+        if self.mode == "asyncio":
+            self.connections.append(
+                AsyncioMqttConnection(client, profile.host, profile.port, profile.keepalive, name)
+            )
+            return client
         try:
             client.connect_async(profile.host, profile.port, keepalive=profile.keepalive)
         except Exception as exc:
-            logger.exception("No se pudo iniciar conexion MQTT broker=%s: %s", profile.key, exc)
+            logger.exception("No se pudo iniciar conexion MQTT broker=%s: %s", name, exc)
             raise
         client.loop_start()
-        self.clients[profile.key] = client
+        return client
+
+    def _all_clients(self) -> List[mqtt.Client]:
+        clients: List[mqtt.Client] = []
+        for key, inbound in self.inbound_clients.items():
+            clients.extend(inbound)
+            command = self.command_clients.get(key)
+            if command is not None and command not in inbound:
+                clients.append(command)
+        return clients
+
+    def covers(self, broker_key: Optional[str], prefix: str) -> bool:
+        """True si los mensajes bajo `prefix` ya llegan a este proceso."""
+        prefix = prefix.rstrip("/")
+        with self._sub_lock:
+            active = list(self._active_filters.get(self.resolve_key(broker_key), ()))
+        return any(not item or prefix == item or prefix.startswith(item + "/") for item in active)
+
+    def _shard_filters(self, broker_key: str, shard: int) -> List[str]:
+        with self._sub_lock:
+            active = sorted(self._active_filters.get(broker_key, set()))
+        return [prefix for prefix in active if self._shard_for(broker_key, prefix) == shard]
+
+    def _shard_for(self, broker_key: str, prefix: str) -> int:
+        """Shard de un filtro: todos los prefijos de una empresa van por la misma conexion."""
+        count = len(self.inbound_clients.get(broker_key) or ())
+        if count <= 1:
+            return 0
+        company = last_message_store.company_for(prefix)
+        key = company if company else prefix
+        return zlib.crc32(key.encode("utf-8")) % count
+
+    async def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        for pipeline in self.pipelines.values():
+            pipeline.loop = self.loop
+        for connection in self.connections:
+            connection.start()
+
+    async def stop(self) -> None:
+        for connection in self.connections:
+            await connection.stop()
+        if self.mode == "thread":
+            for client in self._all_clients():
+                client.disconnect()
+                client.loop_stop()
+
+    def on_event_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
 
     def _make_on_message(self, broker_key: str):
         def _handler(client, userdata, msg):
-            decoded_payload = try_decode(msg.payload)
-            logger.info("MQTT inbound broker=%s topic=%s qos=%s retain=%s", broker_key, msg.topic, msg.qos, msg.retain)
-            data = {
-                "topic": msg.topic,
-                "payload": decoded_payload,
-                "qos": msg.qos,
-                "retain": msg.retain,
-                "broker": broker_key,
-            }
-            remember_message(data)
-            ConnectionManager.broadcast(msg.topic, data)
+            received = mqtt_counters.incr("received")
+            if (received - 1) % MQTT_LOG_SAMPLE_EVERY == 0 and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "MQTT inbound broker=%s topic=%s qos=%s retain=%s (muestra 1/%d)",
+                    broker_key,
+                    msg.topic,
+                    msg.qos,
+                    msg.retain,
+                    MQTT_LOG_SAMPLE_EVERY,
+                )
+            seq = message_sequences.incr(broker_key)
+            # La cache guarda bytes crudos; solo se decodifica si hay destinatarios
+            remember_message(msg.topic, msg.payload, msg.qos, msg.retain, broker_key, seq)
+            ConnectionManager.broadcast(msg.topic, msg.payload, msg.qos, msg.retain, broker_key, seq)
         return _handler
 
+    def acquire_prefixes(self, broker_key: Optional[str], prefixes: List[str]) -> None:
+        if not self.dynamic_subscriptions:
+            return
+        resolved = self.resolve_key(broker_key)
+        with self._sub_lock:
+            counts = self._refcounts.setdefault(resolved, {})
+            released = self._released_at.setdefault(resolved, {})
+            for prefix in {p.rstrip("/") for p in prefixes if p.strip("/")}:
+                counts[prefix] = counts.get(prefix, 0) + 1
+                released.pop(prefix, None)
+        self._reconcile(resolved)
+
+    def release_prefixes(self, broker_key: Optional[str], prefixes: List[str]) -> None:
+        if not self.dynamic_subscriptions:
+            return
+        resolved = self.resolve_key(broker_key)
+        now = time.monotonic()
+        with self._sub_lock:
+            counts = self._refcounts.setdefault(resolved, {})
+            released = self._released_at.setdefault(resolved, {})
+            for prefix in {p.rstrip("/") for p in prefixes if p.strip("/")}:
+                remaining = counts.get(prefix, 0) - 1
+                if remaining > 0:
+                    counts[prefix] = remaining
+                    continue
+                counts.pop(prefix, None)
+                # Se mantiene durante el periodo de gracia por si el usuario recarga la pagina
+                released[prefix] = now
+        if self.release_grace_seconds <= 0:
+            self._reconcile(resolved)
+            return
+        if self.on_event_loop():
+            self.loop.call_later(self.release_grace_seconds, self._reconcile, resolved)
+        elif self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.call_later, self.release_grace_seconds, self._reconcile, resolved)
+        # Sin event loop (antes de start) el prefijo liberado se quita en la proxima reconciliacion
+
+    def _reconcile(self, broker_key: str) -> None:
+        """Ajusta las suscripciones del broker al conjunto minimo que cubre los prefijos en uso."""
+        with self._sub_lock:
+            lock = self._reconcile_locks.setdefault(broker_key, threading.Lock())
+        # El calculo y las llamadas MQTT van juntos: dos reconciliaciones intercaladas podrian
+        # desuscribir un filtro que la otra acaba de suscribir
+        with lock:
+            self._reconcile_locked(broker_key)
+
+    def _reconcile_locked(self, broker_key: str) -> None:
+        clients = self.inbound_clients.get(broker_key) or []
+        cutoff = time.monotonic() - self.release_grace_seconds
+        with self._sub_lock:
+            released = self._released_at.setdefault(broker_key, {})
+            for prefix, released_at in list(released.items()):
+                if released_at <= cutoff:
+                    del released[prefix]
+            wanted = set(self._refcounts.get(broker_key, {})) | set(released)
+            desired = minimal_prefix_cover(wanted)
+            active = self._active_filters.setdefault(broker_key, set())
+            to_subscribe = sorted(desired - active)
+            to_unsubscribe = sorted(active - desired)
+            self._active_filters[broker_key] = desired
+        for shard, client in enumerate(clients):
+            subscribe = [prefix for prefix in to_subscribe if self._shard_for(broker_key, prefix) == shard]
+            unsubscribe = [prefix for prefix in to_unsubscribe if self._shard_for(broker_key, prefix) == shard]
+            if subscribe:
+                client.subscribe([(prefix_filter(prefix), 1) for prefix in subscribe])
+                logger.info("MQTT suscrito broker=%s shard=%d filtros=%s", broker_key, shard, subscribe)
+            if unsubscribe:
+                client.unsubscribe([prefix_filter(prefix) for prefix in unsubscribe])
+                logger.info("MQTT desuscrito broker=%s shard=%d filtros=%s", broker_key, shard, unsubscribe)
+            # Primero la pausa: un filtro amplio que reemplaza a otros mas finos los vuelve a cubrir
+            history_store.pause(broker_key, unsubscribe)
+            if subscribe and client.is_connected():
+                history_store.resume(broker_key, subscribe)
+
+    def subscription_stats(self) -> Dict[str, int]:
+        with self._sub_lock:
+            return {key: len(filters) for key, filters in self._active_filters.items()}
+
+    def connection_stats(self) -> Dict[str, Dict[str, Any]]:
+        stats: Dict[str, Dict[str, Any]] = {}
+        for key, inbound in self.inbound_clients.items():
+            command = self.command_clients.get(key)
+            stats[key] = {
+                "inbound": len(inbound),
+                "inboundConnected": sum(1 for client in inbound if client.is_connected()),
+                "commandConnection": command is not None and command not in inbound,
+                "commandConnected": command is not None and command.is_connected(),
+            }
+        return stats
+
     def resolve_key(self, broker_key: Optional[str]) -> str:
         if broker_key and broker_key in self.profiles:
             return broker_key
@@ -886,17 +1375,52 @@ class BrokerManager:
         event = self.connected_events.get(resolved)
         if event is None:
             raise HTTPException(status_code=500, detail=f"MQTT broker '{resolved}' no configurado")
-        if not event.wait(timeout):
+        # Esperar en el hilo del event loop bloquearia la propia conexion que se espera
+        wait_timeout = 0 if self.mode == "asyncio" and self.on_event_loop() else timeout
+        if not event.wait(wait_timeout):
             raise HTTPException(status_code=503, detail=f"MQTT broker '{resolved}' no conectado")
         return resolved
 
-    def publish(self, broker_key: Optional[str], topic: str, payload: Any, qos: int, retain: bool):
-        resolved = self.ensure_connected(broker_key)
-        client = self.clients.get(resolved)
-        if client is None:
+    async def ensure_connected_async(self, broker_key: Optional[str], timeout: float = 10.0) -> str:
+        resolved = self.resolve_key(broker_key)
+        if self.mode != "asyncio":
+            return await asyncio.to_thread(self.ensure_connected, resolved, timeout)
+        event = self.async_connected.get(resolved)
+        if event is None:
+            raise HTTPException(status_code=500, detail=f"MQTT broker '{resolved}' no configurado")
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail=f"MQTT broker '{resolved}' no conectado") from None
+        return resolved
+
+    async def _pipeline(self, broker_key: Optional[str], timeout: float) -> Tuple[str, CommandPipeline]:
+        resolved = await self.ensure_connected_async(broker_key, timeout)
+        pipeline = self.pipelines.get(resolved)
+        if pipeline is None or pipeline.loop is None:
             raise HTTPException(status_code=500, detail=f"MQTT broker '{resolved}' no inicializado")
-        result = client.publish(topic, payload=payload, qos=qos, retain=retain)
-        return resolved, result
+        return resolved, pipeline
+
+    async def publish_command(self, broker_key: Optional[str], topic: str, payload: Any, qos: int, retain: bool,
+                              timeout: float) -> Tuple[str, int]:
+        """Publica y espera la confirmacion del broker; retorna (broker, mid)."""
+        resolved, pipeline = await self._pipeline(broker_key, timeout)
+        try:
+            mid = await pipeline.publish(topic, payload, qos, retain, timeout)
+        except CommandTimeout as exc:
+            raise HTTPException(status_code=504, detail=str(exc)) from None
+        except CommandRejected as exc:
+            raise HTTPException(status_code=502, detail=str(exc)) from None
+        return resolved, mid
+
+    async def publish_commands(self, broker_key: Optional[str], commands: List[Tuple[str, Any, int, bool]],
+                               timeout: float) -> Tuple[str, List[Dict[str, Any]]]:
+        """Publica varios comandos en paralelo; cada resultado indica si el broker lo confirmo."""
+        resolved, pipeline = await self._pipeline(broker_key, timeout)
+        return resolved, await pipeline.publish_many(commands, timeout)
+
+    def command_stats(self) -> Dict[str, int]:
+        return {key: pipeline.in_flight for key, pipeline in self.pipelines.items()}
 
     def available_keys(self) -> List[str]:
         return list(self.profiles.keys())
@@ -911,6 +1435,8 @@ BASE_BROKER_PROFILE = {
     "tlsInsecure": MQTT_TLS_INSECURE,
     "caCertPath": MQTT_CA_CERT_PATH,
     "keepalive": MQTT_KEEPALIVE,
+    "connections": MQTT_CONNECTIONS,
+    "commandConnection": MQTT_COMMAND_CONNECTION,
 }
 
 broker_manager = BrokerManager(
@@ -919,6 +1445,11 @@ broker_manager = BrokerManager(
     topic_base=TOPIC_BASE,
     public_prefixes=PUBLIC_ALLOWED_PREFIXES,
     default_client_id=MQTT_CLIENT_ID,
+    dynamic_subscriptions=MQTT_DYNAMIC_SUBSCRIPTIONS,
+    release_grace_seconds=MQTT_UNSUBSCRIBE_GRACE_SECONDS,
+    mode=MQTT_CLIENT_MODE,
+    max_inflight_commands=MQTT_MAX_INFLIGHT_COMMANDS,
+    client_suffix=f"-w{os.getpid()}" if CLUSTER_MODE else "",
 )
 
 # Inicializa el mapa de brokers por empresa a partir del archivo local
@@ -955,6 +1486,11 @@ async def capture_event_loop():
     logger.info("Event loop captured")
 
 
+@app.on_event("startup")
+async def start_mqtt_clients():
+    await broker_manager.start()
+
+
 @app.on_event("startup")
 async def init_trend_database_pool():
     global trend_db_pool
@@ -989,6 +1525,37 @@ async def init_quote_database_pool():
         await quote_db.close_pool()
         logger.error("No se pudo inicializar el pool de cotizador: %s", exc)
 
+@app.on_event("startup")
+async def start_cluster():
+    global leader_lease, last_value_bus
+    if not CLUSTER_MODE:
+        return
+    if not DATABASE_URL:
+        logger.error("CLUSTER_MODE requiere DATABASE_URL; cada worker correra sus propias tareas unicas")
+        return
+    leader_lease = LeaderLease(DATABASE_URL, CLUSTER_LEASE_KEY, CLUSTER_LEASE_CHECK_SECONDS)
+    leader_lease.start()
+    last_value_bus = LastValueBus(
+        DATABASE_URL,
+        CLUSTER_CHANNEL,
+        WORKER_ID,
+        last_message_store,
+        broker_manager.covers,
+        CLUSTER_WARM_TIMEOUT_MS / 1000,
+        check_seconds=CLUSTER_LEASE_CHECK_SECONDS,
+    )
+    await last_value_bus.start()
+    logger.info("Modo cluster activo worker=%s", WORKER_ID)
+
+
+def start_singleton(name: str, factory: Callable[[], Awaitable[Any]]) -> Optional[asyncio.Task]:
+    """Tarea que debe correr en un solo proceso; en modo cluster la corre el lider del lease."""
+    if leader_lease is not None:
+        leader_lease.register(name, factory)
+        return None
+    return asyncio.create_task(factory(), name=name)
+
+
 @app.on_event("startup")
 async def start_session_cleanup_task():
     global session_cleanup_task
@@ -1010,7 +1577,78 @@ async def start_session_cleanup_task():
                 logger.warning("Error en tarea de limpieza de sesiones: %s", exc)
             await asyncio.sleep(SESSION_CLEANUP_INTERVAL_SECONDS)
 
-    session_cleanup_task = asyncio.create_task(_run_cleanup())
+    session_cleanup_task = start_singleton("session-cleanup", _run_cleanup)
+
+
+@app.on_event("startup")
+async def start_session_heartbeat_task():
+    global session_heartbeat_task
+    if SESSION_TTL_SECONDS <= 0:
+        return
+    # El intervalo debe ser menor que el TTL para que una sesion activa no expire entre escrituras
+    interval = min(SESSION_HEARTBEAT_FLUSH_SECONDS, max(1, SESSION_TTL_SECONDS // 2))
+
+    async def _run_heartbeats():
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                pool = trend_db_pool
+                if pool is not None:
+                    await flush_session_heartbeats(pool)
+            except asyncio.CancelledError:
+                break
+            except Exception as exc:
+                logger.warning("Error en tarea de heartbeat de sesiones: %s", exc)
+
+    session_heartbeat_task = asyncio.create_task(_run_heartbeats())
+
+
+@app.on_event("startup")
+async def restore_last_value_snapshot():
+    global last_value_snapshot_task
+    if not LAST_VALUE_SNAPSHOT_ENABLED:
+        return
+    # Los hooks de startup terminan antes de aceptar conexiones /ws
+    try:
+        restored = await asyncio.to_thread(last_message_store.load, LAST_VALUE_SNAPSHOT_PATH)
+        if restored:
+            logger.info("Ultimos valores restaurados desde %s: %d", LAST_VALUE_SNAPSHOT_PATH, restored)
+    except Exception as exc:
+        logger.warning("No se pudo restaurar snapshot de ultimos valores: %s", exc)
+    if LAST_VALUE_SNAPSHOT_SECONDS <= 0:
+        return
+
+    async def _run_snapshots():
+        while True:
+            await asyncio.sleep(LAST_VALUE_SNAPSHOT_SECONDS)
+            try:
+                await asyncio.to_thread(last_message_store.save, LAST_VALUE_SNAPSHOT_PATH)
+            except Exception as exc:
+                logger.warning("Error guardando snapshot de ultimos valores: %s", exc)
+
+    # Todos los workers restauran el snapshot; solo uno lo escribe
+    last_value_snapshot_task = start_singleton("last-value-snapshot", _run_snapshots)
+
+
+@app.on_event("startup")
+async def start_last_value_prune_task():
+    global last_value_prune_task
+    if LAST_VALUE_MAX_AGE_HOURS <= 0 and not history_store.enabled and not replay_buffer.enabled:
+        return
+
+    async def _run_prune():
+        while True:
+            await asyncio.sleep(LAST_VALUE_PRUNE_SECONDS)
+            try:
+                removed = last_message_store.prune()
+                if removed:
+                    logger.info("Ultimos valores vencidos eliminados: %d", removed)
+                history_store.prune()
+                replay_buffer.prune()
+            except Exception as exc:
+                logger.warning("Error depurando cache de ultimos valores: %s", exc)
+
+    last_value_prune_task = asyncio.create_task(_run_prune())
 
 
 @app.on_event("startup")
@@ -1018,6 +1656,38 @@ async def start_reports_scheduler_task():
     await start_report_scheduler()
 
 
+@app.on_event("startup")
+async def start_export_worker_task():
+    global export_db_pool, export_worker_task
+    if not EXPORT_JOBS_ENABLED or not DATABASE_URL:
+        logger.info("Worker de exportaciones deshabilitado")
+        return
+    # Pool dedicado: las exportaciones largas no consumen conexiones del trafico interactivo
+    try:
+        export_db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=1,
+            max_size=EXPORT_JOBS_DB_POOL_SIZE,
+            timeout=10,
+        )
+    except Exception as exc:
+        export_db_pool = None
+        logger.error("No se pudo inicializar el pool de exportaciones: %s", exc)
+        return
+    export_worker_task = asyncio.create_task(
+        export_runner.worker_loop(
+            lambda: export_db_pool,
+            EXPORT_STORAGE_DIR,
+            lambda key: TRENDS_RESOLUTION_SECONDS.get(key),
+        )
+    )
+
+
+@app.on_event("shutdown")
+async def stop_mqtt_clients():
+    await broker_manager.stop()
+
+
 @app.on_event("shutdown")
 async def shutdown_trend_database_pool():
     global trend_db_pool
@@ -1036,6 +1706,59 @@ async def shutdown_quote_database_pool():
     await quote_db.close_pool()
     logger.info("Pool de base de datos para cotizador cerrado.")
 
+@app.on_event("shutdown")
+async def stop_export_worker_task():
+    global export_db_pool, export_worker_task
+    task = export_worker_task
+    export_worker_task = None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        except Exception as exc:
+            logger.debug("Error al detener worker de exportaciones: %s", exc)
+    pool = export_db_pool
+    export_db_pool = None
+    if pool is not None:
+        await pool.close()
+
+
+@app.on_event("shutdown")
+async def flush_last_value_snapshot():
+    global last_value_snapshot_task
+    task = last_value_snapshot_task
+    last_value_snapshot_task = None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    if not LAST_VALUE_SNAPSHOT_ENABLED or (leader_lease is not None and not leader_lease.is_leader):
+        return
+    try:
+        saved = await asyncio.to_thread(last_message_store.save, LAST_VALUE_SNAPSHOT_PATH)
+        logger.info("Snapshot de ultimos valores guardado: %d", saved)
+    except Exception as exc:
+        logger.warning("No se pudo guardar snapshot de ultimos valores: %s", exc)
+
+
+@app.on_event("shutdown")
+async def stop_last_value_prune_task():
+    global last_value_prune_task
+    task = last_value_prune_task
+    last_value_prune_task = None
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
 @app.on_event("shutdown")
 async def stop_session_cleanup_task():
     global session_cleanup_task
@@ -1052,6 +1775,35 @@ async def stop_session_cleanup_task():
     finally:
         session_cleanup_task = None
 
+
+@app.on_event("shutdown")
+async def stop_session_heartbeat_task():
+    global session_heartbeat_task
+    task = session_heartbeat_task
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as exc:
+        logger.debug("Error al detener tarea de heartbeat de sesiones: %s", exc)
+    finally:
+        session_heartbeat_task = None
+
+
+@app.on_event("shutdown")
+async def stop_cluster():
+    # Despues de guardar el snapshot, que solo escribe el lider
+    global leader_lease, last_value_bus
+    bus, last_value_bus = last_value_bus, None
+    if bus is not None:
+        await bus.stop()
+    lease, leader_lease = leader_lease, None
+    if lease is not None:
+        await lease.stop()
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -1063,39 +1815,6 @@ app.add_middleware(
 )
 
 # ---- MQTT last message cache ----
-last_message_store: Dict[str, Dict[str, Any]] = {}
-last_message_lock = threading.Lock()
-
-
-def remember_message(data: Dict[str, Any]) -> None:
-    topic = data.get("topic")
-    if not topic:
-        return
-    entry = {
-        "topic": topic,
-        "payload": data.get("payload"),
-        "retain": bool(data.get("retain")),
-        "qos": int(data.get("qos", 0))
-    }
-    broker_key = data.get("broker")
-    if broker_key:
-        entry["broker"] = broker_key
-    with last_message_lock:
-        last_message_store[topic] = entry
-
-
-
-def snapshot_for_prefixes(prefixes: List[str], broker_key: Optional[str] = None) -> List[Dict[str, Any]]:
-    normalized = [p.rstrip("/") + "/" for p in prefixes]
-    with last_message_lock:
-        results: List[Dict[str, Any]] = []
-        for topic, entry in last_message_store.items():
-            if broker_key and entry.get("broker") and entry.get("broker") != broker_key:
-                continue
-            if any((topic.rstrip("/") + "/").startswith(pref) for pref in normalized):
-                results.append(dict(entry))
-        return results
-
 def try_decode(b: bytes) -> Any:
     try:
         s = b.decode("utf-8")
@@ -1107,6 +1826,51 @@ def try_decode(b: bytes) -> Any:
         return {"_binary_base64": base64.b64encode(b).decode("ascii")}
 
 
+mqtt_counters = Counters(("received", "routed", "unrouted", "deliveries"))
+# Secuencia monotona de mensajes por broker (se reinicia con WS_STREAM_EPOCH)
+message_sequences = Counters(())
+
+last_message_store = LastValueCache(
+    TOPIC_BASE,
+    try_decode,
+    max_per_company=LAST_VALUE_MAX_PER_COMPANY,
+    max_age_seconds=LAST_VALUE_MAX_AGE_HOURS * 3600,
+    stale_after_seconds=LAST_VALUE_STALE_SECONDS,
+    max_partitions=LAST_VALUE_MAX_COMPANIES,
+    accepts=(lambda company: company in COMPANY_BROKER_MAP) if LAST_VALUE_KNOWN_COMPANIES_ONLY else None,
+)
+
+replay_buffer = ReplayBuffer(
+    last_message_store.company_for,
+    try_decode,
+    WS_REPLAY_BUFFER_SIZE,
+    max_rings=WS_REPLAY_MAX_COMPANIES,
+    max_bytes=WS_REPLAY_MAX_MB * 1024 * 1024,
+    idle_seconds=WS_REPLAY_IDLE_MINUTES * 60,
+)
+
+history_store = HistoryStore(
+    HISTORY_TOPICS,
+    horizon_seconds=HISTORY_HORIZON_MINUTES * 60,
+    max_points=HISTORY_MAX_POINTS_PER_TOPIC,
+    max_topics=HISTORY_MAX_TOPICS,
+    default_planta=DEFAULT_PLANTA_ID,
+)
+
+
+def remember_message(topic: str, raw: bytes, qos: int, retain: bool, broker_key: Optional[str], seq: int = 0) -> None:
+    if not topic:
+        return
+    last_message_store.put(topic, raw, qos=qos, retain=retain, broker_key=broker_key)
+    if seq:
+        replay_buffer.append(seq, topic, raw, qos, retain, broker_key)
+    history_store.record(topic, raw, broker_key, retain=retain)
+
+
+def snapshot_for_prefixes(prefixes: List[str], broker_key: Optional[str] = None) -> List[Dict[str, Any]]:
+    return last_message_store.snapshot(prefixes, broker_key)
+
+
 def default_plants_for_company(company_id: str) -> List[Dict[str, Any]]:
     serial = sanitize_serial_code(company_id)
     return [{
@@ -1221,6 +1985,44 @@ def normalize_container_plants(raw_containers: Any, plants: List[Dict[str, Any]]
     return normalized
 
 
+def normalize_calculated_tags(raw_tags: Any) -> List[Dict[str, Any]]:
+    if not isinstance(raw_tags, list):
+        return []
+    normalized: List[Dict[str, Any]] = []
+    for entry in raw_tags:
+        if not isinstance(entry, dict):
+            continue
+        tag = coerce_str(entry.get("tag") or entry.get("name"), "")
+        expression = coerce_str(entry.get("expression") or entry.get("expr"), "")
+        if not tag or not expression:
+            continue
+        normalized_entry = dict(entry)
+        normalized_entry.pop("name", None)
+        normalized_entry.pop("expr", None)
+        normalized_entry["tag"] = tag
+        normalized_entry["expression"] = expression
+        normalized_entry["unit"] = coerce_str(entry.get("unit"), "")
+        normalized_entry["description"] = coerce_str(entry.get("description"), "")
+        normalized.append(normalized_entry)
+    return normalized
+
+
+def calculated_definitions_for_company(company_id: str) -> Optional[List[Dict[str, Any]]]:
+    """Definiciones `calculatedTags` de la empresa para procesos fuera de un request (reportes)."""
+    try:
+        return load_scada_config(company_id).get("calculatedTags")
+    except HTTPException:
+        return None
+
+
+def calculated_tags_for_config(cfg: Dict[str, Any]) -> Optional[trend_calculated.CalculatedTagSet]:
+    try:
+        return trend_calculated.compiled_tag_set(cfg.get("calculatedTags"))
+    except ValueError as exc:
+        logger.warning("Tags calculados invalidos para empresa %s: %s", cfg.get("empresaId"), exc)
+        return None
+
+
 def plant_lookup(plants: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
     return {plant["id"]: plant for plant in plants}
 
@@ -1307,6 +2109,7 @@ def normalize_config(data: Dict[str, Any]) -> Dict[str, Any]:
     result["plants"] = plants
     result["plantAssignments"] = normalize_plant_assignments(result.get("plantAssignments"), plants)
     result["containers"] = normalize_container_plants(result.get("containers"), plants)
+    result["calculatedTags"] = normalize_calculated_tags(result.get("calculatedTags"))
     return result
 
 
@@ -1833,77 +2636,246 @@ def validate_config_payload(data: Dict[str, Any]) -> Dict[str, Any]:
             if topic is not None and not isinstance(topic, str):
                 raise HTTPException(status_code=400, detail=f"El topic del objeto {o_idx} del contenedor {c_idx} debe ser texto")
     try:
-        return normalize_config(data)
+        normalized = normalize_config(data)
+        trend_calculated.build_tag_set(normalized["calculatedTags"])
+        return normalized
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
 
 
 # ---- WebSocket connection manager ----
+def resolve_conflate_seconds(requested_ms: Optional[int]) -> float:
+    value = WS_CONFLATE_DEFAULT_MS if requested_ms is None else requested_ms
+    if value <= 0:
+        return 0.0
+    return min(max(value, WS_CONFLATE_MIN_MS), WS_CONFLATE_MAX_MS) / 1000.0
+
+
 class WSClient:
-    def __init__(self, ws: WebSocket, uid: str, company_id: str, allowed_prefixes: List[str], broker_key: str):
+    def __init__(
+        self,
+        ws: WebSocket,
+        uid: str,
+        company_id: str,
+        allowed_prefixes: List[str],
+        broker_key: str,
+        conflate_seconds: float = 0.0,
+        protocol: str = ws_codec.PROTOCOL_JSON,
+    ):
         self.ws = ws
         self.uid = uid
         self.company_id = company_id
         self.allowed_prefixes = [p.rstrip("/") + "/" for p in allowed_prefixes]
         self.broker_key = broker_key
+        self.protocol = protocol
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.writer_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.closed = False
+        # Conflacion: ultimo frame pendiente por topic, enviado en lote cada intervalo
+        self.conflate_seconds = conflate_seconds
+        self.pending: Dict[str, WSFrame] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        # Cierre por cliente lento: se guarda la referencia para que la tarea no se pierda
+        self.close_task: Optional[asyncio.Task] = None
+        # Filtros que el cliente realmente renderiza; siempre dentro de allowed_prefixes
+        self.subscriptions: Set[str] = {p.rstrip("/") for p in allowed_prefixes}
 
     def can_receive(self, topic: str) -> bool:
         t = topic.rstrip("/") + "/"
         return any(t.startswith(pref) for pref in self.allowed_prefixes)
 
-class ConnectionManager:
-    clients: List[WSClient] = []
-    lock = threading.Lock()
+    def start(self) -> None:
+        self.writer_task = asyncio.create_task(self._writer())
+        if self.conflate_seconds > 0:
+            self.flush_task = asyncio.create_task(self._flusher())
+
+    async def stop(self) -> None:
+        self.closed = True
+        self.pending.clear()
+        tasks = [self.writer_task, self.flush_task]
+        self.writer_task = None
+        self.flush_task = None
+        for task in tasks:
+            if task is None or task is asyncio.current_task():
+                continue
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def send(self, message: Dict[str, Any]) -> None:
+        # Respuestas propias de la conexion (hello/ack/error): esperan lugar en la cola
+        # en vez de descartarse, y comparten el orden con los mensajes MQTT.
+        if not self.closed:
+            frame = ws_codec.encode(message, self.protocol)
+            await asyncio.wait_for(self.queue.put(frame), timeout=WS_SEND_TIMEOUT_SECONDS)
+
+    def enqueue(self, frame: WSFrame, topic: Optional[str] = None) -> bool:
+        """Encola un frame ya serializado sin bloquear; debe llamarse desde el event loop."""
+        if self.closed:
+            return False
+        if self.conflate_seconds > 0 and topic is not None:
+            # Conserva solo el valor mas reciente; reinsertar mantiene el orden de llegada
+            self.pending.pop(topic, None)
+            self.pending[topic] = frame
+            return True
+        return self._put(frame)
 
-    @classmethod
-    def add(cls, c: WSClient):
-        with cls.lock:
-            cls.clients.append(c)
+    def flush_pending(self) -> None:
+        if not self.pending or self.closed:
+            return
+        frames = list(self.pending.values())
+        self.pending = {}
+        self._put(frames[0] if len(frames) == 1 else ws_codec.batch(frames, self.protocol))
 
-    @classmethod
-    def remove(cls, ws: WebSocket):
-        with cls.lock:
-            cls.clients = [c for c in cls.clients if c.ws is not ws]
+    async def _flusher(self) -> None:
+        while True:
+            await asyncio.sleep(self.conflate_seconds)
+            self.flush_pending()
 
-    @classmethod
-    def broadcast(cls, topic: str, data: dict):
-        delivered = 0
-        to_remove = []
-        loop = event_loop
-        for c in list(cls.clients):
-            try:
-                if not c.can_receive(topic):
-                    continue
-                data_broker = data.get("broker")
-                if data_broker and getattr(c, "broker_key", DEFAULT_BROKER_KEY) != data_broker:
-                    continue
-                if loop is None:
-                    logger.warning("WS deliver skipped; no event loop topic=%s", topic)
-                    continue
-                future = asyncio.run_coroutine_threadsafe(c.ws.send_json(data), loop)
-                try:
-                    future.result(timeout=5)
-                    delivered += 1
-                    logger.info(
-                        "WS deliver topic=%s uid=%s empresa=%s broker=%s",
-                        topic,
-                        c.uid,
-                        getattr(c, "company_id", None),
-                        getattr(c, "broker_key", DEFAULT_BROKER_KEY),
-                    )
-                except FutureTimeoutError:
-                    logger.error("WS deliver timeout uid=%s topic=%s", c.uid, topic)
-                    to_remove.append(c.ws)
-                except Exception as exc:
-                    logger.error("WS deliver failed uid=%s topic=%s: %s", c.uid, topic, exc, exc_info=exc)
-                    to_remove.append(c.ws)
-            except Exception as exc:
-                logger.error("Broadcast loop error uid=%s topic=%s: %s", getattr(c, "uid", None), topic, exc, exc_info=exc)
-                to_remove.append(c.ws)
-        for ws in to_remove:
-            cls.remove(ws)
-        if delivered == 0:
-            logger.info("WS no listeners for topic=%s", topic)
+    def _put(self, frame: WSFrame) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+        self.dropped += 1
+        if WS_SLOW_CLIENT_POLICY == "disconnect":
+            logger.warning("WS cliente lento desconectado uid=%s empresa=%s", self.uid, self.company_id)
+            self.closed = True
+            self.close_task = asyncio.create_task(self._close(code=1013))
+            return False
+        if WS_SLOW_CLIENT_POLICY == "drop_oldest":
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            self.queue.put_nowait(frame)
+        if self.dropped == 1 or self.dropped % 100 == 0:
+            logger.warning(
+                "WS cola llena uid=%s empresa=%s descartados=%d politica=%s",
+                self.uid,
+                self.company_id,
+                self.dropped,
+                WS_SLOW_CLIENT_POLICY,
+            )
+        return WS_SLOW_CLIENT_POLICY == "drop_oldest"
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                frame = await self.queue.get()
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(self.ws.send_bytes(frame), timeout=WS_SEND_TIMEOUT_SECONDS)
+                else:
+                    await asyncio.wait_for(self.ws.send_text(frame), timeout=WS_SEND_TIMEOUT_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.error("WS deliver timeout uid=%s empresa=%s", self.uid, self.company_id)
+            await self._close(code=1013)
+        except Exception as exc:
+            logger.error("WS deliver failed uid=%s empresa=%s: %s", self.uid, self.company_id, exc)
+            await self._close(code=1011)
+
+    async def _close(self, code: int) -> None:
+        self.closed = True
+        ConnectionManager.remove(self.ws)
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+class ConnectionManager:
+    clients: List[WSClient] = []
+    # Indice (broker, prefijo) -> clientes; evita recorrer todos los clientes por mensaje
+    index: TopicIndex[WSClient] = TopicIndex()
+    lock = threading.Lock()
+
+    @classmethod
+    def add(cls, c: WSClient):
+        with cls.lock:
+            cls.clients.append(c)
+            cls.index.add_many(c.broker_key, c.subscriptions, c)
+        broker_manager.acquire_prefixes(c.broker_key, c.allowed_prefixes)
+
+    @classmethod
+    def subscribe(cls, c: WSClient, filters: List[str], replace: bool = False) -> List[str]:
+        """Actualiza las suscripciones del cliente y retorna los filtros nuevos."""
+        with cls.lock:
+            current = set(c.subscriptions)
+            target = set(filters) if replace else current | set(filters)
+            for removed in current - target:
+                cls.index.discard(c.broker_key, removed, c)
+            added = sorted(target - current)
+            registered = any(existing is c for existing in cls.clients)
+            if registered:
+                cls.index.add_many(c.broker_key, added, c)
+            c.subscriptions = target
+            return added
+
+    @classmethod
+    def unsubscribe(cls, c: WSClient, filters: List[str]) -> None:
+        with cls.lock:
+            for item in filters:
+                if item in c.subscriptions:
+                    c.subscriptions.discard(item)
+                    cls.index.discard(c.broker_key, item, c)
+
+    @classmethod
+    def remove(cls, ws: WebSocket):
+        with cls.lock:
+            removed = [c for c in cls.clients if c.ws is ws]
+            cls.clients = [c for c in cls.clients if c.ws is not ws]
+            for c in removed:
+                cls.index.remove(c)
+        for c in removed:
+            broker_manager.release_prefixes(c.broker_key, c.allowed_prefixes)
+
+    @classmethod
+    def broadcast(cls, topic: str, raw: bytes, qos: int, retain: bool, broker_key: Optional[str], seq: int = 0):
+        # En modo thread corre en el hilo de red de paho: solo selecciona destinatarios y
+        # delega el encolado al event loop, sin esperar a que cada cliente reciba el mensaje.
+        recipients = [c for c in cls.index.match(topic, broker_key) if not c.closed]
+        if not recipients:
+            mqtt_counters.incr("unrouted")
+            return
+        loop = event_loop
+        if loop is None:
+            logger.warning("WS deliver skipped; no event loop topic=%s", topic)
+            return
+        mqtt_counters.incr("routed")
+        mqtt_counters.incr("deliveries", len(recipients))
+        data = {
+            "topic": topic,
+            "payload": try_decode(raw),
+            "qos": qos,
+            "retain": retain,
+            "broker": broker_key,
+            "seq": seq,
+        }
+        # Un solo frame por protocolo, compartido por todas las colas de destino
+        frames: Dict[str, WSFrame] = {}
+        for c in recipients:
+            if c.protocol not in frames:
+                frames[c.protocol] = ws_codec.encode(data, c.protocol)
+        if broker_manager.on_event_loop():
+            # Modo asyncio: ya estamos en el event loop, no hace falta saltar de hilo
+            cls._dispatch(recipients, frames, topic)
+            return
+        try:
+            loop.call_soon_threadsafe(cls._dispatch, recipients, frames, topic)
+        except RuntimeError:
+            logger.warning("WS deliver skipped; event loop cerrado topic=%s", topic)
+
+    @staticmethod
+    def _dispatch(recipients: List[WSClient], frames: Dict[str, WSFrame], topic: str) -> None:
+        for c in recipients:
+            c.enqueue(frames[c.protocol], topic)
 
 # ---- Helpers ----
 
@@ -2029,8 +3001,62 @@ def allowed_prefixes_for_user(
     combined.extend(PUBLIC_ALLOWED_PREFIXES)
     return combined
 
-def ensure_mqtt_connected(broker_key: Optional[str]):
-    broker_manager.ensure_connected(broker_key)
+
+def topic_within_prefixes(topic: str, prefixes: List[str]) -> bool:
+    candidate = topic.rstrip("/") + "/"
+    return any(candidate.startswith(pref.rstrip("/") + "/") for pref in prefixes)
+
+
+def normalize_topic_filter(raw: Any) -> str:
+    """Filtro de suscripcion como prefijo; acepta el sufijo MQTT `/#`."""
+    if not isinstance(raw, str):
+        raise ValueError("El filtro debe ser texto")
+    value = raw.strip()
+    if value.endswith("/#"):
+        value = value[:-2]
+    value = value.rstrip("/")
+    if not value:
+        raise ValueError("Filtro vacio")
+    if "#" in value or "+" in value:
+        raise ValueError(f"Comodines no soportados: {raw}")
+    return value
+
+
+def default_subscriptions_for_config(cfg: Dict[str, Any], company_id: Optional[str], prefixes: List[str]) -> List[str]:
+    """Topics de los widgets configurados (topic/feedbackTopic) dentro del alcance del usuario."""
+    if not company_id:
+        return [p.rstrip("/") for p in prefixes]
+    base = TOPIC_BASE.rstrip("/")
+    lookup = plant_lookup(cfg.get("plants", []) or [])
+    topics: Set[str] = set()
+    for container in cfg.get("containers", []) or []:
+        if not isinstance(container, dict):
+            continue
+        plant = lookup.get(container.get("plantId"))
+        serial = plant.get("serialCode") if plant else None
+        if not serial:
+            continue
+        for obj in container.get("objects", []) or []:
+            if not isinstance(obj, dict):
+                continue
+            for key in ("topic", "feedbackTopic"):
+                relative = obj.get(key)
+                if not isinstance(relative, str):
+                    continue
+                path = "/".join(part for part in relative.split("/") if part)
+                if not path:
+                    continue
+                full = f"{base}/{company_id}/{serial}/{path}"
+                if topic_within_prefixes(full, prefixes):
+                    topics.add(full)
+    if not topics:
+        return [p.rstrip("/") for p in prefixes]
+    topics.update(p.rstrip("/") for p in PUBLIC_ALLOWED_PREFIXES if topic_within_prefixes(p, prefixes))
+    return sorted(topics)
+
+
+async def ensure_mqtt_connected_async(broker_key: Optional[str]):
+    await broker_manager.ensure_connected_async(broker_key)
 
 
 
@@ -2352,7 +3378,8 @@ async def trigger_report_run_endpoint(
         raise HTTPException(status_code=404, detail="Reporte no encontrado")
     try:
         run = await report_service.create_run(pool, company_id, report_id, definition, request, decoded.get("email"))
-        report_runner.spawn_background(pool, run.id)
+        calculated_definitions = await asyncio.to_thread(calculated_definitions_for_company, company_id)
+        report_runner.spawn_background(pool, run.id, calculated_definitions)
         return run
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc)) from exc
@@ -2719,14 +3746,15 @@ def get_trend_page():
     return FileResponse(TREND_HTML_PATH, media_type="text/html")
 
 
-@app.get("/api/tendencias/tags")
-async def list_trend_tags(
-    authorization: Optional[str] = Header(None),
-    empresa_id: Optional[str] = Query(None),
-    planta_id: Optional[str] = Query(None, alias="plantaId"),
-    limit: int = Query(200, ge=1, le=1000),
-):
-    decoded = verify_bearer_token(authorization)
+@dataclass
+class TrendScope:
+    company_id: str
+    config: Dict[str, Any]
+    allowed_plants: List[str]
+    selected_plants: Optional[List[str]]
+
+
+def resolve_trend_scope(decoded: Dict[str, Any], empresa_id: Optional[str], planta_id: Optional[str]) -> TrendScope:
     is_master = is_master_admin(decoded)
     if empresa_id:
         if not is_master:
@@ -2742,7 +3770,6 @@ async def list_trend_tags(
     email = decoded.get("email") if decoded else None
     role = "admin" if is_master else role_for_email(config, email)
     allowed_plants = [normalize_plant_id(pid) for pid in resolve_user_plant_ids(config, email, role, is_master)]
-    plants_list = config.get("plants") or []
     # Normaliza planta solicitada
     selected_plants: Optional[List[str]] = None
     if planta_id:
@@ -2752,6 +3779,144 @@ async def list_trend_tags(
         selected_plants = [plant_candidate]
     elif allowed_plants:
         selected_plants = allowed_plants
+    return TrendScope(
+        company_id=company_id,
+        config=config,
+        allowed_plants=allowed_plants,
+        selected_plants=selected_plants,
+    )
+
+
+def normalize_trend_tags(tags: Optional[List[str]]) -> List[str]:
+    normalized_tags: List[str] = []
+    seen: Set[str] = set()
+    for raw in tags or []:
+        if raw is None:
+            continue
+        candidate = raw.strip()
+        if not candidate:
+            continue
+        lowered = candidate.lower()
+        if lowered in seen:
+            continue
+        seen.add(lowered)
+        normalized_tags.append(candidate)
+    if not normalized_tags:
+        raise HTTPException(status_code=400, detail="tag es requerido")
+    return normalized_tags
+
+
+def resolve_trend_resolution(resolution: Optional[str]) -> Tuple[str, Optional[int]]:
+    resolution_key = (resolution or "raw").strip().lower()
+    if resolution_key not in TRENDS_RESOLUTION_SECONDS:
+        raise HTTPException(status_code=400, detail=f"Resolucion no soportada: {resolution}")
+    return resolution_key, TRENDS_RESOLUTION_SECONDS[resolution_key]
+
+
+def resolve_trend_window(start: Optional[datetime], end: Optional[datetime]) -> Tuple[datetime, datetime]:
+    now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
+    if start is not None and start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end is not None and end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    end_dt = end or now_utc
+    start_dt = start or (end_dt - timedelta(hours=DEFAULT_TRENDS_RANGE_HOURS))
+    if start_dt >= end_dt:
+        raise HTTPException(status_code=400, detail="El rango de fechas es invalido")
+    return start_dt, end_dt
+
+
+def build_series_trend_entry(
+    tag: str,
+    timestamps: np.ndarray,
+    values: np.ndarray,
+    *,
+    interval_seconds: Optional[int],
+    aggregates: List[str],
+    limit: int,
+) -> Dict[str, Any]:
+    """Entrada de /api/tendencias a partir de una serie ya cargada (ordenada por timestamp)."""
+    stats = trend_calculated.series_stats(timestamps, values)
+    if stats is None:
+        return {"tag": tag, "points": [], "stats": None, "count": 0}
+    stats["latestTimestamp"] = isoformat_utc(datetime.fromtimestamp(stats["latestTimestamp"], tz=timezone.utc))
+    entry: Dict[str, Any] = {"tag": tag, "stats": stats}
+    if interval_seconds is None:
+        stamps = trend_align.grid_timestamps(timestamps[:limit])
+        entry["points"] = [
+            {"timestamp": stamp, "value": float(value)} for stamp, value in zip(stamps, values[:limit].tolist())
+        ]
+    else:
+        buckets, columns = trend_calculated.bucket_aggregates(timestamps, values, interval_seconds, aggregates)
+        stamps = trend_align.grid_timestamps(buckets[:limit])
+        aggregate_columns = {
+            key: column[:limit].astype(np.int64).tolist() if key == "count" else trend_align.to_json_rows(column[:limit])
+            for key, column in columns.items()
+        }
+        primary = aggregate_columns[aggregates[0]]
+        entry["points"] = [{"timestamp": stamp, "value": value} for stamp, value in zip(stamps, primary)]
+        entry["timestamps"] = stamps
+        entry["aggregates"] = aggregate_columns
+    entry["count"] = len(entry["points"])
+    return entry
+
+
+def build_calculated_trend_entry(
+    tag_set: trend_calculated.CalculatedTagSet,
+    tag: str,
+    samples: Dict[str, trend_service.TagSamples],
+    *,
+    interval_seconds: Optional[int],
+    aggregates: List[str],
+    limit: int,
+) -> Dict[str, Any]:
+    timestamps, values = trend_calculated.evaluate_series(tag_set, tag, samples)
+    entry = build_series_trend_entry(
+        tag, timestamps, values, interval_seconds=interval_seconds, aggregates=aggregates, limit=limit
+    )
+    entry["calculated"] = True
+    return entry
+
+
+def memory_trend_series(
+    company_id: str,
+    tags: List[str],
+    plants: Optional[List[str]],
+    start_dt: datetime,
+    end_dt: datetime,
+    *,
+    interval_seconds: Optional[int],
+    aggregates: List[str],
+    limit: int,
+) -> Optional[List[Dict[str, Any]]]:
+    """Series desde la historia en memoria, o None si algun tag no esta cubierto completo."""
+    loaded = []
+    for tag in tags:
+        series = history_store.series(company_id, tag, plants, start_dt.timestamp(), end_dt.timestamp())
+        if series is None:
+            return None
+        loaded.append((tag, series))
+    return [
+        build_series_trend_entry(
+            tag, timestamps, values, interval_seconds=interval_seconds, aggregates=aggregates, limit=limit
+        )
+        for tag, (timestamps, values) in loaded
+    ]
+
+
+@app.get("/api/tendencias/tags")
+async def list_trend_tags(
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+    planta_id: Optional[str] = Query(None, alias="plantaId"),
+    limit: int = Query(200, ge=1, le=1000),
+):
+    decoded = verify_bearer_token(authorization)
+    scope = resolve_trend_scope(decoded, empresa_id, planta_id)
+    company_id = scope.company_id
+    allowed_plants = scope.allowed_plants
+    selected_plants = scope.selected_plants
+    plants_list = scope.config.get("plants") or []
 
     pool = require_trend_pool()
     effective_limit = max(1, min(int(limit), 1000))
@@ -2777,6 +3942,10 @@ async def list_trend_tags(
     async with pool.acquire() as conn:
         rows = await conn.fetch(query, *params)
     tags = [row["tag"] for row in rows if row["tag"]]
+    calculated = calculated_tags_for_config(scope.config)
+    calculated_names = sorted(calculated.tags) if calculated is not None else []
+    if calculated_names:
+        tags = sorted(set(tags) | set(calculated_names))
     visible_plants = []
     for item in plants_list:
         raw_id = item.get("id") or item.get("serialCode") or item.get("name") or ""
@@ -2787,14 +3956,15 @@ async def list_trend_tags(
     return {
         "empresaId": company_id,
         "tags": tags,
+        "calculatedTags": calculated_names,
         "count": len(tags),
         "plants": visible_plants,
         "selectedPlantas": selected_plants or [],
     }
 
 
-@app.get("/api/tendencias")
-async def read_trend_series(
+@app.get("/api/tendencias/export")
+async def export_trend_series(
     tags: List[str] = Query(..., alias="tag"),
     authorization: Optional[str] = Header(None),
     empresa_id: Optional[str] = Query(None),
@@ -2802,63 +3972,239 @@ async def read_trend_series(
     from_ts: Optional[str] = Query(None, alias="from"),
     to_ts: Optional[str] = Query(None, alias="to"),
     resolution: str = Query("raw"),
-    limit: Optional[int] = Query(None, ge=1, le=10000),
+    export_format: str = Query("csv", alias="format"),
+    compress: bool = Query(True, alias="gzip"),
 ):
-    if not tags:
-        raise HTTPException(status_code=400, detail="tag es requerido")
+    normalized_tags = normalize_trend_tags(tags)
+    decoded = verify_bearer_token(authorization)
+    scope = resolve_trend_scope(decoded, empresa_id, planta_id)
+    _, interval_seconds = resolve_trend_resolution(resolution)
+    start_dt, end_dt = resolve_trend_window(parse_iso8601(from_ts), parse_iso8601(to_ts))
+    format_key = (export_format or "csv").strip().lower()
+    if format_key not in trend_export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado: {export_format}")
 
-    normalized_tags: List[str] = []
-    seen: Set[str] = set()
-    for raw in tags:
-        if raw is None:
-            continue
-        candidate = raw.strip()
-        if not candidate:
-            continue
-        lowered = candidate.lower()
-        if lowered in seen:
-            continue
-        seen.add(lowered)
-        normalized_tags.append(candidate)
+    pool = require_trend_pool()
+    pages = trend_service.iter_export_rows(
+        pool,
+        empresa_id=scope.company_id,
+        plantas=scope.selected_plants,
+        tags=normalized_tags,
+        start=start_dt,
+        end=end_dt,
+        interval_seconds=interval_seconds,
+    )
+    filename = trend_export.export_filename(format_key, compress)
+    logger.info(
+        "Exportacion de tendencias empresa=%s tags=%d formato=%s gzip=%s",
+        scope.company_id,
+        len(normalized_tags),
+        format_key,
+        compress,
+    )
+    return StreamingResponse(
+        trend_export.stream_export(pages, format_key, compress),
+        media_type=trend_export.media_type_for(format_key, compress),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
-    if not normalized_tags:
-        raise HTTPException(status_code=400, detail="tag es requerido")
+
+@app.get("/api/tendencias/matrix")
+async def read_trend_matrix(
+    tags: List[str] = Query(..., alias="tag"),
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+    planta_id: Optional[str] = Query(None, alias="plantaId"),
+    from_ts: Optional[str] = Query(None, alias="from"),
+    to_ts: Optional[str] = Query(None, alias="to"),
+    resolution: Optional[str] = Query(None),
+    step: Optional[int] = Query(None, ge=1),
+    align: str = Query("previous"),
+    agg: str = Query("avg"),
+):
+    normalized_tags = normalize_trend_tags(tags)
+    if len(normalized_tags) > TRENDS_MATRIX_MAX_TAGS:
+        raise HTTPException(status_code=400, detail=f"Maximo {TRENDS_MATRIX_MAX_TAGS} tags por consulta")
+    align_key = (align or "previous").strip().lower()
+    if align_key not in trend_align.ALIGN_METHODS:
+        raise HTTPException(status_code=400, detail=f"Alineacion no soportada: {align}")
+    try:
+        aggregate = trend_service.normalize_aggregates([agg])[0]
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
 
     decoded = verify_bearer_token(authorization)
-    is_master = is_master_admin(decoded)
-    if empresa_id:
-        if not is_master:
-            raise HTTPException(status_code=403, detail="Solo administradores maestros pueden consultar otras empresas")
-        try:
-            company_id = sanitize_company_id(empresa_id)
-        except ValueError as exc:
-            raise HTTPException(status_code=400, detail=f"empresaId invalido: {exc}") from exc
-    else:
-        company_id = extract_company_id(decoded)
+    scope = resolve_trend_scope(decoded, empresa_id, planta_id)
+    start_dt, end_dt = resolve_trend_window(parse_iso8601(from_ts), parse_iso8601(to_ts))
+
+    step_seconds = step
+    if step_seconds is None and resolution:
+        _, step_seconds = resolve_trend_resolution(resolution)
+    if step_seconds is None:
+        window_seconds = (end_dt - start_dt).total_seconds()
+        step_seconds = max(1, math.ceil(window_seconds / TRENDS_MATRIX_DEFAULT_POINTS))
+    if trend_align.grid_size(start_dt, end_dt, step_seconds) > TRENDS_MATRIX_MAX_POINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"La grilla supera {TRENDS_MATRIX_MAX_POINTS} puntos; aumenta step o reduce el rango",
+        )
 
-    config = load_scada_config(company_id)
-    email = decoded.get("email") if decoded else None
-    role = "admin" if is_master else role_for_email(config, email)
-    allowed_plants = [normalize_plant_id(pid) for pid in resolve_user_plant_ids(config, email, role, is_master)]
-    selected_plants: Optional[List[str]] = None
-    if planta_id:
-        plant_candidate = normalize_plant_id(planta_id)
-        if allowed_plants and plant_candidate not in allowed_plants:
-            raise HTTPException(status_code=403, detail="Planta no autorizada")
-        selected_plants = [plant_candidate]
-    elif allowed_plants:
-        selected_plants = allowed_plants
+    pool = require_trend_pool()
+    async with pool.acquire() as conn:
+        if align_key == "bucket":
+            samples = await trend_service.fetch_bucket_samples(
+                conn,
+                empresa_id=scope.company_id,
+                plantas=scope.selected_plants,
+                tags=normalized_tags,
+                start=start_dt,
+                end=end_dt,
+                interval_seconds=step_seconds,
+                aggregate=aggregate,
+            )
+        else:
+            samples = await trend_service.fetch_tag_samples(
+                conn,
+                empresa_id=scope.company_id,
+                plantas=scope.selected_plants,
+                tags=normalized_tags,
+                start=start_dt,
+                end=end_dt,
+                max_rows_per_tag=TRENDS_MATRIX_MAX_ROWS_PER_TAG,
+            )
 
-    resolution_key = (resolution or "raw").strip().lower()
-    if resolution_key not in TRENDS_RESOLUTION_SECONDS:
-        raise HTTPException(status_code=400, detail=f"Resolucion no soportada: {resolution}")
-    interval_seconds = TRENDS_RESOLUTION_SECONDS[resolution_key]
+    grid = trend_align.build_grid(start_dt, end_dt, step_seconds)
+    matrix = trend_align.build_matrix(samples, normalized_tags, grid, align_key, step_seconds)
+    return {
+        "tags": normalized_tags,
+        "timestamps": trend_align.grid_timestamps(grid),
+        "values": trend_align.to_json_rows(matrix),
+        "meta": {
+            "empresaId": scope.company_id,
+            "from": isoformat_utc(start_dt),
+            "to": isoformat_utc(end_dt),
+            "step": step_seconds,
+            "align": align_key,
+            "aggregate": aggregate if align_key == "bucket" else None,
+            "points": int(grid.size),
+            "truncated": [tag for tag in normalized_tags if samples[tag].truncated],
+        },
+    }
 
-    now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
-    end_dt = parse_iso8601(to_ts) or now_utc
-    start_dt = parse_iso8601(from_ts) or (end_dt - timedelta(hours=DEFAULT_TRENDS_RANGE_HOURS))
-    if start_dt >= end_dt:
-        raise HTTPException(status_code=400, detail="El rango de fechas es invalido")
+
+@app.post("/api/tendencias/export-jobs", response_model=ExportJobOut, status_code=202)
+async def create_export_job_endpoint(
+    payload: ExportJobCreate,
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+):
+    normalized_tags = normalize_trend_tags(payload.tags)
+    decoded = verify_bearer_token(authorization)
+    scope = resolve_trend_scope(decoded, empresa_id, payload.planta_id)
+    resolution_key, _ = resolve_trend_resolution(payload.resolution)
+    start_dt, end_dt = resolve_trend_window(payload.window_start, payload.window_end)
+    if not EXPORT_JOBS_ENABLED:
+        raise HTTPException(status_code=503, detail="Exportaciones asincronas deshabilitadas")
+    pool = require_trend_pool()
+    try:
+        job = await export_service.create_job(
+            pool,
+            empresa_id=scope.company_id,
+            planta_ids=scope.selected_plants,
+            tags=normalized_tags,
+            resolution=resolution_key,
+            export_format=payload.format,
+            window_start=start_dt,
+            window_end=end_dt,
+            requested_by=decoded.get("uid"),
+            max_pending=EXPORT_JOBS_MAX_QUEUED_PER_COMPANY,
+        )
+    except asyncpg.PostgresError as exc:
+        logger.exception("No se pudo crear la exportacion: %s", exc)
+        raise HTTPException(status_code=500, detail="No se pudo crear la exportacion") from exc
+    if job is None:
+        raise HTTPException(status_code=429, detail="Demasiadas exportaciones pendientes para la empresa")
+    return job
+
+
+def export_job_owner_filter(decoded: Dict[str, Any]) -> Optional[str]:
+    return None if is_master_admin(decoded) else decoded.get("uid")
+
+
+@app.get("/api/tendencias/export-jobs", response_model=List[ExportJobOut])
+async def list_export_jobs_endpoint(
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+    limit: int = Query(20, ge=1, le=200),
+):
+    decoded = verify_bearer_token(authorization)
+    company_id = resolve_company_access(decoded, empresa_id)
+    pool = require_trend_pool()
+    return await export_service.list_jobs(pool, company_id, export_job_owner_filter(decoded), limit=limit)
+
+
+@app.get("/api/tendencias/export-jobs/{job_id}", response_model=ExportJobOut)
+async def get_export_job_endpoint(
+    job_id: int,
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+):
+    decoded = verify_bearer_token(authorization)
+    company_id = resolve_company_access(decoded, empresa_id)
+    pool = require_trend_pool()
+    job = await export_service.get_job(pool, company_id, job_id, export_job_owner_filter(decoded))
+    if not job:
+        raise HTTPException(status_code=404, detail="Exportacion no encontrada")
+    return job
+
+
+@app.get("/api/tendencias/export-jobs/{job_id}/download")
+async def download_export_job_endpoint(
+    job_id: int,
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+):
+    decoded = verify_bearer_token(authorization)
+    company_id = resolve_company_access(decoded, empresa_id)
+    pool = require_trend_pool()
+    job = await export_service.get_job(pool, company_id, job_id, export_job_owner_filter(decoded))
+    if not job:
+        raise HTTPException(status_code=404, detail="Exportacion no encontrada")
+    if job.status != "success":
+        raise HTTPException(status_code=409, detail=f"Exportacion en estado {job.status}")
+    raw_path = await export_service.get_job_file_path(pool, job.id)
+    file_path = Path(raw_path) if raw_path else None
+    if file_path is None or not file_path.is_file():
+        raise HTTPException(status_code=410, detail="Archivo de exportacion no disponible")
+    filename = f"tendencias_{job.empresa_id}_{job.id}.{job.format}.gz"
+    return FileResponse(file_path, media_type=trend_export.GZIP_MEDIA_TYPE, filename=filename)
+
+
+@app.get("/api/tendencias")
+async def read_trend_series(
+    tags: List[str] = Query(..., alias="tag"),
+    authorization: Optional[str] = Header(None),
+    empresa_id: Optional[str] = Query(None),
+    planta_id: Optional[str] = Query(None, alias="plantaId"),
+    from_ts: Optional[str] = Query(None, alias="from"),
+    to_ts: Optional[str] = Query(None, alias="to"),
+    resolution: str = Query("raw"),
+    limit: Optional[int] = Query(None, ge=1, le=10000),
+    agg: Optional[List[str]] = Query(None),
+):
+    normalized_tags = normalize_trend_tags(tags)
+    try:
+        aggregates = trend_service.normalize_aggregates(agg)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    decoded = verify_bearer_token(authorization)
+    scope = resolve_trend_scope(decoded, empresa_id, planta_id)
+    company_id = scope.company_id
+    selected_plants = scope.selected_plants
+
+    resolution_key, interval_seconds = resolve_trend_resolution(resolution)
+    start_dt, end_dt = resolve_trend_window(parse_iso8601(from_ts), parse_iso8601(to_ts))
 
     fetch_limit = TRENDS_FETCH_LIMIT
     if limit is not None:
@@ -2867,12 +4213,69 @@ async def read_trend_series(
         except (TypeError, ValueError) as exc:
             raise HTTPException(status_code=400, detail=f"limit invalido: {exc}") from exc
 
+    calculated = calculated_tags_for_config(scope.config)
+    calculated_requested = [tag for tag in normalized_tags if calculated is not None and tag in calculated]
+
+    meta = {
+        "tags": normalized_tags,
+        "empresaId": company_id,
+        "resolution": resolution_key,
+        "aggregates": aggregates if interval_seconds is not None else [],
+        "from": isoformat_utc(start_dt),
+        "to": isoformat_utc(end_dt),
+        "limit": fetch_limit,
+        "requested": len(normalized_tags),
+        "truncated": [],
+    }
+
+    # Ventanas recientes (p. ej. la ultima media hora) se responden sin tocar la base
+    if not calculated_requested:
+        memory_series = memory_trend_series(
+            company_id,
+            normalized_tags,
+            selected_plants,
+            start_dt,
+            end_dt,
+            interval_seconds=interval_seconds,
+            aggregates=aggregates,
+            limit=fetch_limit,
+        )
+        if memory_series is not None:
+            dataset_size = sum(entry["count"] for entry in memory_series)
+            meta.update({"datasetSize": dataset_size, "totalPoints": dataset_size, "source": "memory"})
+            return {"series": memory_series, "meta": meta}
+
     pool = require_trend_pool()
     series_collection: List[Dict[str, Any]] = []
     total_points = 0
 
     async with pool.acquire() as conn:
+        calculated_samples: Dict[str, trend_service.TagSamples] = {}
+        if calculated is not None and calculated_requested:
+            calculated_samples = await trend_service.fetch_tag_samples(
+                conn,
+                empresa_id=company_id,
+                plantas=selected_plants,
+                tags=calculated.raw_dependencies(calculated_requested),
+                start=start_dt,
+                end=end_dt,
+                max_rows_per_tag=TRENDS_MATRIX_MAX_ROWS_PER_TAG,
+            )
+            # Igual que /matrix: se avisa que tags quedaron cortados por el limite de filas
+            meta["truncated"] = calculated.truncated(calculated_requested, calculated_samples)
         for normalized_tag in normalized_tags:
+            if calculated is not None and normalized_tag in calculated_requested:
+                entry = build_calculated_trend_entry(
+                    calculated,
+                    normalized_tag,
+                    calculated_samples,
+                    interval_seconds=interval_seconds,
+                    aggregates=aggregates,
+                    limit=fetch_limit,
+                )
+                total_points += entry["count"]
+                series_collection.append(entry)
+                continue
             stats_query = """
                 SELECT
                     COUNT(*) OVER () AS count,
@@ -2905,6 +4308,7 @@ async def read_trend_series(
                 )
                 continue
 
+            columns: Optional[Dict[str, Any]] = None
             if interval_seconds is None:
                 data_query = """
                     SELECT timestamp, valor
@@ -2927,38 +4331,26 @@ async def read_trend_series(
                     for row in rows
                 ]
             else:
-                data_query = """
-                    SELECT to_timestamp(floor(extract(epoch FROM timestamp)/$5)*$5) AS bucket,
-                           AVG(valor) AS value
-                    FROM trends
-                    WHERE empresa_id = $1
-                      AND tag = $2
-                      {planta_filter}
-                      AND timestamp BETWEEN $3 AND $4
-                    GROUP BY bucket
-                    ORDER BY bucket ASC
-                    LIMIT $6
-                """.format(
-                    planta_filter="AND planta_id = ANY($7)" if selected_plants is not None else ""
-                )
-                params = [
-                    company_id,
-                    normalized_tag,
-                    start_dt,
-                    end_dt,
-                    interval_seconds,
-                    fetch_limit,
-                ]
-                if selected_plants is not None:
-                    params.append(selected_plants)
-                rows = await conn.fetch(
-                    data_query,
-                    *params,
+                bucket_rows = await trend_service.fetch_bucket_rows(
+                    conn,
+                    empresa_id=company_id,
+                    plantas=selected_plants,
+                    tag=normalized_tag,
+                    start=start_dt,
+                    end=end_dt,
+                    interval_seconds=interval_seconds,
+                    aggregates=aggregates,
+                    limit=fetch_limit,
                 )
+                primary = aggregates[0]
                 points = [
-                    {"timestamp": isoformat_utc(row["bucket"]), "value": float(row["value"])}  # type: ignore[arg-type]
-                    for row in rows
+                    {"timestamp": isoformat_utc(bucket), "value": values[primary]}  # type: ignore[arg-type]
+                    for bucket, values in bucket_rows
                 ]
+                columns = {
+                    "timestamps": [point["timestamp"] for point in points],
+                    "aggregates": trend_service.bucket_columns(bucket_rows, aggregates),
+                }
 
             total_points += len(points)
             stats = {
@@ -2969,26 +4361,23 @@ async def read_trend_series(
                 "latestTimestamp": isoformat_utc(stats_row["latest_timestamp"]),
                 "count": int(stats_row["count"]),
             }
-            series_collection.append(
-                {
-                    "tag": normalized_tag,
-                    "points": points,
-                    "stats": stats,
-                    "count": len(points),
-                }
-            )
-
-    meta = {
-        "tags": normalized_tags,
-        "empresaId": company_id,
-        "resolution": resolution_key,
-        "from": isoformat_utc(start_dt),
-        "to": isoformat_utc(end_dt),
-        "limit": fetch_limit,
-        "datasetSize": sum(entry["count"] for entry in series_collection),
-        "totalPoints": total_points,
-        "requested": len(normalized_tags),
-    }
+            entry = {
+                "tag": normalized_tag,
+                "points": points,
+                "stats": stats,
+                "count": len(points),
+            }
+            if columns is not None:
+                entry.update(columns)
+            series_collection.append(entry)
+
+    meta.update(
+        {
+            "datasetSize": sum(entry["count"] for entry in series_collection),
+            "totalPoints": total_points,
+            "source": "database",
+        }
+    )
     return {"series": series_collection, "meta": meta}
 
 
@@ -2997,15 +4386,41 @@ async def read_trend_series(
 def root():
     return {"service": "mqtt-web-bridge", "health": "ok"}
 
+def cluster_stats() -> Optional[Dict[str, Any]]:
+    if leader_lease is None:
+        return None
+    return {
+        "worker": WORKER_ID,
+        "leader": leader_lease.is_leader,
+        "lastValueBus": dict(last_value_bus.stats) if last_value_bus is not None else None,
+    }
+
+
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "lastValues": last_message_store.stats(),
+        "mqtt": mqtt_counters.snapshot(),
+        "mqttSubscriptions": broker_manager.subscription_stats(),
+        "mqttConnections": broker_manager.connection_stats(),
+        "mqttCommandsInFlight": broker_manager.command_stats(),
+        "replay": replay_buffer.stats(),
+        "history": history_store.stats(),
+        "cluster": cluster_stats(),
+    }
 
 class PublishIn(BaseModel):
     topic: str
     payload: Any
-    qos: int = 0
+    qos: Literal[0, 1, 2] = 0
     retain: bool = False
+    timeout: Optional[float] = None  # segundos hasta la confirmacion del broker
+
+
+class PublishBatchIn(BaseModel):
+    commands: List[PublishIn]
+    timeout: Optional[float] = None
 
 
 class TenantBase(BaseModel):
@@ -3311,35 +4726,174 @@ def reset_user_password(uid: str, payload: UserResetRequest, authorization: Opti
     return {"resetLink": reset_link, "emailSent": email_sent, "empresaId": company_id}
 
 
-@app.post("/publish")
-def publish(p: PublishIn, authorization: Optional[str] = Header(None)):
+def resolve_publish_scope(authorization: Optional[str]) -> Tuple[str, List[str]]:
+    """Valida el token y retorna (broker, prefijos publicables) del usuario."""
     decoded = verify_bearer_token(authorization)
     uid = decoded["uid"]
     company_id = extract_company_id(decoded)
     broker_key = broker_key_for_company(company_id)
     cfg = load_scada_config(company_id)
     prefixes = allowed_prefixes_for_user(uid, company_id, decoded=decoded, cfg=cfg)
-    normalized_prefixes = [x.rstrip("/") + "/" for x in prefixes]
-    if not normalized_prefixes:
+    if not prefixes:
         raise HTTPException(status_code=403, detail="Usuario sin plantas asignadas")
-    if not any(p.topic.startswith(pref) for pref in normalized_prefixes):
-        raise HTTPException(status_code=403, detail=f"Topic not allowed for user {uid} en empresa {company_id}")
-    ensure_mqtt_connected(broker_key)
-    payload = p.payload
-    if isinstance(payload, (dict, list)):
-        payload = json.dumps(payload, separators=(",", ":"))
-    elif not isinstance(payload, str):
-        payload = str(payload)
-    resolved_key, res = broker_manager.publish(broker_key, p.topic, payload=payload, qos=p.qos, retain=p.retain)
-    if res.rc != mqtt.MQTT_ERR_SUCCESS:
-        raise HTTPException(status_code=500, detail=f"MQTT publish error rc={res.rc}")
-    return {"ok": True, "broker": resolved_key}
+    return broker_key, prefixes
+
+
+def mqtt_payload(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(",", ":"))
+    if not isinstance(value, str):
+        return str(value)
+    return value
+
+
+def command_timeout(value: Any) -> float:
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return float(MQTT_COMMAND_TIMEOUT_SECONDS)
+    if not math.isfinite(seconds) or seconds <= 0:
+        return float(MQTT_COMMAND_TIMEOUT_SECONDS)
+    return min(seconds, MQTT_COMMAND_TIMEOUT_MAX_SECONDS)
+
+
+def topic_publishable(topic: str, prefixes: List[str]) -> bool:
+    return any(topic.startswith(pref.rstrip("/") + "/") for pref in prefixes)
+
+
+@app.post("/publish")
+async def publish(p: PublishIn, authorization: Optional[str] = Header(None)):
+    # Token y configuracion pueden tocar red/disco: fuera del event loop
+    broker_key, prefixes = await asyncio.to_thread(resolve_publish_scope, authorization)
+    if not topic_publishable(p.topic, prefixes):
+        raise HTTPException(status_code=403, detail=f"Topic not allowed: {p.topic}")
+    resolved_key, mid = await broker_manager.publish_command(
+        broker_key, p.topic, mqtt_payload(p.payload), p.qos, p.retain, command_timeout(p.timeout)
+    )
+    return {"ok": True, "broker": resolved_key, "mid": mid}
+
+
+@app.post("/publish/batch")
+async def publish_batch(batch: PublishBatchIn, authorization: Optional[str] = Header(None)):
+    if not batch.commands:
+        raise HTTPException(status_code=400, detail="commands no puede estar vacio")
+    if len(batch.commands) > MQTT_MAX_BATCH_COMMANDS:
+        raise HTTPException(status_code=400, detail=f"Maximo {MQTT_MAX_BATCH_COMMANDS} comandos por lote")
+    broker_key, prefixes = await asyncio.to_thread(resolve_publish_scope, authorization)
+    denied = [item.topic for item in batch.commands if not topic_publishable(item.topic, prefixes)]
+    if denied:
+        raise HTTPException(status_code=403, detail=f"Topic not allowed: {', '.join(denied[:5])}")
+    commands = [(item.topic, mqtt_payload(item.payload), item.qos, item.retain) for item in batch.commands]
+    resolved_key, results = await broker_manager.publish_commands(broker_key, commands, command_timeout(batch.timeout))
+    return {"ok": all(item["ok"] for item in results), "broker": resolved_key, "results": results}
+
+def command_reply(data: Dict[str, Any], reply: Dict[str, Any]) -> Dict[str, Any]:
+    # El id opcional del cliente permite correlacionar respuestas que llegan fuera de orden
+    if data.get("id") is not None:
+        reply["id"] = data.get("id")
+    return reply
+
+
+async def handle_ws_publish(client: WSClient, data: Dict[str, Any], prefixes: List[str]) -> None:
+    timeout = command_timeout(data.get("timeout"))
+    is_batch = data.get("type") == "publish_batch"
+    if is_batch:
+        raw_commands = data.get("commands")
+        if not isinstance(raw_commands, list) or not raw_commands:
+            await client.send(command_reply(data, {"type": "error", "error": "commands debe ser una lista"}))
+            return
+        if len(raw_commands) > MQTT_MAX_BATCH_COMMANDS:
+            await client.send(command_reply(data, {"type": "error", "error": f"Maximo {MQTT_MAX_BATCH_COMMANDS} comandos por lote"}))
+            return
+    else:
+        raw_commands = [data]
+    commands: List[Tuple[str, Any, int, bool]] = []
+    for item in raw_commands:
+        if not isinstance(item, dict):
+            await client.send(command_reply(data, {"type": "error", "error": "Comando invalido"}))
+            return
+        topic = item.get("topic", "")
+        if not isinstance(topic, str) or not topic_publishable(topic, prefixes):
+            await client.send(command_reply(data, {"type": "error", "error": "Topic not allowed", "topic": topic}))
+            return
+        try:
+            qos = int(item.get("qos", 0))
+        except (TypeError, ValueError):
+            qos = -1
+        if qos not in (0, 1, 2):
+            await client.send(command_reply(data, {"type": "error", "error": "QoS invalido", "topic": topic}))
+            return
+        commands.append((topic, mqtt_payload(item.get("payload")), qos, bool(item.get("retain", False))))
+    try:
+        if is_batch:
+            resolved_key, results = await broker_manager.publish_commands(client.broker_key, commands, timeout)
+            await client.send(command_reply(data, {"type": "batch_ack", "broker": resolved_key, "results": results}))
+            return
+        topic, payload, qos, retain = commands[0]
+        resolved_key, mid = await broker_manager.publish_command(client.broker_key, topic, payload, qos, retain, timeout)
+    except HTTPException as exc:
+        reply: Dict[str, Any] = {"type": "error", "error": exc.detail}
+        if not is_batch:
+            reply["topic"] = commands[0][0]
+        await client.send(command_reply(data, reply))
+        return
+    await client.send(command_reply(data, {"type": "ack", "topic": topic, "broker": resolved_key, "mid": mid}))
+
+
+async def handle_ws_subscription(client: WSClient, data: Dict[str, Any]) -> None:
+    raw_topics = data.get("topics")
+    if raw_topics is None and data.get("topic") is not None:
+        raw_topics = [data.get("topic")]
+    if not isinstance(raw_topics, list):
+        await client.send({"type": "error", "error": "topics debe ser una lista"})
+        return
+    accepted: List[str] = []
+    rejected: List[str] = []
+    for raw in raw_topics:
+        try:
+            candidate = normalize_topic_filter(raw)
+        except ValueError:
+            rejected.append(str(raw))
+            continue
+        if topic_within_prefixes(candidate, client.allowed_prefixes):
+            accepted.append(candidate)
+        else:
+            rejected.append(candidate)
+    if data.get("type") == "unsubscribe":
+        ConnectionManager.unsubscribe(client, accepted)
+        await client.send({"type": "unsubscribed", "topics": accepted, "subscriptions": sorted(client.subscriptions)})
+        return
+    replace = bool(data.get("replace", False))
+    resulting = len(set(accepted) | (set() if replace else client.subscriptions))
+    if resulting > WS_MAX_SUBSCRIPTIONS:
+        await client.send({"type": "error", "error": f"Maximo {WS_MAX_SUBSCRIPTIONS} suscripciones por conexion"})
+        return
+    added = ConnectionManager.subscribe(client, accepted, replace=replace)
+    response: Dict[str, Any] = {
+        "type": "subscribed",
+        "topics": accepted,
+        "subscriptions": sorted(client.subscriptions),
+        "last_values": snapshot_for_prefixes(added, client.broker_key) if added else [],
+    }
+    if rejected:
+        response["rejected"] = rejected
+    await client.send(response)
+
 
 @app.websocket("/ws")
-async def ws_endpoint(websocket: WebSocket, token: Optional[str] = Query(default=None)):
-    await websocket.accept()
+async def ws_endpoint(
+    websocket: WebSocket,
+    token: Optional[str] = Query(default=None),
+    conflate: Optional[int] = Query(default=None),
+    protocol: Optional[str] = Query(default=None),
+    resume_from: Optional[int] = Query(default=None),
+    epoch: Optional[str] = Query(default=None),
+    history: Optional[int] = Query(default=None),
+):
+    ws_protocol, subprotocol = ws_codec.negotiate_protocol(protocol, websocket.scope.get("subprotocols") or [])
+    await websocket.accept(subprotocol=subprotocol)
     origin = websocket.headers.get("origin")
-    logger.info("WS accepted origin=%s", origin)
+    logger.info("WS accepted origin=%s protocol=%s", origin, ws_protocol)
 
     if not token:
         await websocket.close(code=4401)
@@ -3362,7 +4916,7 @@ async def ws_endpoint(websocket: WebSocket, token: Optional[str] = Query(default
         await websocket.close(code=4403)
         return
     try:
-        ensure_mqtt_connected(broker_key)
+        await ensure_mqtt_connected_async(broker_key)
     except HTTPException as exc:
         await websocket.send_json({"type": "error", "error": exc.detail or "MQTT broker not connected"})
         await websocket.close(code=1013)
@@ -3381,58 +4935,94 @@ async def ws_endpoint(websocket: WebSocket, token: Optional[str] = Query(default
     else:
         logger.warning("Pool de base de datos no disponible; omitiendo control de sesiones para WS de %s", uid)
 
-    client = WSClient(websocket, uid, company_id, prefixes, broker_key)
-    ConnectionManager.add(client)
+    client = WSClient(
+        websocket,
+        uid,
+        company_id,
+        prefixes,
+        broker_key,
+        conflate_seconds=resolve_conflate_seconds(conflate),
+        protocol=ws_protocol,
+    )
+    client.subscriptions = set(default_subscriptions_for_config(cfg, company_id, prefixes))
+    client.start()
+
+    if last_value_bus is not None:
+        # Prefijos que este worker aun no recibe: otros workers pueden tener sus ultimos valores
+        missing = [prefix for prefix in client.allowed_prefixes if not broker_manager.covers(broker_key, prefix)]
+        if missing:
+            await last_value_bus.warm(broker_key, missing)
 
-    initial_snapshot = snapshot_for_prefixes(prefixes, broker_key)
-    await websocket.send_json({
+    # Registro, snapshot y hello sin await intermedio: ningun mensaje cae entre el snapshot
+    # y el alta del cliente, y los mensajes en vivo se encolan despues del hello
+    ConnectionManager.add(client)
+    current_seq = message_sequences.get(broker_key)
+    replay = None
+    # Sin epoch no hay forma de saber si la secuencia es de este proceso: snapshot completo
+    if resume_from is not None and epoch == WS_STREAM_EPOCH and 0 <= resume_from <= current_seq:
+        replay = replay_buffer.since(resume_from, sorted(client.subscriptions), broker_key)
+    hello: Dict[str, Any] = {
         "type": "hello",
         "uid": uid,
         "empresaId": company_id,
         "allowed_prefixes": prefixes,
+        "subscriptions": sorted(client.subscriptions),
         "broker": broker_key,
-        "last_values": initial_snapshot
-    })
+        "conflateMs": int(client.conflate_seconds * 1000),
+        "protocol": client.protocol,
+        "staleAfterSeconds": LAST_VALUE_STALE_SECONDS,
+        "epoch": WS_STREAM_EPOCH,
+        "seq": current_seq,
+        "resumed": replay is not None,
+    }
+    if replay is not None:
+        hello["last_values"] = []
+        hello["replay"] = replay
+    else:
+        hello["last_values"] = snapshot_for_prefixes(sorted(client.subscriptions), broker_key)
+    if history and history > 0:
+        # Minutos de historia reciente por topic, para sparklines sin consultar tendencias
+        hello["history"] = history_store.recent(sorted(client.subscriptions), broker_key, history * 60)
+    client.enqueue(ws_codec.encode(hello, client.protocol))
+    pending_commands: Set[asyncio.Task] = set()
 
     try:
         while True:
-            data = await websocket.receive_json()
-            if session_pool is not None and session_claimed:
-                await touch_session(session_pool, session_id)
+            message = await websocket.receive()
+            if message.get("type") == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            try:
+                data = ws_codec.decode(message)
+            except ValueError:
+                await client.send({"type": "error", "error": "Mensaje invalido"})
+                continue
+            if session_claimed:
+                touch_session(session_id)
             if not isinstance(data, dict):
                 continue
-            if data.get("type") == "publish":
-                topic = data.get("topic", "")
-                payload = data.get("payload")
-                qos = int(data.get("qos", 0))
-                retain = bool(data.get("retain", False))
-
-                if not any(topic.startswith(pref.rstrip('/') + '/') for pref in prefixes):
-                    await websocket.send_json({"type": "error", "error": "Topic not allowed"})
+            if data.get("type") in ("publish", "publish_batch"):
+                # La confirmacion del broker se espera en una tarea aparte: el loop sigue leyendo
+                if len(pending_commands) >= MQTT_MAX_INFLIGHT_COMMANDS:
+                    await client.send(command_reply(data, {"type": "error", "error": "Demasiados comandos en curso"}))
                     continue
-
-                ensure_mqtt_connected(client.broker_key)
-                pub_payload = payload
-                if isinstance(pub_payload, (dict, list)):
-                    pub_payload = json.dumps(pub_payload, separators=(",", ":"))
-                elif not isinstance(pub_payload, str):
-                    pub_payload = str(pub_payload)
-
-                resolved_key, res = broker_manager.publish(client.broker_key, topic, payload=pub_payload, qos=qos, retain=retain)
-                if res.rc != mqtt.MQTT_ERR_SUCCESS:
-                    await websocket.send_json({"type": "error", "error": f"MQTT publish rc={res.rc}"})
-                else:
-                    await websocket.send_json({"type": "ack", "topic": topic, "broker": resolved_key})
+                task = asyncio.create_task(handle_ws_publish(client, data, prefixes))
+                pending_commands.add(task)
+                task.add_done_callback(pending_commands.discard)
+            elif data.get("type") in ("subscribe", "unsubscribe"):
+                await handle_ws_subscription(client, data)
             else:
-                await websocket.send_json({"type": "error", "error": "Unknown message type"})
+                await client.send({"type": "error", "error": "Unknown message type"})
     except WebSocketDisconnect:
         pass
     except Exception:
         logger.exception("Error en WS para uid=%s empresa=%s", uid, company_id)
     finally:
+        for task in list(pending_commands):
+            task.cancel()
         if session_pool is not None and session_claimed:
             await drop_session(session_pool, session_id)
         ConnectionManager.remove(websocket)
+        await client.stop()
         try:
             await websocket.close()
         except Exception:
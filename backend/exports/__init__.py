@@ -0,0 +1,3 @@
+"""Trabajos asincronos de exportacion de tendencias."""
+
+__all__ = ["runner", "schemas", "service"]
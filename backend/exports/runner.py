@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import AsyncIterator, Callable, List, Optional, Set
+
+import asyncpg
+
+from trends import export as trend_export
+from trends import service as trend_service
+from trends.service import ExportRow
+
+from . import service as export_service
+from .schemas import ExportJobOut
+
+logger = logging.getLogger("bridge.exports")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except (TypeError, ValueError):
+        return default
+
+
+POLL_INTERVAL_SECONDS = max(1, _env_int("EXPORT_JOBS_POLL_SECONDS", 5))
+MAX_CONCURRENT_JOBS = max(1, _env_int("EXPORT_JOBS_MAX_CONCURRENT", 2))
+MAX_RUNNING_PER_COMPANY = max(1, _env_int("EXPORT_JOBS_MAX_PER_COMPANY", 1))
+JOB_TTL_SECONDS = max(60, _env_int("EXPORT_JOBS_TTL_HOURS", 24) * 3600)
+STALE_JOB_SECONDS = max(60, _env_int("EXPORT_JOBS_STALE_SECONDS", 900))
+CLEANUP_INTERVAL_SECONDS = 300
+# Heartbeat de trabajos en curso y barrido de abandonados: bien por debajo del umbral de abandono
+HEARTBEAT_INTERVAL_SECONDS = max(10, STALE_JOB_SECONDS // 3)
+
+_running: Set[int] = set()
+
+
+def job_file_path(storage_dir: Path, job: ExportJobOut) -> Path:
+    return storage_dir / f"{job.empresa_id}_{job.id}.{job.format}.gz"
+
+
+async def execute_job(pool: asyncpg.pool.Pool, job: ExportJobOut, storage_dir: Path, interval_seconds: Optional[int]) -> None:
+    target = job_file_path(storage_dir, job)
+    partial = target.with_name(target.name + ".part")
+    rows_written = 0
+    tags_done = 0
+
+    async def pages() -> AsyncIterator[List[ExportRow]]:
+        nonlocal rows_written, tags_done
+        for index, tag in enumerate(job.tags):
+            async for page in trend_service.iter_export_rows(
+                pool,
+                empresa_id=job.empresa_id,
+                plantas=job.planta_ids,
+                tags=[tag],
+                start=job.window_start,
+                end=job.window_end,
+                interval_seconds=interval_seconds,
+            ):
+                rows_written += len(page)
+                yield page
+                # Cada pagina renueva updated_at ademas del avance
+                if not await export_service.update_progress(pool, job.id, rows_written, tags_done):
+                    raise RuntimeError("La exportacion ya no esta en curso")
+            tags_done = index + 1
+
+    storage_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        with partial.open("wb") as fh:
+            async for chunk in trend_export.stream_export(pages(), job.format, compressed=True):
+                fh.write(chunk)
+        partial.replace(target)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    completed = await export_service.complete_job(
+        pool,
+        job.id,
+        file_path=str(target),
+        file_size_bytes=target.stat().st_size,
+        rows_written=rows_written,
+        tags_done=tags_done,
+        ttl_seconds=JOB_TTL_SECONDS,
+    )
+    if not completed:
+        # Otro proceso lo dio por abandonado mientras se escribia: el archivo no queda referenciado
+        target.unlink(missing_ok=True)
+        logger.warning("Exportacion %s ya no estaba en curso; se descarta el archivo", job.id)
+        return
+    logger.info("Exportacion %s completada empresa=%s filas=%d", job.id, job.empresa_id, rows_written)
+
+
+async def _run_job(
+    pool: asyncpg.pool.Pool,
+    job: ExportJobOut,
+    storage_dir: Path,
+    resolve_interval: Callable[[str], Optional[int]],
+) -> None:
+    try:
+        await execute_job(pool, job, storage_dir, resolve_interval(job.resolution))
+    except asyncio.CancelledError:
+        try:
+            await export_service.fail_job(pool, job.id, "Exportacion cancelada")
+        except Exception:
+            pass
+        raise
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Exportacion %s fallida: %s", job.id, exc)
+        try:
+            await export_service.fail_job(pool, job.id, str(exc) or exc.__class__.__name__)
+        except Exception:
+            pass
+    finally:
+        _running.discard(job.id)
+
+
+async def cleanup_expired(pool: asyncpg.pool.Pool) -> int:
+    paths = await export_service.expire_jobs(pool)
+    for raw_path in paths:
+        try:
+            Path(raw_path).unlink(missing_ok=True)
+        except OSError as exc:
+            logger.warning("No se pudo eliminar exportacion vencida %s: %s", raw_path, exc)
+    return len(paths)
+
+
+async def worker_loop(
+    get_pool_callable: Callable[[], Optional[asyncpg.pool.Pool]],
+    storage_dir: Path,
+    resolve_interval: Callable[[str], Optional[int]],
+) -> None:
+    tasks: Set[asyncio.Task] = set()
+    last_cleanup: Optional[float] = None
+    last_heartbeat: Optional[float] = None
+    try:
+        while True:
+            try:
+                pool = get_pool_callable()
+                if pool is not None:
+                    if last_heartbeat is None or time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL_SECONDS:
+                        last_heartbeat = time.monotonic()
+                        # Primero los propios (una pagina lenta no debe parecer abandono), luego el barrido:
+                        # trabajos que quedaron en running tras una caida liberan el cupo de su empresa
+                        await export_service.touch_jobs(pool, sorted(_running))
+                        failed = await export_service.fail_stale_jobs(pool, STALE_JOB_SECONDS)
+                        if failed:
+                            logger.warning("Exportaciones abandonadas marcadas como fallidas: %d", failed)
+                    if last_cleanup is None or time.monotonic() - last_cleanup >= CLEANUP_INTERVAL_SECONDS:
+                        last_cleanup = time.monotonic()
+                        removed = await cleanup_expired(pool)
+                        if removed:
+                            logger.info("Exportaciones vencidas eliminadas: %d", removed)
+                    while len(_running) < MAX_CONCURRENT_JOBS:
+                        job = await export_service.claim_next_job(pool, MAX_RUNNING_PER_COMPANY)
+                        if job is None:
+                            break
+                        _running.add(job.id)
+                        task = asyncio.create_task(_run_job(pool, job, storage_dir, resolve_interval))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Error en worker de exportaciones: %s", exc)
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
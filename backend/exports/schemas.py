@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+ExportJobStatus = Literal["queued", "running", "success", "failed", "expired"]
+ExportFormat = Literal["csv", "ndjson"]
+
+
+class ExportJobCreate(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    tags: List[str] = Field(..., min_length=1)
+    planta_id: Optional[str] = Field(None, alias="plantaId")
+    window_start: Optional[datetime] = Field(None, alias="from")
+    window_end: Optional[datetime] = Field(None, alias="to")
+    resolution: str = Field(default="raw")
+    format: ExportFormat = Field(default="csv")
+
+    @field_validator("resolution")
+    @classmethod
+    def _normalize_resolution(cls, value: str) -> str:
+        return (value or "raw").strip().lower()
+
+    @field_validator("window_end")
+    @classmethod
+    def _validate_range(cls, end: Optional[datetime], info):
+        start = info.data.get("window_start")
+        if start and end and start >= end:
+            raise ValueError("to debe ser posterior a from")
+        return end
+
+
+class ExportJobOut(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    id: int
+    empresa_id: str = Field(..., alias="empresaId")
+    planta_ids: Optional[List[str]] = Field(None, alias="plantaIds")
+    tags: List[str]
+    resolution: str
+    format: ExportFormat
+    window_start: datetime = Field(..., alias="from")
+    window_end: datetime = Field(..., alias="to")
+    status: ExportJobStatus
+    rows_written: int = Field(0, alias="rowsWritten")
+    tags_done: int = Field(0, alias="tagsDone")
+    file_size_bytes: Optional[int] = Field(None, alias="fileSizeBytes")
+    error: Optional[str] = None
+    requested_by: Optional[str] = Field(None, alias="requestedBy")
+    created_at: datetime = Field(..., alias="createdAt")
+    started_at: Optional[datetime] = Field(None, alias="startedAt")
+    completed_at: Optional[datetime] = Field(None, alias="completedAt")
+    expires_at: Optional[datetime] = Field(None, alias="expiresAt")
@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Sequence
+
+import asyncpg
+from asyncpg.pool import Pool
+
+from .schemas import ExportJobOut
+
+# Espacio de advisory locks para la admision por empresa (dos claves: no choca con el lease de lider)
+COMPANY_LOCK_NAMESPACE = 7301
+# Empresas al limite que claim_next_job salta antes de rendirse en una pasada
+CLAIM_MAX_ATTEMPTS = 5
+
+JOB_COLUMNS = """
+    id,
+    empresa_id,
+    planta_ids,
+    tags,
+    resolution,
+    format,
+    window_start,
+    window_end,
+    status,
+    rows_written,
+    tags_done,
+    file_path,
+    file_size_bytes,
+    error,
+    requested_by,
+    created_at,
+    updated_at,
+    started_at,
+    completed_at,
+    expires_at
+"""
+
+
+def _now_utc() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _record_to_job(record: asyncpg.Record) -> ExportJobOut:
+    data = dict(record)
+    data["tags"] = data.get("tags") or []
+    return ExportJobOut.model_validate(data)
+
+
+def _affected(result: str) -> int:
+    try:
+        return int(result.split(" ")[-1])
+    except Exception:
+        return 0
+
+
+async def _lock_company(conn: asyncpg.Connection, empresa_id: str) -> None:
+    # Se libera al terminar la transaccion; serializa altas y admision de una misma empresa
+    await conn.execute("SELECT pg_advisory_xact_lock($1, hashtext($2))", COMPANY_LOCK_NAMESPACE, empresa_id)
+
+
+async def count_pending(pool: Pool, empresa_id: str) -> int:
+    query = """
+        SELECT COUNT(*)
+        FROM export_jobs
+        WHERE empresa_id = $1
+          AND status IN ('queued', 'running')
+    """
+    return int(await pool.fetchval(query, empresa_id) or 0)
+
+
+async def create_job(
+    pool: Pool,
+    *,
+    empresa_id: str,
+    planta_ids: Optional[Sequence[str]],
+    tags: Sequence[str],
+    resolution: str,
+    export_format: str,
+    window_start: datetime,
+    window_end: datetime,
+    requested_by: Optional[str],
+    max_pending: Optional[int] = None,
+) -> Optional[ExportJobOut]:
+    """Encola un trabajo; retorna None si la empresa ya tiene `max_pending` pendientes."""
+    query = f"""
+        INSERT INTO export_jobs (
+            empresa_id,
+            planta_ids,
+            tags,
+            resolution,
+            format,
+            window_start,
+            window_end,
+            status,
+            requested_by
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, 'queued', $8)
+        RETURNING {JOB_COLUMNS}
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if max_pending is not None:
+                await _lock_company(conn, empresa_id)
+                if await count_pending(conn, empresa_id) >= max_pending:
+                    return None
+            row = await conn.fetchrow(
+                query,
+                empresa_id,
+                list(planta_ids) if planta_ids is not None else None,
+                list(tags),
+                resolution,
+                export_format,
+                window_start,
+                window_end,
+                requested_by,
+            )
+    return _record_to_job(row)
+
+
+async def get_job(pool: Pool, empresa_id: str, job_id: int, requested_by: Optional[str] = None) -> Optional[ExportJobOut]:
+    params: List[object] = [empresa_id, job_id]
+    owner_clause = ""
+    if requested_by is not None:
+        owner_clause = "AND requested_by = $3"
+        params.append(requested_by)
+    query = f"""
+        SELECT {JOB_COLUMNS}
+        FROM export_jobs
+        WHERE empresa_id = $1
+          AND id = $2
+          {owner_clause}
+    """
+    row = await pool.fetchrow(query, *params)
+    if not row:
+        return None
+    return _record_to_job(row)
+
+
+async def get_job_file_path(pool: Pool, job_id: int) -> Optional[str]:
+    return await pool.fetchval("SELECT file_path FROM export_jobs WHERE id = $1", job_id)
+
+
+async def list_jobs(pool: Pool, empresa_id: str, requested_by: Optional[str] = None, limit: int = 20) -> List[ExportJobOut]:
+    params: List[object] = [empresa_id]
+    owner_clause = ""
+    if requested_by is not None:
+        owner_clause = "AND requested_by = $2"
+        params.append(requested_by)
+    params.append(max(1, min(limit, 200)))
+    query = f"""
+        SELECT {JOB_COLUMNS}
+        FROM export_jobs
+        WHERE empresa_id = $1
+          {owner_clause}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ${len(params)}
+    """
+    rows = await pool.fetch(query, *params)
+    return [_record_to_job(row) for row in rows]
+
+
+async def claim_next_job(pool: Pool, max_running_per_company: int) -> Optional[ExportJobOut]:
+    limit = max(1, max_running_per_company)
+    # SKIP LOCKED permite que varios procesos compitan por la cola sin bloquearse;
+    # el conteo de esta consulta solo descarta candidatos, no garantiza el limite
+    candidate_query = """
+        SELECT j.id, j.empresa_id
+        FROM export_jobs j
+        WHERE j.status = 'queued'
+          AND j.empresa_id <> ALL($2::text[])
+          AND (
+              SELECT COUNT(*)
+              FROM export_jobs r
+              WHERE r.empresa_id = j.empresa_id
+                AND r.status = 'running'
+          ) < $1
+        ORDER BY j.created_at ASC, j.id ASC
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    """
+    running_query = """
+        SELECT COUNT(*)
+        FROM export_jobs
+        WHERE empresa_id = $1
+          AND status = 'running'
+    """
+    claim_query = f"""
+        UPDATE export_jobs
+        SET status = 'running',
+            started_at = $2,
+            updated_at = $2
+        WHERE id = $1
+        RETURNING {JOB_COLUMNS}
+    """
+    skipped: List[str] = []
+    for _ in range(CLAIM_MAX_ATTEMPTS):
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                candidate = await conn.fetchrow(candidate_query, limit, skipped)
+                if not candidate:
+                    return None
+                empresa_id = candidate["empresa_id"]
+                # Con el lock de la empresa se vuelve a contar: ve lo que otro proceso admitio y confirmo
+                await _lock_company(conn, empresa_id)
+                if int(await conn.fetchval(running_query, empresa_id) or 0) >= limit:
+                    skipped.append(empresa_id)
+                    continue
+                row = await conn.fetchrow(claim_query, candidate["id"], _now_utc())
+        return _record_to_job(row)
+    return None
+
+
+async def update_progress(pool: Pool, job_id: int, rows_written: int, tags_done: int) -> bool:
+    """Registra el avance; retorna False si el trabajo ya no esta en curso (p. ej. marcado abandonado)."""
+    result = await pool.execute(
+        """
+        UPDATE export_jobs
+        SET rows_written = $1,
+            tags_done = $2,
+            updated_at = $3
+        WHERE id = $4 AND status = 'running'
+        """,
+        rows_written,
+        tags_done,
+        _now_utc(),
+        job_id,
+    )
+    return _affected(result) > 0
+
+
+async def touch_jobs(pool: Pool, job_ids: List[int]) -> None:
+    """Renueva `updated_at` de trabajos en curso para que otro proceso no los tome por abandonados."""
+    if not job_ids:
+        return
+    await pool.execute(
+        """
+        UPDATE export_jobs
+        SET updated_at = $1
+        WHERE id = ANY($2) AND status = 'running'
+        """,
+        _now_utc(),
+        list(job_ids),
+    )
+
+
+async def complete_job(
+    pool: Pool,
+    job_id: int,
+    *,
+    file_path: str,
+    file_size_bytes: int,
+    rows_written: int,
+    tags_done: int,
+    ttl_seconds: int,
+) -> bool:
+    """Marca el trabajo como exitoso; retorna False si ya no estaba en curso."""
+    now = _now_utc()
+    result = await pool.execute(
+        """
+        UPDATE export_jobs
+        SET status = 'success',
+            file_path = $1,
+            file_size_bytes = $2,
+            rows_written = $3,
+            tags_done = $4,
+            completed_at = $5,
+            updated_at = $5,
+            expires_at = $6
+        WHERE id = $7 AND status = 'running'
+        """,
+        file_path,
+        file_size_bytes,
+        rows_written,
+        tags_done,
+        now,
+        now + timedelta(seconds=ttl_seconds),
+        job_id,
+    )
+    return _affected(result) > 0
+
+
+async def fail_job(pool: Pool, job_id: int, error: str) -> None:
+    now = _now_utc()
+    await pool.execute(
+        """
+        UPDATE export_jobs
+        SET status = 'failed',
+            error = $1,
+            completed_at = $2,
+            updated_at = $2
+        WHERE id = $3 AND status = 'running'
+        """,
+        error[:2000],
+        now,
+        job_id,
+    )
+
+
+async def fail_stale_jobs(pool: Pool, stale_seconds: int) -> int:
+    cutoff = _now_utc() - timedelta(seconds=stale_seconds)
+    result = await pool.execute(
+        """
+        UPDATE export_jobs
+        SET status = 'failed',
+            error = 'Exportacion interrumpida',
+            completed_at = $2,
+            updated_at = $2
+        WHERE status = 'running'
+          AND updated_at < $1
+        """,
+        cutoff,
+        _now_utc(),
+    )
+    return _affected(result)
+
+
+async def expire_jobs(pool: Pool) -> List[str]:
+    """Marca como expirados los trabajos vencidos y retorna las rutas a eliminar."""
+    rows = await pool.fetch(
+        """
+        WITH expired AS (
+            SELECT id, file_path
+            FROM export_jobs
+            WHERE status = 'success'
+              AND expires_at IS NOT NULL
+              AND expires_at < $1
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE export_jobs AS j
+        SET status = 'expired',
+            file_path = NULL,
+            updated_at = $1
+        FROM expired
+        WHERE j.id = expired.id
+        RETURNING expired.file_path AS file_path
+        """,
+        _now_utc(),
+    )
+    return [row["file_path"] for row in rows if row["file_path"]]
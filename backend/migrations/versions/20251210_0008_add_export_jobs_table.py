@@ -0,0 +1,56 @@
+"""add export_jobs table for asynchronous trend extracts
+
+Revision ID: 20251210_0008
+Revises: 20251202_0007
+Create Date: 2025-12-10 00:00:00.000000
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "20251210_0008"
+down_revision = "20251202_0007"
+branch_labels: tuple[str, ...] | None = None
+depends_on: tuple[str, ...] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "export_jobs",
+        sa.Column("id", sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column("empresa_id", sa.Text(), nullable=False),
+        sa.Column("planta_ids", postgresql.ARRAY(sa.Text()), nullable=True),
+        sa.Column("tags", postgresql.ARRAY(sa.Text()), nullable=False),
+        sa.Column("resolution", sa.Text(), nullable=False, server_default="raw"),
+        sa.Column("format", sa.Text(), nullable=False, server_default="csv"),
+        sa.Column("window_start", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("window_end", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("status", sa.Text(), nullable=False, server_default="queued"),
+        sa.Column("rows_written", sa.BigInteger(), nullable=False, server_default=sa.text("0")),
+        sa.Column("tags_done", sa.Integer(), nullable=False, server_default=sa.text("0")),
+        sa.Column("file_path", sa.Text(), nullable=True),
+        sa.Column("file_size_bytes", sa.BigInteger(), nullable=True),
+        sa.Column("error", sa.Text(), nullable=True),
+        sa.Column("requested_by", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column("started_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("completed_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=True),
+        sa.CheckConstraint(
+            "status IN ('queued', 'running', 'success', 'failed', 'expired')", name="ck_export_jobs_status"
+        ),
+        sa.CheckConstraint("format IN ('csv', 'ndjson')", name="ck_export_jobs_format"),
+    )
+    op.create_index("ix_export_jobs_status_created", "export_jobs", ["status", "created_at"])
+    op.create_index("ix_export_jobs_empresa_status", "export_jobs", ["empresa_id", "status"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_export_jobs_empresa_status", table_name="export_jobs")
+    op.drop_index("ix_export_jobs_status_created", table_name="export_jobs")
+    op.drop_table("export_jobs")
@@ -0,0 +1,40 @@
+"""add active_sessions_counts table for ws session admission
+
+Revision ID: 20251215_0009
+Revises: 20251210_0008
+Create Date: 2025-12-15 00:00:00.000000
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = "20251215_0009"
+down_revision = "20251210_0008"
+branch_labels: tuple[str, ...] | None = None
+depends_on: tuple[str, ...] | None = None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "active_sessions_counts" not in set(inspector.get_table_names()):
+        op.create_table(
+            "active_sessions_counts",
+            sa.Column("empresa_id", sa.Text(), primary_key=True, nullable=False),
+            sa.Column("active", sa.Integer(), nullable=False, server_default="0"),
+        )
+    # Contadores iniciales a partir de las sesiones ya registradas
+    op.execute(
+        """
+        INSERT INTO active_sessions_counts (empresa_id, active)
+        SELECT empresa_id, COUNT(*) FROM active_sessions GROUP BY empresa_id
+        ON CONFLICT (empresa_id) DO NOTHING
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("active_sessions_counts")
@@ -0,0 +1,3 @@
+"""Enrutamiento en tiempo real de mensajes MQTT hacia clientes WebSocket."""
+
+__all__ = ["cluster", "codec", "commands", "history", "last_values", "mqtt_loop", "replay", "stats", "topic_index"]
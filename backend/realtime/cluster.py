@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import logging
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+from .last_values import LastValueCache
+
+logger = logging.getLogger("bridge.cluster")
+
+# Limite de NOTIFY en Postgres: 8000 bytes por payload
+NOTIFY_MAX_BYTES = 7800
+# Toda consulta de estas conexiones tiene tope: en una conexion TCP semiabierta nunca retornaria
+QUERY_TIMEOUT_SECONDS = 5.0
+
+TaskFactory = Callable[[], Awaitable[Any]]
+CoverageCheck = Callable[[Optional[str], str], bool]
+
+
+class LeaderLease:
+    """Elige un proceso lider con `pg_try_advisory_lock` sobre una conexion dedicada.
+
+    El lock vive mientras viva la conexion: si el lider muere o pierde la base,
+    Postgres lo libera y otro worker lo toma en el siguiente intento. Solo el
+    lider corre las tareas registradas con `register`.
+    """
+
+    def __init__(self, dsn: str, lock_key: int, check_seconds: float) -> None:
+        self.dsn = dsn
+        self.lock_key = lock_key
+        self.check_seconds = max(1.0, check_seconds)
+        self.is_leader = False
+        self._factories: List[Tuple[str, TaskFactory]] = []
+        self._tasks: List[asyncio.Task] = []
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        # Un lider que no confirma su sesion a tiempo suelta las tareas antes de que otro tome el lock
+        self._query_timeout = min(QUERY_TIMEOUT_SECONDS, self.check_seconds)
+
+    def register(self, name: str, factory: TaskFactory) -> None:
+        self._factories.append((name, factory))
+        if self.is_leader:
+            self._tasks.append(asyncio.create_task(factory(), name=name))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task = self._task
+        self._task = None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._release()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if self.is_leader:
+                    # Si la conexion se cerro o falla, el lock ya no es nuestro
+                    if self._conn is None or self._conn.is_closed():
+                        raise ConnectionError("conexion del lease cerrada")
+                    await self._conn.fetchval("SELECT 1", timeout=self._query_timeout)
+                else:
+                    if self._conn is None or self._conn.is_closed():
+                        self._conn = await asyncpg.connect(self.dsn, timeout=10)
+                    if await self._conn.fetchval(
+                        "SELECT pg_try_advisory_lock($1)", self.lock_key, timeout=self._query_timeout
+                    ):
+                        self._lead()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Lease de lider perdido o no disponible: %s", str(exc) or exc.__class__.__name__)
+                await self._release()
+            await asyncio.sleep(self.check_seconds)
+
+    def _lead(self) -> None:
+        self.is_leader = True
+        logger.info("Worker elegido lider; tareas unicas: %s", [name for name, _ in self._factories])
+        self._tasks = [asyncio.create_task(factory(), name=name) for name, factory in self._factories]
+
+    async def _release(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as exc:
+                logger.debug("Error al detener tarea unica %s: %s", task.get_name(), exc)
+        if self.is_leader:
+            logger.info("Worker deja de ser lider")
+        self.is_leader = False
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            # Cerrar la conexion libera el advisory lock
+            try:
+                await conn.close(timeout=2)
+            except Exception:
+                conn.terminate()
+
+
+class LastValueBus:
+    """Comparte ultimos valores entre workers del mismo despliegue via LISTEN/NOTIFY.
+
+    Un worker que aun no esta suscrito a un prefijo pide sus ultimos valores
+    (`want`); los workers suscritos a todos esos prefijos responden en bloques
+    (`values`) que caben en un NOTIFY, el ultimo marcado con `last`. Los valores
+    restaurados no pisan mensajes MQTT mas nuevos. La conexion LISTEN se verifica
+    cada `check_seconds` y se reabre si se perdio.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        channel: str,
+        worker_id: str,
+        cache: LastValueCache,
+        covers: CoverageCheck,
+        timeout_seconds: float,
+        check_seconds: float = 10,
+    ) -> None:
+        self.dsn = dsn
+        self.channel = channel
+        self.worker_id = worker_id
+        self.cache = cache
+        self.covers = covers
+        self.timeout_seconds = timeout_seconds
+        self.check_seconds = max(1.0, check_seconds)
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+        self._waiters: Dict[str, asyncio.Event] = {}
+        self._received: Dict[str, int] = {}
+        self._answers: Set[asyncio.Task] = set()
+        self.stats: Dict[str, int] = {"requests": 0, "answered": 0, "received": 0, "timeouts": 0}
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None and not self._conn.is_closed()
+
+    async def start(self) -> None:
+        try:
+            await self._connect()
+        except Exception as exc:
+            await self._close()
+            logger.error("No se pudo escuchar %s; se reintentara: %s", self.channel, exc)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        task = self._task
+        self._task = None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        for task in list(self._answers):
+            task.cancel()
+        await self._close()
+
+    async def _connect(self) -> None:
+        conn = await asyncpg.connect(self.dsn, timeout=10)
+        self._conn = conn
+        await conn.add_listener(self.channel, self._on_notify)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_seconds)
+            try:
+                if self.connected:
+                    async with self._send_lock:
+                        await self._conn.fetchval("SELECT 1", timeout=QUERY_TIMEOUT_SECONDS)
+                else:
+                    await self._connect()
+                    logger.info("Escucha de %s restablecida", self.channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Mientras tanto warm no espera respuestas y este worker no responde pedidos
+                logger.warning("Conexion LISTEN de %s perdida o no disponible: %s", self.channel, str(exc) or exc.__class__.__name__)
+                await self._close()
+
+    async def _close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            try:
+                await conn.close(timeout=2)
+            except Exception:
+                conn.terminate()
+
+    async def _notify(self, message: Dict[str, Any]) -> None:
+        payload = json.dumps(message, separators=(",", ":"))
+        async with self._send_lock:
+            if self.connected:
+                await self._conn.execute(
+                    "SELECT pg_notify($1, $2)", self.channel, payload, timeout=QUERY_TIMEOUT_SECONDS
+                )
+
+    async def warm(self, broker_key: Optional[str], prefixes: List[str]) -> int:
+        """Pide a los otros workers los ultimos valores de `prefixes`; espera como maximo el timeout."""
+        if not prefixes or not self.connected or self.timeout_seconds <= 0:
+            return 0
+        request_id = uuid.uuid4().hex
+        done = asyncio.Event()
+        self._waiters[request_id] = done
+        self._received[request_id] = 0
+        self.stats["requests"] += 1
+        message = {"op": "want", "id": request_id, "from": self.worker_id, "broker": broker_key, "prefixes": prefixes}
+
+        async def ask() -> None:
+            await self._notify(message)
+            await done.wait()
+
+        try:
+            # El tope cubre tambien el envio: _send_lock puede estar tomado por una verificacion lenta
+            await asyncio.wait_for(ask(), timeout=self.timeout_seconds)
+        except asyncio.TimeoutError:
+            # Ningun worker tiene esos prefijos (o tardo demasiado): se sigue con lo retenido del broker
+            self.stats["timeouts"] += 1
+        except Exception as exc:
+            logger.warning("No se pudo pedir ultimos valores a otros workers: %s", exc)
+        finally:
+            self._waiters.pop(request_id, None)
+        return self._received.pop(request_id, 0)
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("from") == self.worker_id:
+            return
+        op = message.get("op")
+        if op == "want":
+            task = asyncio.create_task(self._answer(message))
+            self._answers.add(task)
+            task.add_done_callback(self._answers.discard)
+        elif op == "values" and message.get("to") == self.worker_id:
+            self._apply(message)
+
+    def _apply(self, message: Dict[str, Any]) -> None:
+        request_id = message.get("id")
+        broker_key = message.get("broker")
+        restored = 0
+        for topic, raw, qos, retain, updated_at in message.get("entries") or []:
+            if self.cache.put(topic, base64.b64decode(raw), qos, retain, broker_key, updated_at=updated_at):
+                restored += 1
+        self.stats["received"] += restored
+        if request_id in self._received:
+            self._received[request_id] += restored
+        if message.get("last"):
+            done = self._waiters.get(request_id)
+            if done is not None:
+                done.set()
+
+    async def _answer(self, request: Dict[str, Any]) -> None:
+        broker_key = request.get("broker")
+        prefixes = request.get("prefixes") or []
+        # Solo responde quien recibe esos prefijos: su cache esta completa y al dia
+        if not prefixes or not all(self.covers(broker_key, prefix) for prefix in prefixes):
+            return
+        entries = self.cache.entries(prefixes, broker_key)
+        header = {
+            "op": "values",
+            "id": request.get("id"),
+            "from": self.worker_id,
+            "to": request.get("from"),
+            "broker": broker_key,
+        }
+        budget = NOTIFY_MAX_BYTES - len(json.dumps(header)) - 32
+        chunk: List[List[Any]] = []
+        size = 0
+        chunks: List[List[List[Any]]] = []
+        for entry in entries:
+            row = [entry.topic, base64.b64encode(entry.raw).decode("ascii"), entry.qos, entry.retain, entry.updated_at]
+            row_size = len(json.dumps(row)) + 1
+            if row_size > budget:
+                # Payloads grandes no caben en un NOTIFY; llegaran con el proximo mensaje MQTT
+                continue
+            if size + row_size > budget and chunk:
+                chunks.append(chunk)
+                chunk, size = [], 0
+            chunk.append(row)
+            size += row_size
+        if chunk or not chunks:
+            chunks.append(chunk)
+        try:
+            for index, rows in enumerate(chunks):
+                await self._notify({**header, "entries": rows, "last": index == len(chunks) - 1})
+            self.stats["answered"] += 1
+        except Exception as exc:
+            logger.warning("No se pudieron enviar ultimos valores a %s: %s", request.get("from"), exc)
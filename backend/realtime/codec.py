@@ -0,0 +1,66 @@
+"""Serializacion de frames WebSocket: JSON como texto o MessagePack como binario."""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import msgpack
+
+PROTOCOL_JSON = "json"
+PROTOCOL_MSGPACK = "msgpack"
+PROTOCOLS = (PROTOCOL_JSON, PROTOCOL_MSGPACK)
+
+WSFrame = Union[str, bytes]
+
+_BATCH_PREFIX_MSGPACK = (
+    msgpack.Packer().pack_map_header(2)
+    + msgpack.packb("type")
+    + msgpack.packb("batch")
+    + msgpack.packb("messages")
+)
+
+
+def negotiate_protocol(requested: Optional[str], offered: Sequence[str]) -> Tuple[str, Optional[str]]:
+    """Elige el protocolo y el subprotocolo a confirmar en el handshake.
+
+    El parametro de query tiene prioridad; si no viene se usa el primer subprotocolo
+    ofrecido que se reconozca. Si el navegador ofrecio subprotocolos hay que
+    confirmar uno de ellos o cancelara la conexion.
+    """
+    offered_known = [item for item in offered if item in PROTOCOLS]
+    protocol = PROTOCOL_JSON
+    if requested:
+        candidate = requested.strip().lower()
+        if candidate in PROTOCOLS:
+            protocol = candidate
+    elif offered_known:
+        protocol = offered_known[0]
+    if protocol in offered:
+        return protocol, protocol
+    return protocol, offered_known[0] if offered_known else None
+
+
+def encode(message: Dict[str, Any], protocol: str = PROTOCOL_JSON) -> WSFrame:
+    if protocol == PROTOCOL_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True, default=str)
+    # Mismo formato que WebSocket.send_json, pero serializado una sola vez por mensaje
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def batch(frames: List[WSFrame], protocol: str = PROTOCOL_JSON) -> WSFrame:
+    """Agrupa frames ya serializados en `{"type":"batch","messages":[...]}` sin re-serializar."""
+    if protocol == PROTOCOL_MSGPACK:
+        return _BATCH_PREFIX_MSGPACK + msgpack.Packer().pack_array_header(len(frames)) + b"".join(frames)
+    return '{"type":"batch","messages":[' + ",".join(frames) + "]}"
+
+
+def decode(message: Dict[str, Any]) -> Any:
+    """Decodifica un mensaje ASGI `websocket.receive` (texto JSON o binario MessagePack)."""
+    raw_bytes = message.get("bytes")
+    if raw_bytes is not None:
+        return msgpack.unpackb(raw_bytes, raw=False)
+    text = message.get("text")
+    if text is None:
+        raise ValueError("Mensaje vacio")
+    return json.loads(text)
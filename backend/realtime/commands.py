@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import paho.mqtt.client as mqtt
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class CommandRejected(Exception):
+    pass
+
+
+class CommandPipeline:
+    """Publicaciones awaitables sobre un cliente paho.
+
+    `publish` termina cuando el broker confirma (PUBACK para QoS 1, PUBCOMP para
+    QoS 2) o cuando el mensaje QoS 0 se escribio en el socket. Un semaforo limita
+    los comandos en vuelo por broker. Todo el estado vive en el event loop; desde
+    el hilo de paho solo se agenda `_resolve`. El propio `on_publish` es la
+    confirmacion: paho puede llamarlo antes de marcar el mensaje como publicado.
+    """
+
+    def __init__(self, client: mqtt.Client, max_in_flight: int) -> None:
+        self.client = client
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self._waiters: Dict[int, Tuple[asyncio.Future, mqtt.MQTTMessageInfo]] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._waiters)
+
+    def on_publish(self, client: mqtt.Client, userdata: Any, mid: int, *args: Any) -> None:
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            loop.call_soon(self._resolve, mid)
+        else:
+            loop.call_soon_threadsafe(self._resolve, mid)
+
+    def _resolve(self, mid: int) -> None:
+        waiter = self._waiters.get(mid)
+        if waiter is None:
+            return
+        future, _ = waiter
+        if not future.done():
+            future.set_result(None)
+
+    async def publish(self, topic: str, payload: Any, qos: int, retain: bool, timeout: float) -> int:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise CommandTimeout("Demasiados comandos en curso para el broker") from None
+        try:
+            try:
+                info = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
+            except ValueError as exc:
+                # Topic con comodines, QoS invalido o payload demasiado grande
+                raise CommandRejected(str(exc)) from None
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise CommandRejected(f"MQTT publish rc={info.rc}")
+            if info.is_published():
+                return info.mid
+            # Sin await entre publish y el registro: cualquier _resolve agendado corre despues
+            future = loop.create_future()
+            self._waiters[info.mid] = (future, info)
+            try:
+                await asyncio.wait_for(future, timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise CommandTimeout("Sin confirmacion del broker") from None
+            finally:
+                current = self._waiters.get(info.mid)
+                if current is not None and current[0] is future:
+                    del self._waiters[info.mid]
+            return info.mid
+        finally:
+            self._slots.release()
+
+    async def publish_many(
+        self,
+        commands: Sequence[Tuple[str, Any, int, bool]],
+        timeout: float,
+    ) -> List[Dict[str, Any]]:
+        """Publica varios comandos en paralelo y retorna un resultado por comando, en orden."""
+
+        async def _one(topic: str, payload: Any, qos: int, retain: bool) -> Dict[str, Any]:
+            try:
+                mid = await self.publish(topic, payload, qos, retain, timeout)
+            except (CommandTimeout, CommandRejected) as exc:
+                return {"topic": topic, "ok": False, "error": str(exc)}
+            return {"topic": topic, "ok": True, "mid": mid}
+
+        return list(await asyncio.gather(*(_one(*command) for command in commands)))
@@ -0,0 +1,431 @@
+from __future__ import annotations
+
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("bridge.realtime")
+
+INITIAL_CAPACITY = 16
+
+TrendKey = Tuple[str, str]  # (empresa, tag)
+Identity = Tuple[str, str, str]  # (empresa, planta, tag) como queda en `trends`
+
+# parse_payload del worker reconoce este prefijo literal, no TOPIC_BASE
+TREND_ROOT = ("scada", "customers")
+_OVERRIDE_FIELDS = ("empresaId", "plantaId", "tag")
+
+
+def normalize_planta(value: Any, default: str) -> str:
+    # Copia exacta de normalize_planta del worker de tendencias (workers/trends_ingest/worker.py)
+    if not value:
+        return default
+    normalized = "".join(ch if ch.isalnum() or ch in {"-", "_"} else "_" for ch in str(value))
+    normalized = normalized.strip("_").lower()
+    return normalized or default
+
+
+def _under(topic: str, prefix: str) -> bool:
+    return not prefix or topic == prefix or topic.startswith(prefix + "/")
+
+
+def _filter_matches(filter_segments: Tuple[str, ...], topic: str) -> bool:
+    """Coincidencia de filtro MQTT (`+`, `#`), como las suscripciones del worker."""
+    parts = topic.split("/")
+    for index, segment in enumerate(filter_segments):
+        if segment == "#":
+            return True
+        if index >= len(parts) or (segment != "+" and segment != parts[index]):
+            return False
+    return len(parts) == len(filter_segments)
+
+
+def _numeric(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "false"):
+            return 1.0 if lowered == "true" else 0.0
+        try:
+            return float(lowered)
+        except ValueError:
+            return None
+    return None
+
+
+class _Ring:
+    """Serie (epoch, valor) en dos arreglos numpy circulares que crecen hasta `max_points`."""
+
+    __slots__ = (
+        "lock", "ts", "values", "start", "size", "max_points", "covered_since", "last_ts", "identity", "from_topic"
+    )
+
+    def __init__(self, max_points: int, covered_since: float, identity: Identity, from_topic: bool) -> None:
+        self.lock = threading.Lock()
+        capacity = min(INITIAL_CAPACITY, max_points)
+        self.ts = np.empty(capacity, dtype=np.float64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.start = 0
+        self.size = 0
+        self.max_points = max_points
+        # Desde cuando la serie esta completa; infinito mientras el topic no llega (pausa)
+        self.covered_since = covered_since
+        self.last_ts = 0.0
+        # Fila de `trends` que recibe estos puntos y si sale solo del topic (sin campos del payload)
+        self.identity = identity
+        self.from_topic = from_topic
+
+    def append(self, ts: float, value: float) -> None:
+        capacity = self.ts.size
+        if self.size == capacity and capacity < self.max_points:
+            ts_arr, values_arr = self._ordered()
+            capacity = min(capacity * 2, self.max_points)
+            self.ts = np.empty(capacity, dtype=np.float64)
+            self.values = np.empty(capacity, dtype=np.float64)
+            self.ts[: self.size] = ts_arr
+            self.values[: self.size] = values_arr
+            self.start = 0
+        if self.size == capacity:
+            # Se descarta el punto insertado primero, que con timestamps desordenados no es
+            # el mas viejo: la serie queda completa solo despues de todo lo descartado
+            dropped = float(self.ts[self.start])
+            self.covered_since = max(self.covered_since, float(np.nextafter(dropped, np.inf)))
+            self.ts[self.start] = ts
+            self.values[self.start] = value
+            self.start = (self.start + 1) % capacity
+        else:
+            index = (self.start + self.size) % capacity
+            self.ts[index] = ts
+            self.values[index] = value
+            self.size += 1
+        self.last_ts = max(self.last_ts, ts)
+
+    def _ordered(self) -> Tuple[np.ndarray, np.ndarray]:
+        end = self.start + self.size
+        capacity = self.ts.size
+        if end <= capacity:
+            return self.ts[self.start:end].copy(), self.values[self.start:end].copy()
+        tail = end - capacity
+        return (
+            np.concatenate((self.ts[self.start:], self.ts[:tail])),
+            np.concatenate((self.values[self.start:], self.values[:tail])),
+        )
+
+    def window(self, start: float, end: float) -> Tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            ts, values = self._ordered()
+        if ts.size > 1 and np.any(ts[1:] < ts[:-1]):
+            # Timestamps del payload pueden llegar desordenados
+            order = np.argsort(ts, kind="stable")
+            ts, values = ts[order], values[order]
+        lo = np.searchsorted(ts, start, side="left")
+        hi = np.searchsorted(ts, end, side="right")
+        return ts[lo:hi], values[lo:hi]
+
+
+class HistoryStore:
+    """Historia reciente de los topics de tendencias, servida desde memoria al WS y a /api/tendencias.
+
+    Solo entran los topics que el worker de tendencias guarda (`topic_filters`, sus
+    `MQTT_TOPICS`), y cada uno se interpreta igual que el worker (empresa, planta y
+    tag desde el topic o el payload, `value`/`timestamp` desde el payload), asi que
+    una ventana dentro del horizonte se puede responder sin consultar `trends`. La
+    cobertura se lleva por filtro suscrito: `resume` al suscribir o reconectar,
+    `pause` al desuscribir o perder la conexion. Cuando la memoria no puede
+    garantizar la misma respuesta que la base (topic rechazado por el limite, dos
+    topics hacia la misma fila, identidad que cambia segun el payload) `series`
+    retorna None.
+    """
+
+    def __init__(
+        self,
+        topic_filters: Sequence[str],
+        horizon_seconds: float,
+        max_points: int,
+        max_topics: int,
+        default_planta: str = "default",
+    ) -> None:
+        self._filters = [tuple(item.strip().split("/")) for item in topic_filters if item.strip()]
+        self.horizon_seconds = horizon_seconds
+        self.max_points = max_points
+        self.max_topics = max_topics
+        self.default_planta = default_planta
+        self._rings: Dict[Tuple[str, str], _Ring] = {}
+        # (empresa, tag) -> planta -> anillos; mas de uno en una planta es ambiguo
+        self._by_tag: Dict[TrendKey, Dict[str, List[_Ring]]] = {}
+        # (empresa, tag) cuya identidad cambio segun el payload -> ultima vez visto
+        self._ambiguous: Dict[TrendKey, float] = {}
+        # (broker, prefijo) suscrito -> desde cuando llegan todos sus mensajes
+        self._resumed_at: Dict[Tuple[str, str], float] = {}
+        # Ultimo topic rechazado por el limite: hasta entonces la memoria puede estar incompleta
+        self._rejected_at = 0.0
+        self._lock = threading.Lock()
+        self._full_logged = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.horizon_seconds > 0 and self.max_points > 0 and bool(self._filters)
+
+    def stored(self, topic: str) -> bool:
+        """True si el worker de tendencias guarda el topic."""
+        return any(_filter_matches(item, topic) for item in self._filters)
+
+    def _topic_identity(self, topic: str) -> Optional[Identity]:
+        # Mismo recorrido que parse_payload del worker; topics fuera de la raiz no se guardan aqui
+        parts = topic.split("/")
+        if len(parts) < 4 or (parts[0], parts[1]) != TREND_ROOT or not parts[2]:
+            return None
+        empresa = parts[2]
+        if len(parts) >= 5:
+            planta = normalize_planta(parts[3] or self.default_planta, self.default_planta)
+            tag_parts = parts[5:] if len(parts) >= 6 and parts[4] == "trend" else parts[4:]
+        else:
+            planta = self.default_planta
+            tag_parts = parts[3:]
+        return empresa, planta, "/".join(tag_parts) or topic
+
+    def _identity(self, base: Identity, payload: Any) -> Identity:
+        empresa, planta, tag = base
+        if isinstance(payload, dict):
+            if payload.get("empresaId"):
+                empresa = str(payload["empresaId"])
+            if payload.get("plantaId"):
+                planta = normalize_planta(payload["plantaId"], self.default_planta)
+            if payload.get("tag"):
+                tag = str(payload["tag"])
+        return empresa, planta, tag
+
+    def record(
+        self,
+        topic: str,
+        raw: bytes,
+        broker_key: Optional[str],
+        retain: bool = False,
+        now: Optional[float] = None,
+    ) -> bool:
+        # Un retenido es un valor viejo reenviado al suscribir o reconectar, no una muestra nueva
+        if not self.enabled or not raw or retain:
+            return False
+        key = (broker_key or "", topic)
+        ring = self._rings.get(key)
+        # Solo se decodifican los topics que el worker guarda
+        if ring is None and not self.stored(topic):
+            return False
+        try:
+            payload: Any = json.loads(raw)
+        except (ValueError, UnicodeDecodeError):
+            try:
+                payload = raw.decode("utf-8").strip()
+            except UnicodeDecodeError:
+                return False
+        ts = now if now is not None else time.time()
+        if isinstance(payload, dict):
+            value = _numeric(payload.get("value"))
+            stamp = payload.get("timestamp")
+            if stamp:
+                try:
+                    ts = datetime.fromisoformat(str(stamp).replace("Z", "+00:00")).timestamp()
+                except ValueError:
+                    pass
+        else:
+            value = _numeric(payload)
+        if value is None:
+            return False
+        overridden = isinstance(payload, dict) and any(payload.get(field) for field in _OVERRIDE_FIELDS)
+        if ring is None:
+            base = self._topic_identity(topic)
+            if base is None:
+                return False
+            ring = self._create(key, self._identity(base, payload), not overridden)
+            if ring is None:
+                return False
+        elif overridden or not ring.from_topic:
+            base = self._topic_identity(topic)
+            identity = self._identity(base, payload) if base is not None else None
+            if identity != ring.identity:
+                # La fila de `trends` depende del payload: este tag no se responde desde memoria
+                self._mark_ambiguous(ring.identity, identity, ts)
+                return False
+        with ring.lock:
+            ring.append(ts, value)
+        return True
+
+    def _mark_ambiguous(self, current: Identity, other: Optional[Identity], when: float) -> None:
+        with self._lock:
+            for identity in (current, other):
+                if identity is not None:
+                    self._ambiguous[(identity[0], identity[2])] = max(when, time.time())
+
+    def _create(self, key: Tuple[str, str], identity: Identity, from_topic: bool) -> Optional[_Ring]:
+        empresa, planta, tag = identity
+        broker, topic = key
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is not None:
+                return ring
+            if self.max_topics > 0 and len(self._rings) >= self.max_topics:
+                self._rejected_at = time.time()
+                if not self._full_logged:
+                    logger.warning("Historia reciente llena: %d topics; se ignoran topics nuevos", self.max_topics)
+                    self._full_logged = True
+                return None
+            # Un topic nuevo no tuvo mensajes antes: esta completo desde que su filtro esta suscrito,
+            # salvo que haya sido rechazado por el limite (entonces desde el ultimo rechazo)
+            covered = [
+                since for (filter_broker, prefix), since in self._resumed_at.items()
+                if filter_broker == broker and _under(topic, prefix)
+            ]
+            covered_since = max(max(covered) if covered else time.time(), self._rejected_at)
+            ring = _Ring(self.max_points, covered_since, identity, from_topic)
+            self._rings[key] = ring
+            self._by_tag.setdefault((empresa, tag), {}).setdefault(planta, []).append(ring)
+            return ring
+
+    def recent(
+        self,
+        prefixes: Iterable[str],
+        broker_key: Optional[str],
+        seconds: float,
+        now: Optional[float] = None,
+    ) -> Dict[str, Dict[str, List[float]]]:
+        """Historia de los topics bajo los prefijos: `{topic: {"t": [ms...], "v": [...]}}`."""
+        if not self.enabled or seconds <= 0:
+            return {}
+        current = now if now is not None else time.time()
+        start = current - min(seconds, self.horizon_seconds)
+        filters = [prefix.rstrip("/") for prefix in prefixes]
+        with self._lock:
+            items = list(self._rings.items())
+        result: Dict[str, Dict[str, List[float]]] = {}
+        for (broker, topic), ring in items:
+            if broker_key and broker and broker != broker_key:
+                continue
+            if not any(_under(topic, prefix) for prefix in filters):
+                continue
+            ts, values = ring.window(start, current)
+            if ts.size:
+                result[topic] = {"t": np.round(ts * 1000).astype(np.int64).tolist(), "v": values.tolist()}
+        return result
+
+    def series(
+        self,
+        empresa: str,
+        tag: str,
+        plantas: Optional[Sequence[str]],
+        start: float,
+        end: float,
+        now: Optional[float] = None,
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Serie del tag en [start, end] o None si la memoria no cubre la ventana completa."""
+        if not self.enabled:
+            return None
+        current = now if now is not None else time.time()
+        if start < current - self.horizon_seconds:
+            return None
+        with self._lock:
+            # Un topic rechazado por el limite desde `start` puede tener puntos que faltan aqui
+            if self._rejected_at >= start or (empresa, tag) in self._ambiguous:
+                return None
+            by_planta = {planta: list(rings) for planta, rings in (self._by_tag.get((empresa, tag)) or {}).items()}
+            company_since = self._company_covered_since(empresa) if plantas is None else None
+        if plantas is None:
+            # Las plantas sin anillo no tuvieron datos solo si toda la empresa llega desde antes de `start`
+            if company_since is None or company_since > start:
+                return None
+            groups = list(by_planta.values())
+        else:
+            groups = [by_planta.get(planta) or [] for planta in plantas]
+        # Cada planta pedida debe venir de exactamente un topic, igual que su fila en `trends`
+        if not groups or any(len(group) != 1 for group in groups):
+            return None
+        rings = [group[0] for group in groups]
+        if any(ring.covered_since > start for ring in rings):
+            return None
+        parts = [ring.window(start, end) for ring in rings]
+        if len(parts) == 1:
+            return parts[0]
+        ts = np.concatenate([part[0] for part in parts])
+        values = np.concatenate([part[1] for part in parts])
+        order = np.argsort(ts, kind="stable")
+        return ts[order], values[order]
+
+    def _company_covered_since(self, empresa: str) -> Optional[float]:
+        company_prefix = "/".join(TREND_ROOT + (empresa,))
+        covering = [since for (_, prefix), since in self._resumed_at.items() if _under(company_prefix, prefix)]
+        return min(covering) if covering else None
+
+    def resume(self, broker_key: Optional[str], prefixes: Iterable[str], now: Optional[float] = None) -> None:
+        """Los prefijos vuelven a recibir mensajes: la memoria los cubre desde ahora."""
+        current = now if now is not None else time.time()
+        self._set_coverage(broker_key or "", list(prefixes), current)
+
+    def pause(self, broker_key: Optional[str], prefixes: Iterable[str]) -> None:
+        """Los prefijos dejan de recibir mensajes: sin cobertura hasta el proximo `resume`."""
+        self._set_coverage(broker_key or "", list(prefixes), None)
+
+    def _set_coverage(self, broker_key: str, prefixes: List[str], since: Optional[float]) -> None:
+        if not self.enabled or not prefixes:
+            return
+        with self._lock:
+            for prefix in prefixes:
+                if since is None:
+                    self._resumed_at.pop((broker_key, prefix), None)
+                else:
+                    self._resumed_at.setdefault((broker_key, prefix), since)
+            items = list(self._rings.items())
+        for (broker, topic), ring in items:
+            if broker != broker_key or not any(_under(topic, prefix) for prefix in prefixes):
+                continue
+            with ring.lock:
+                if since is None:
+                    ring.covered_since = math.inf
+                elif math.isinf(ring.covered_since):
+                    ring.covered_since = since
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Elimina los topics sin datos dentro del horizonte."""
+        if not self.enabled:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.horizon_seconds
+        removed = 0
+        with self._lock:
+            for key, ring in list(self._rings.items()):
+                if ring.last_ts >= cutoff:
+                    continue
+                del self._rings[key]
+                empresa, planta, tag = ring.identity
+                by_planta = self._by_tag.get((empresa, tag))
+                rings = by_planta.get(planta) if by_planta is not None else None
+                if rings is not None:
+                    rings[:] = [item for item in rings if item is not ring]
+                    if not rings:
+                        del by_planta[planta]
+                    if not by_planta:
+                        del self._by_tag[(empresa, tag)]
+                removed += 1
+            for trend_key, seen in list(self._ambiguous.items()):
+                if seen < cutoff:
+                    del self._ambiguous[trend_key]
+            if removed:
+                self._full_logged = False
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rings = list(self._rings.values())
+            ambiguous = len(self._ambiguous)
+        return {
+            "topics": len(rings),
+            "points": sum(ring.size for ring in rings),
+            "bytes": sum(ring.ts.nbytes + ring.values.nbytes for ring in rings),
+            "ambiguous": ambiguous,
+        }
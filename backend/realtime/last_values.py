@@ -0,0 +1,356 @@
+from __future__ import annotations
+
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left, insort
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import msgpack
+
+from .topic_index import topic_segments
+
+logger = logging.getLogger("bridge.realtime")
+
+PartitionKey = Tuple[str, str]
+Decoder = Callable[[bytes], Any]
+
+# Estimacion fija (no medida) de un registro con slots mas su lugar en el dict y la lista
+# ordenada; `bytes` en stats es una aproximacion para comparar, no la memoria real
+ENTRY_OVERHEAD_BYTES = 200
+SNAPSHOT_VERSION = 1
+
+
+class LastValue:
+    """Ultimo mensaje de un topic; guarda el payload crudo y se decodifica al leerlo."""
+
+    __slots__ = ("topic", "raw", "qos", "retain", "broker", "updated_at")
+
+    def __init__(self, topic: str, raw: bytes, qos: int, retain: bool, broker: Optional[str], updated_at: float) -> None:
+        self.topic = topic
+        self.raw = raw
+        self.qos = qos
+        self.retain = retain
+        self.broker = broker
+        self.updated_at = updated_at
+
+    def size(self) -> int:
+        return ENTRY_OVERHEAD_BYTES + len(self.topic) + len(self.raw)
+
+    def to_message(self, decoder: Decoder, now: float, stale_after: float = 0) -> Dict[str, Any]:
+        message: Dict[str, Any] = {
+            "topic": self.topic,
+            "payload": decoder(self.raw),
+            "retain": self.retain,
+            "qos": self.qos,
+            "ts": int(self.updated_at * 1000),
+            # Permite a la UI marcar valores que no se actualizan hace tiempo
+            "stale": stale_after > 0 and now - self.updated_at > stale_after,
+        }
+        if self.broker:
+            message["broker"] = self.broker
+        return message
+
+    def to_row(self) -> List[Any]:
+        return [self.topic, self.raw, self.qos, self.retain, self.broker, self.updated_at]
+
+
+class _Partition:
+    __slots__ = ("lock", "entries", "topics", "bytes", "evicted", "expired", "removed")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # Orden de insercion == orden de actualizacion: el primero es el menos reciente
+        self.entries: Dict[str, LastValue] = {}
+        # Topics ordenados: un prefijo es un rango contiguo que se ubica con bisect
+        self.topics: List[str] = []
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+        # Marcada al quitarla del cache (vacia); un put que la tenia en mano busca otra
+        self.removed = False
+
+    def _drop(self, topic: str, expired: bool = False) -> None:
+        entry = self.entries.pop(topic)
+        self.bytes -= entry.size()
+        index = bisect_left(self.topics, topic)
+        if index < len(self.topics) and self.topics[index] == topic:
+            del self.topics[index]
+        if expired:
+            self.expired += 1
+        else:
+            self.evicted += 1
+
+
+class LastValueCache:
+    """Ultimo valor por topic, particionado por (broker, empresa) e indexado por prefijo.
+
+    Cada particion tiene su propio lock, asi que el hilo MQTT de una empresa no
+    compite con los snapshots de otra. La cantidad de topics por empresa esta
+    acotada (se descarta el menos reciente), igual que la cantidad de particiones
+    (los mensajes de empresas nuevas se rechazan al llegar al limite), y `prune`
+    elimina los que dejaron de publicar hace mas de `max_age_seconds` junto con
+    las particiones que quedan vacias.
+    """
+
+    def __init__(
+        self,
+        topic_base: str,
+        decoder: Decoder,
+        max_per_company: int = 0,
+        max_age_seconds: float = 0,
+        stale_after_seconds: float = 0,
+        max_partitions: int = 0,
+        accepts: Optional[Callable[[str], bool]] = None,
+    ) -> None:
+        self._base = topic_segments(topic_base)
+        self._decoder = decoder
+        self.max_per_company = max_per_company
+        self.max_age_seconds = max_age_seconds
+        self.stale_after_seconds = stale_after_seconds
+        self.max_partitions = max_partitions
+        # Filtro opcional de empresas (p. ej. solo las configuradas)
+        self._accepts = accepts
+        self._partitions: Dict[PartitionKey, _Partition] = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self._evicted_total = 0
+        self._expired_total = 0
+
+    def company_for(self, topic: str) -> Optional[str]:
+        """Empresa del topic, "" si esta fuera de la base y None si es la base misma."""
+        segments = topic_segments(topic)
+        depth = len(self._base)
+        if segments[:depth] != self._base:
+            return ""
+        if len(segments) <= depth:
+            return None
+        return segments[depth]
+
+    def _partition(self, key: PartitionKey) -> Optional[_Partition]:
+        partition = self._partitions.get(key)
+        if partition is not None:
+            return partition
+        company = key[1]
+        if company and self._accepts is not None and not self._accepts(company):
+            self.rejected += 1
+            return None
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is None:
+                if self.max_partitions > 0 and len(self._partitions) >= self.max_partitions:
+                    self.rejected += 1
+                    if self.rejected == 1 or self.rejected % 1000 == 0:
+                        logger.warning(
+                            "Cache de ultimos valores sin lugar para empresa=%s broker=%s limite=%d rechazados=%d",
+                            company,
+                            key[0],
+                            self.max_partitions,
+                            self.rejected,
+                        )
+                    return None
+                partition = self._partitions[key] = _Partition()
+        return partition
+
+    def put(
+        self,
+        topic: str,
+        raw: bytes,
+        qos: int = 0,
+        retain: bool = False,
+        broker_key: Optional[str] = None,
+        updated_at: Optional[float] = None,
+    ) -> bool:
+        company = self.company_for(topic) or ""
+        key = (broker_key or "", company)
+        restoring = updated_at is not None
+        entry = LastValue(
+            sys.intern(topic),
+            bytes(raw),
+            int(qos),
+            bool(retain),
+            broker_key,
+            updated_at if restoring else time.time(),
+        )
+        while True:
+            partition = self._partition(key)
+            if partition is None:
+                return False
+            with partition.lock:
+                if not partition.removed:
+                    return self._put_locked(partition, entry, restoring, company, broker_key)
+
+    def _put_locked(
+        self,
+        partition: _Partition,
+        entry: LastValue,
+        restoring: bool,
+        company: str,
+        broker_key: Optional[str],
+    ) -> bool:
+        # Se llama con el lock de la particion tomado
+        topic = entry.topic
+        previous = partition.entries.get(topic)
+        if restoring and previous is not None and previous.updated_at >= entry.updated_at:
+            # Un mensaje MQTT llegado antes de restaurar es mas reciente que el snapshot
+            return False
+        if not restoring and entry.retain and previous is not None and previous.raw == entry.raw:
+            # Reenvio del retenido al suscribir o reconectar: el valor no cambio desde previous.updated_at.
+            # Se reemplaza en su lugar, las entradas siguen ordenadas por updated_at
+            entry.updated_at = previous.updated_at
+            partition.entries[topic] = entry
+            return True
+        if previous is None:
+            insort(partition.topics, entry.topic)
+        else:
+            del partition.entries[topic]
+            partition.bytes -= previous.size()
+        partition.entries[entry.topic] = entry
+        partition.bytes += entry.size()
+        overflow = len(partition.entries) - self.max_per_company if self.max_per_company > 0 else 0
+        for _ in range(overflow):
+            partition._drop(next(iter(partition.entries)))
+        if overflow > 0 and (partition.evicted == overflow or partition.evicted % 1000 == 0):
+            logger.warning(
+                "Cache de ultimos valores llena empresa=%s broker=%s limite=%d descartados=%d",
+                company,
+                broker_key,
+                self.max_per_company,
+                partition.evicted,
+            )
+        return True
+
+    def prune(self, now: Optional[float] = None) -> int:
+        if self.max_age_seconds <= 0:
+            return 0
+        cutoff = (now if now is not None else time.time()) - self.max_age_seconds
+        removed = 0
+        for partition in self._all_partitions():
+            with partition.lock:
+                while partition.entries:
+                    oldest = next(iter(partition.entries.values()))
+                    if oldest.updated_at >= cutoff:
+                        break
+                    partition._drop(oldest.topic, expired=True)
+                    removed += 1
+        self._drop_empty()
+        return removed
+
+    def _drop_empty(self) -> None:
+        with self._lock:
+            for key, partition in list(self._partitions.items()):
+                with partition.lock:
+                    if partition.entries:
+                        continue
+                    partition.removed = True
+                    # Los contadores de la particion se conservan en los totales
+                    self._expired_total += partition.expired
+                    self._evicted_total += partition.evicted
+                    del self._partitions[key]
+
+    def _all_partitions(self) -> List[_Partition]:
+        with self._lock:
+            return list(self._partitions.values())
+
+    def _partitions_for(self, prefix: str, broker_key: Optional[str]) -> List[_Partition]:
+        company = self.company_for(prefix)
+        with self._lock:
+            items = list(self._partitions.items())
+        return [
+            partition
+            for (broker, partition_company), partition in items
+            if (not broker_key or not broker or broker == broker_key)
+            and (company is None or partition_company == company)
+        ]
+
+    @staticmethod
+    def _range(partition: _Partition, prefix: str) -> List[LastValue]:
+        # "/" + 1 == "0": [prefix/, prefix0) contiene exactamente los topics bajo prefix/
+        with partition.lock:
+            matched = [partition.entries[prefix]] if prefix in partition.entries else []
+            if prefix:
+                lo = bisect_left(partition.topics, prefix + "/")
+                hi = bisect_left(partition.topics, prefix + "0", lo)
+                topics = partition.topics[lo:hi]
+            else:
+                topics = list(partition.topics)
+            matched.extend(partition.entries[topic] for topic in topics)
+        return matched
+
+    def entries(self, prefixes: Iterable[str], broker_key: Optional[str] = None) -> List[LastValue]:
+        """Entradas bajo los prefijos, sin repetir topics."""
+        results: List[LastValue] = []
+        seen: Set[str] = set()
+        for raw in prefixes:
+            prefix = raw.rstrip("/")
+            for partition in self._partitions_for(prefix, broker_key):
+                for entry in self._range(partition, prefix):
+                    if entry.topic not in seen:
+                        seen.add(entry.topic)
+                        results.append(entry)
+        return results
+
+    def snapshot(self, prefixes: Iterable[str], broker_key: Optional[str] = None) -> List[Dict[str, Any]]:
+        now = time.time()
+        # La decodificacion ocurre fuera del lock
+        return [
+            entry.to_message(self._decoder, now, self.stale_after_seconds)
+            for entry in self.entries(prefixes, broker_key)
+        ]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            partitions = list(self._partitions.values())
+            evicted, expired = self._evicted_total, self._expired_total
+        return {
+            "entries": sum(len(partition.entries) for partition in partitions),
+            # Aproximado: ENTRY_OVERHEAD_BYTES por entrada mas topic y payload
+            "bytes": sum(partition.bytes for partition in partitions),
+            "partitions": len(partitions),
+            "evicted": evicted + sum(partition.evicted for partition in partitions),
+            "expired": expired + sum(partition.expired for partition in partitions),
+            "rejected": self.rejected,
+        }
+
+    def __len__(self) -> int:
+        return sum(len(partition.entries) for partition in self._all_partitions())
+
+    def save(self, path: Path) -> int:
+        """Escribe todas las entradas en `path` (MessagePack) de forma atomica."""
+        rows: List[List[Any]] = []
+        for partition in self._all_partitions():
+            with partition.lock:
+                rows.extend(entry.to_row() for entry in partition.entries.values())
+        payload = msgpack.packb(
+            {"version": SNAPSHOT_VERSION, "savedAt": time.time(), "entries": rows},
+            use_bin_type=True,
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(path.name + ".part")
+        try:
+            partial.write_bytes(payload)
+            partial.replace(path)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        return len(rows)
+
+    def load(self, path: Path) -> int:
+        """Restaura un snapshot previo; omite entradas vencidas o ya reemplazadas."""
+        if not path.exists():
+            return 0
+        data = msgpack.unpackb(path.read_bytes(), raw=False)
+        if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+            logger.warning("Snapshot de ultimos valores ignorado: version no soportada")
+            return 0
+        cutoff = time.time() - self.max_age_seconds if self.max_age_seconds > 0 else None
+        restored = 0
+        # En orden de actualizacion para que el LRU quede igual que antes del reinicio
+        for topic, raw, qos, retain, broker, updated_at in sorted(data.get("entries") or [], key=lambda row: row[5]):
+            if cutoff is not None and updated_at < cutoff:
+                continue
+            if self.put(topic, raw, qos=qos, retain=retain, broker_key=broker, updated_at=updated_at):
+                restored += 1
+        return restored
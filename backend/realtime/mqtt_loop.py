@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Callable, Optional
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger("bridge.mqtt")
+
+MISC_INTERVAL_SECONDS = 1.0
+RECONNECT_MIN_SECONDS = 1.0
+RECONNECT_MAX_SECONDS = 30.0
+READ_BATCH = 256
+
+
+class AsyncioMqttConnection:
+    """Conduce un `paho.mqtt.Client` desde el event loop, sin el hilo de `loop_start`.
+
+    El socket se registra con `add_reader`/`add_writer`, por lo que los callbacks de
+    paho (on_connect, on_message, ...) corren en el hilo del event loop. Solo el
+    handshake TCP/TLS, que en paho es bloqueante, se hace en un executor.
+    """
+
+    def __init__(self, client: mqtt.Client, host: str, port: int, keepalive: int, name: str) -> None:
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.task: Optional[asyncio.Task] = None
+        self._closed: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._connected_once = False
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 2.0) -> None:
+        self._stopping = True
+        if self.client.is_connected():
+            self.client.disconnect()
+            if self._closed is not None:
+                try:
+                    await asyncio.wait_for(self._closed.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        task = self.task
+        self.task = None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _call(self, fn: Callable[..., Any], *args: Any) -> None:
+        # paho invoca los callbacks de socket desde el executor durante el handshake
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            fn(*args)
+        else:
+            loop.call_soon_threadsafe(fn, *args)
+
+    def _on_socket_open(self, client: mqtt.Client, userdata: Any, sock: Any) -> None:
+        self._call(self.loop.add_reader, sock, self._on_readable)
+
+    def _on_readable(self) -> None:
+        client = self.client
+        for _ in range(READ_BATCH):
+            if client.loop_read() != mqtt.MQTT_ERR_SUCCESS:
+                return
+            # Con TLS puede quedar data ya descifrada en el objeto SSL que epoll no ve
+            sock = client.socket()
+            pending = getattr(sock, "pending", None)
+            if pending is None or pending() <= 0:
+                return
+
+    def _on_socket_close(self, client: mqtt.Client, userdata: Any, sock: Any) -> None:
+        # Se captura el evento del intento actual; un reintento crea uno nuevo
+        self._call(self._remove_socket, sock, self._closed)
+
+    def _remove_socket(self, sock: Any, closed: Optional[asyncio.Event]) -> None:
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        if closed is not None:
+            closed.set()
+
+    def _on_socket_register_write(self, client: mqtt.Client, userdata: Any, sock: Any) -> None:
+        self._call(self.loop.add_writer, sock, self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client: mqtt.Client, userdata: Any, sock: Any) -> None:
+        self._call(self.loop.remove_writer, sock)
+
+    async def _connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._connected_once:
+            await loop.run_in_executor(None, self.client.reconnect)
+        else:
+            await loop.run_in_executor(None, self.client.connect, self.host, self.port, self.keepalive)
+            self._connected_once = True
+
+    async def _run(self) -> None:
+        delay = RECONNECT_MIN_SECONDS
+        while not self._stopping:
+            self._closed = asyncio.Event()
+            try:
+                await self._connect()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("MQTT conexion fallida broker=%s: %s; reintento en %.0fs", self.name, exc, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+                continue
+            delay = RECONNECT_MIN_SECONDS
+            # Keepalive (PINGREQ) y reintentos de QoS los maneja loop_misc
+            while not self._closed.is_set():
+                if self.client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                try:
+                    await asyncio.wait_for(self._closed.wait(), timeout=MISC_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            if not self._stopping:
+                await asyncio.sleep(delay)
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+PartitionKey = Tuple[str, str]
+Decoder = Callable[[bytes], Any]
+CompanyResolver = Callable[[str], Optional[str]]
+
+# (seq, topic, raw, qos, retain)
+ReplayEntry = Tuple[int, str, bytes, int, bool]
+
+# Estimacion fija del costo de una entrada (tupla, enteros y lugar en la deque)
+ENTRY_OVERHEAD_BYTES = 120
+
+
+def _entry_size(entry: ReplayEntry) -> int:
+    return ENTRY_OVERHEAD_BYTES + len(entry[1]) + len(entry[2])
+
+
+class _Ring:
+    __slots__ = ("lock", "entries", "dropped_through", "bytes", "last_append", "removed")
+
+    def __init__(self, size: int) -> None:
+        self.lock = threading.Lock()
+        self.entries: Deque[ReplayEntry] = deque(maxlen=size)
+        # Secuencia del ultimo mensaje descartado: quien reanude desde antes perdio datos
+        self.dropped_through = 0
+        self.bytes = 0
+        self.last_append = time.monotonic()
+        # Marcado por prune; quien lo tenga en mano crea otro anillo
+        self.removed = False
+
+    def _drop_oldest(self) -> int:
+        entry = self.entries.popleft()
+        self.dropped_through = entry[0]
+        size = _entry_size(entry)
+        self.bytes -= size
+        return size
+
+
+class ReplayBuffer:
+    """Ultimos mensajes por (broker, empresa) con su secuencia, para reanudar conexiones WS.
+
+    Las secuencias son por broker, asi que dentro de un anillo no son consecutivas.
+    `since` retorna None cuando el anillo ya descarto mensajes posteriores a la
+    secuencia pedida; en ese caso el cliente necesita un snapshot completo.
+
+    La memoria esta acotada: como maximo `max_rings` anillos (los mensajes de
+    empresas nuevas no se retienen al llegar al limite) y `max_bytes` en total
+    (al superarlo el anillo que escribe descarta sus mensajes mas viejos). `prune`
+    elimina los anillos sin mensajes hace mas de `idle_seconds`. Lo que se pierde
+    por estos limites queda registrado por broker, y las reanudaciones anteriores
+    a esa secuencia reciben snapshot completo.
+    """
+
+    def __init__(
+        self,
+        company_for: CompanyResolver,
+        decoder: Decoder,
+        size_per_company: int,
+        max_rings: int = 0,
+        max_bytes: int = 0,
+        idle_seconds: float = 0,
+    ) -> None:
+        self._company_for = company_for
+        self._decoder = decoder
+        self.size_per_company = size_per_company
+        self.max_rings = max_rings
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        # Nunca se toma el lock de un anillo con `_lock` tomado (ni al reves)
+        self._rings: Dict[PartitionKey, _Ring] = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        # Por broker: secuencia mas alta que no se puede reponer (anillo rechazado o eliminado)
+        self._lost_through: Dict[str, int] = {}
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size_per_company > 0
+
+    def _ring(self, key: PartitionKey, seq: int) -> Optional[_Ring]:
+        ring = self._rings.get(key)
+        if ring is not None and not ring.removed:
+            return ring
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None or ring.removed:
+                if self.max_rings > 0 and len(self._rings) >= self.max_rings:
+                    self.rejected += 1
+                    self._lost_through[key[0]] = max(self._lost_through.get(key[0], 0), seq)
+                    return None
+                ring = self._rings[key] = _Ring(self.size_per_company)
+        return ring
+
+    def append(self, seq: int, topic: str, raw: bytes, qos: int, retain: bool, broker_key: Optional[str]) -> None:
+        if not self.enabled:
+            return
+        key = (broker_key or "", self._company_for(topic) or "")
+        entry = (seq, topic, bytes(raw), int(qos), bool(retain))
+        size = _entry_size(entry)
+        while True:
+            ring = self._ring(key, seq)
+            if ring is None:
+                return
+            with ring.lock:
+                if ring.removed:
+                    continue
+                delta = size
+                if len(ring.entries) == ring.entries.maxlen:
+                    delta -= ring._drop_oldest()
+                ring.entries.append(entry)
+                ring.bytes += size
+                ring.last_append = time.monotonic()
+            break
+        with self._lock:
+            self._bytes += delta
+            over = self._bytes - self.max_bytes if self.max_bytes > 0 else 0
+        if over <= 0:
+            return
+        freed = 0
+        # Sobre el limite global cede el anillo que escribe; siempre conserva el mensaje nuevo
+        with ring.lock:
+            while over > freed and len(ring.entries) > 1 and not ring.removed:
+                freed += ring._drop_oldest()
+        if freed:
+            with self._lock:
+                self._bytes -= freed
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Elimina anillos sin mensajes hace mas de `idle_seconds`; retorna cuantos."""
+        if self.idle_seconds <= 0:
+            return 0
+        cutoff = (now if now is not None else time.monotonic()) - self.idle_seconds
+        removed = 0
+        with self._lock:
+            items = list(self._rings.items())
+        for key, ring in items:
+            with ring.lock:
+                if ring.removed or ring.last_append >= cutoff:
+                    continue
+                ring.removed = True
+                last_seq = ring.entries[-1][0] if ring.entries else ring.dropped_through
+                freed, ring.bytes = ring.bytes, 0
+                ring.entries.clear()
+            with self._lock:
+                self._lost_through[key[0]] = max(self._lost_through.get(key[0], 0), last_seq)
+                self._bytes -= freed
+                if self._rings.get(key) is ring:
+                    del self._rings[key]
+            removed += 1
+        return removed
+
+    def since(self, seq: int, prefixes: Iterable[str], broker_key: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+        """Mensajes posteriores a `seq` bajo los prefijos, en orden de secuencia."""
+        if not self.enabled:
+            return None
+        filters = [prefix.rstrip("/") for prefix in prefixes]
+        companies = {self._company_for(prefix) for prefix in filters}
+        with self._lock:
+            if self._lost_through.get(broker_key or "", 0) > seq:
+                return None
+            rings = [
+                ring
+                for (broker, company), ring in self._rings.items()
+                if broker == (broker_key or "") and (None in companies or company in companies)
+            ]
+        matched: Dict[int, ReplayEntry] = {}
+        for ring in rings:
+            with ring.lock:
+                if ring.removed or ring.dropped_through > seq:
+                    return None
+                entries = [entry for entry in ring.entries if entry[0] > seq]
+            for entry in entries:
+                topic = entry[1]
+                if any(topic == prefix or topic.startswith(prefix + "/") for prefix in filters):
+                    matched[entry[0]] = entry
+        messages: List[Dict[str, Any]] = []
+        for entry_seq, topic, raw, qos, retain in sorted(matched.values()):
+            message: Dict[str, Any] = {
+                "topic": topic,
+                "payload": self._decoder(raw),
+                "qos": qos,
+                "retain": retain,
+                "seq": entry_seq,
+            }
+            if broker_key:
+                message["broker"] = broker_key
+            messages.append(message)
+        return messages
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rings = list(self._rings.values())
+            total_bytes = self._bytes
+        return {
+            "rings": len(rings),
+            "entries": sum(len(ring.entries) for ring in rings),
+            # Aproximado: ENTRY_OVERHEAD_BYTES por mensaje mas topic y payload
+            "bytes": total_bytes,
+            "rejected": self.rejected,
+        }
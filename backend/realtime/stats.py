@@ -0,0 +1,26 @@
+from __future__ import annotations
+
+import threading
+from typing import Dict, Iterable
+
+
+class Counters:
+    """Contadores monotonicos compartidos entre el hilo MQTT y el event loop."""
+
+    def __init__(self, names: Iterable[str]) -> None:
+        self._values: Dict[str, int] = {name: 0 for name in names}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        with self._lock:
+            value = self._values.get(name, 0) + amount
+            self._values[name] = value
+            return value
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import threading
+from typing import Dict, Generic, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+
+def topic_segments(topic: str) -> Tuple[str, ...]:
+    """Segmentos de un topic o prefijo; ignora las barras finales (`a/b/` == `a/b`)."""
+    stripped = topic.rstrip("/")
+    if not stripped:
+        return ()
+    return tuple(stripped.split("/"))
+
+
+class _Node(Generic[T]):
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_Node[T]"] = {}
+        self.subscribers: Set[T] = set()
+
+
+class TopicIndex(Generic[T]):
+    """Trie por segmentos que asocia prefijos de topic (por broker) a suscriptores.
+
+    `match` recorre solo la rama del topic, por lo que su costo es
+    O(profundidad del topic + destinatarios) y no depende del total de clientes.
+    """
+
+    def __init__(self) -> None:
+        self._roots: Dict[str, _Node[T]] = {}
+        self._entries: Dict[T, Set[Tuple[str, Tuple[str, ...]]]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, broker_key: str, prefix: str, subscriber: T) -> None:
+        segments = topic_segments(prefix)
+        with self._lock:
+            node = self._roots.setdefault(broker_key, _Node())
+            for segment in segments:
+                node = node.children.setdefault(segment, _Node())
+            node.subscribers.add(subscriber)
+            self._entries.setdefault(subscriber, set()).add((broker_key, segments))
+
+    def add_many(self, broker_key: str, prefixes: Iterable[str], subscriber: T) -> None:
+        for prefix in prefixes:
+            self.add(broker_key, prefix, subscriber)
+
+    def discard(self, broker_key: str, prefix: str, subscriber: T) -> None:
+        segments = topic_segments(prefix)
+        with self._lock:
+            self._discard_locked(broker_key, segments, subscriber)
+            entries = self._entries.get(subscriber)
+            if entries is not None:
+                entries.discard((broker_key, segments))
+                if not entries:
+                    del self._entries[subscriber]
+
+    def remove(self, subscriber: T) -> None:
+        with self._lock:
+            for broker_key, segments in self._entries.pop(subscriber, set()):
+                self._discard_locked(broker_key, segments, subscriber)
+
+    def _discard_locked(self, broker_key: str, segments: Tuple[str, ...], subscriber: T) -> None:
+        root = self._roots.get(broker_key)
+        if root is None:
+            return
+        path: List[Tuple[_Node[T], str]] = []
+        node = root
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                return
+            path.append((node, segment))
+            node = child
+        node.subscribers.discard(subscriber)
+        # Poda las ramas que quedaron vacias
+        for parent, segment in reversed(path):
+            child = parent.children[segment]
+            if child.subscribers or child.children:
+                break
+            del parent.children[segment]
+        if not root.children and not root.subscribers:
+            del self._roots[broker_key]
+
+    def match(self, topic: str, broker_key: Optional[str] = None) -> Set[T]:
+        segments = topic_segments(topic)
+        found: Set[T] = set()
+        with self._lock:
+            roots = [self._roots.get(broker_key)] if broker_key else list(self._roots.values())
+            for node in roots:
+                if node is None:
+                    continue
+                found.update(node.subscribers)
+                for segment in segments:
+                    node = node.children.get(segment)
+                    if node is None:
+                        break
+                    found.update(node.subscribers)
+        return found
+
+    def prefixes_for(self, subscriber: T) -> List[Tuple[str, str]]:
+        with self._lock:
+            return [(broker, "/".join(segments)) for broker, segments in self._entries.get(subscriber, set())]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
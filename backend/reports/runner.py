@@ -6,7 +6,7 @@ import math
 import os
 from datetime import datetime, timezone
 from email.message import EmailMessage
-from typing import List, Optional, Sequence, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import aiosmtplib
 import asyncpg
@@ -22,6 +22,9 @@ import matplotlib.pyplot as plt
 
 from reports.schemas import ReportDefinitionOut, ReportRunOut, ReportStatus
 from reports import service as report_service
+from trends import calculated as trend_calculated
+
+CalculatedDefinitions = Optional[Sequence[Dict[str, Any]]]
 
 PALETTE = {
     "primary": colors.HexColor("#0d6efd"),
@@ -130,6 +133,8 @@ def _build_pdf(
             elements.append(flow)
         elif not points:
             elements.append(Paragraph("Sin datos en el rango.", normal))
+        if item.get("truncated"):
+            elements.append(Paragraph("Serie calculada parcial: sus dependencias superan el limite de filas.", normal))
         elements.append(Spacer(1, 0.2 * cm))
 
     elements.append(Spacer(1, 0.3 * cm))
@@ -219,11 +224,19 @@ def _plot_series_chart(tag: str, points: Sequence[dict]) -> Optional[bytes]:
     if not points:
         return None
     try:
-        xs = [datetime.fromisoformat(p["timestamp"].replace("Z", "+00:00")) for p in points]
+        xs = [
+            p["timestamp"]
+            if isinstance(p["timestamp"], datetime)
+            else datetime.fromisoformat(p["timestamp"].replace("Z", "+00:00"))
+            for p in points
+        ]
         ys = [p["value"] for p in points]
         plt.figure(figsize=(6, 2.2))
         plt.plot(xs, ys, color="#0d6efd", linewidth=1.5)
-        plt.fill_between(xs, ys, color="#0d6efd", alpha=0.1)
+        if all(p.get("min") is not None and p.get("max") is not None for p in points):
+            plt.fill_between(xs, [p["min"] for p in points], [p["max"] for p in points], color="#0d6efd", alpha=0.15)
+        else:
+            plt.fill_between(xs, ys, color="#0d6efd", alpha=0.1)
         plt.title(tag, fontsize=10)
         plt.xlabel("Tiempo")
         plt.ylabel("Valor")
@@ -348,10 +361,15 @@ async def execute_run(
     *,
     run: ReportRunOut,
     definition: ReportDefinitionOut,
+    calculated_definitions: CalculatedDefinitions = None,
 ) -> Tuple[ReportStatus, Optional[bytes], List[str], Optional[str]]:
     now = datetime.now(timezone.utc)
     start = _tz_aware(run.window_start or now)
     end = _tz_aware(run.window_end or now)
+    try:
+        calculated = trend_calculated.compiled_tag_set(calculated_definitions)
+    except Exception:  # noqa: BLE001
+        calculated = None
     series = await report_service.fetch_trend_series(
         pool,
         empresa_id=definition.empresa_id,
@@ -359,6 +377,7 @@ async def execute_run(
         tags=definition.tags,
         start=start,
         end=end,
+        calculated=calculated,
     )
     alarms: List[dict] = []
     if definition.include_alarms:
@@ -388,13 +407,19 @@ async def execute_run(
     return status, pdf_bytes, emails_sent, error
 
 
-async def process_run(pool: asyncpg.pool.Pool, run_id: int) -> Optional[ReportRunOut]:
+async def process_run(
+    pool: asyncpg.pool.Pool,
+    run_id: int,
+    calculated_definitions: CalculatedDefinitions = None,
+) -> Optional[ReportRunOut]:
     run = await report_service.fetch_run(pool, run_id)
     if not run:
         return None
     definition = await _load_definition(pool, run.empresa_id, run.report_id)
     try:
-        status, pdf_bytes, sent, mail_error = await execute_run(pool, run=run, definition=definition)
+        status, pdf_bytes, sent, mail_error = await execute_run(
+            pool, run=run, definition=definition, calculated_definitions=calculated_definitions
+        )
         if mail_error:
             status = "failed"
         return await report_service.update_run_status(
@@ -409,14 +434,23 @@ async def process_run(pool: asyncpg.pool.Pool, run_id: int) -> Optional[ReportRu
         return await report_service.update_run_status(pool, run_id, "failed", error=str(exc))
 
 
-async def process_run_background(pool: asyncpg.pool.Pool, run_id: int) -> None:
+async def process_run_background(
+    pool: asyncpg.pool.Pool,
+    run_id: int,
+    calculated_definitions: CalculatedDefinitions = None,
+) -> None:
     try:
-        await process_run(pool, run_id)
+        await process_run(pool, run_id, calculated_definitions)
     except Exception:
         # no-op, ya se loguea en update_run_status
         pass
 
 
-def spawn_background(pool: asyncpg.pool.Pool, run_id: int) -> None:
+def spawn_background(
+    pool: asyncpg.pool.Pool,
+    run_id: int,
+    calculated_definitions: CalculatedDefinitions = None,
+) -> None:
+    """`calculated_definitions` son los `calculatedTags` de la empresa del reporte."""
     loop = asyncio.get_event_loop()
-    loop.create_task(process_run_background(pool, run_id))
+    loop.create_task(process_run_background(pool, run_id, calculated_definitions))
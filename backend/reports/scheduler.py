@@ -2,18 +2,23 @@ from __future__ import annotations
 
 import asyncio
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Callable, Optional
 
 import asyncpg
 
 from . import service as report_service
-from .runner import spawn_background
+from .runner import CalculatedDefinitions, spawn_background
 
 CHECK_INTERVAL_SECONDS = 60
 SCHEDULER_ENABLED_ENV = "REPORTS_SCHEDULER_ENABLED"
 
+DefinitionsLoader = Callable[[str], CalculatedDefinitions]
 
-async def process_due_reports(pool: asyncpg.pool.Pool) -> int:
+
+async def process_due_reports(
+    pool: asyncpg.pool.Pool,
+    load_calculated_definitions: Optional[DefinitionsLoader] = None,
+) -> int:
     now = datetime.now(timezone.utc)
     due = await report_service.list_due_definitions(pool, now)
     processed = 0
@@ -29,19 +34,25 @@ async def process_due_reports(pool: asyncpg.pool.Pool) -> int:
             )
             next_run = report_service.compute_next_run_at(definition, now)
             await report_service.update_next_run(pool, definition.empresa_id, definition.id, next_run)
-            spawn_background(pool, run.id)
+            calculated_definitions = None
+            if load_calculated_definitions is not None:
+                calculated_definitions = await asyncio.to_thread(load_calculated_definitions, definition.empresa_id)
+            spawn_background(pool, run.id, calculated_definitions)
             processed += 1
         except Exception:
             continue
     return processed
 
 
-async def scheduler_loop(get_pool_callable) -> None:
+async def scheduler_loop(
+    get_pool_callable,
+    load_calculated_definitions: Optional[DefinitionsLoader] = None,
+) -> None:
     while True:
         try:
             pool: Optional[asyncpg.pool.Pool] = get_pool_callable()
             if pool:
-                await process_due_reports(pool)
+                await process_due_reports(pool, load_calculated_definitions)
         except Exception:
             pass
         await asyncio.sleep(CHECK_INTERVAL_SECONDS)
@@ -8,6 +8,9 @@ from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import asyncpg
 from asyncpg.pool import Pool
 
+from trends import calculated as trend_calculated
+from trends import service as trend_service
+
 from .schemas import (
     ReportCreatePayload,
     ReportDefinitionOut,
@@ -21,6 +24,9 @@ DEFAULT_PLANTA_ID = "default"
 MAX_REPORTS_PER_PLANT = 2
 ALLOWED_STATUSES: Set[ReportStatus] = {"idle", "queued", "running", "success", "failed", "skipped"}
 DEFAULT_MAX_POINTS = 400
+# El envolvente min/max conserva en el PDF las excursiones que el promedio oculta.
+REPORT_AGGREGATES: Tuple[str, ...] = ("avg", "min", "max")
+CALCULATED_MAX_ROWS_PER_TAG = 50000
 _COLUMN_CACHE: Dict[Tuple[str, str], bool] = {}
 DEFAULT_REPORT_TIMEZONE = os.getenv("REPORTS_DEFAULT_TIMEZONE", "America/Santiago").strip() or "America/Santiago"
 
@@ -681,6 +687,34 @@ async def fetch_run(pool: Pool, run_id: int) -> Optional[ReportRunOut]:
     return _record_to_run(row)
 
 
+def _calculated_series(
+    tag_set: trend_calculated.CalculatedTagSet,
+    tag: str,
+    samples: Dict[str, trend_service.TagSamples],
+    bucket: int,
+    aggregates: Sequence[str],
+    max_points: int,
+) -> Dict[str, Any]:
+    timestamps, values = trend_calculated.evaluate_series(tag_set, tag, samples)
+    stats = trend_calculated.series_stats(timestamps, values)
+    if stats is None:
+        return {"tag": tag, "points": [], "stats": None}
+    stats["latestTimestamp"] = datetime.fromtimestamp(stats["latestTimestamp"], tz=timezone.utc)
+    buckets, columns = trend_calculated.bucket_aggregates(timestamps, values, bucket, aggregates)
+    primary = aggregates[0]
+    points: List[Dict[str, Any]] = []
+    for index in range(min(buckets.size, max_points)):
+        row = {key: float(columns[key][index]) for key in aggregates}
+        points.append(
+            {
+                "timestamp": datetime.fromtimestamp(float(buckets[index]), tz=timezone.utc),
+                "value": row[primary],
+                **row,
+            }
+        )
+    return {"tag": tag, "points": points, "stats": stats}
+
+
 async def fetch_trend_series(
     pool: Pool,
     *,
@@ -690,14 +724,35 @@ async def fetch_trend_series(
     start: datetime,
     end: datetime,
     max_points: int = DEFAULT_MAX_POINTS,
+    aggregates: Sequence[str] = REPORT_AGGREGATES,
+    calculated: Optional[trend_calculated.CalculatedTagSet] = None,
 ) -> List[Dict[str, Any]]:
     if not tags:
         return []
+    aggregates = trend_service.normalize_aggregates(aggregates)
     total_seconds = max(1, int((end - start).total_seconds()))
     bucket = max(1, int(total_seconds / max(1, min(max_points, 1000))))
+    calculated_requested = [tag for tag in tags if calculated is not None and tag in calculated]
     results: List[Dict[str, Any]] = []
     async with pool.acquire() as conn:
+        samples: Dict[str, trend_service.TagSamples] = {}
+        if calculated is not None and calculated_requested:
+            samples = await trend_service.fetch_tag_samples(
+                conn,
+                empresa_id=empresa_id,
+                plantas=[planta_id],
+                tags=calculated.raw_dependencies(calculated_requested),
+                start=start,
+                end=end,
+                max_rows_per_tag=CALCULATED_MAX_ROWS_PER_TAG,
+            )
+        truncated = set(calculated.truncated(calculated_requested, samples)) if calculated is not None else set()
         for tag in tags:
+            if calculated is not None and tag in calculated_requested:
+                entry = _calculated_series(calculated, tag, samples, bucket, aggregates, max_points)
+                entry["truncated"] = tag in truncated
+                results.append(entry)
+                continue
             stats_query = """
                 SELECT
                     COUNT(*) OVER () AS count,
@@ -718,29 +773,19 @@ async def fetch_trend_series(
             if stats_row is None or not stats_row["count"]:
                 results.append({"tag": tag, "points": [], "stats": None})
                 continue
-            data_query = """
-                SELECT to_timestamp(floor(extract(epoch FROM timestamp)/$6)*$6) AS bucket,
-                       AVG(valor) AS value
-                FROM trends
-                WHERE empresa_id = $1
-                  AND planta_id = $2
-                  AND tag = $3
-                  AND timestamp BETWEEN $4 AND $5
-                GROUP BY bucket
-                ORDER BY bucket ASC
-                LIMIT $7
-            """
-            rows = await conn.fetch(
-                data_query,
-                empresa_id,
-                planta_id,
-                tag,
-                start,
-                end,
-                bucket,
-                max_points,
+            rows = await trend_service.fetch_bucket_rows(
+                conn,
+                empresa_id=empresa_id,
+                plantas=[planta_id],
+                tag=tag,
+                start=start,
+                end=end,
+                interval_seconds=bucket,
+                aggregates=aggregates,
+                limit=max_points,
             )
-            points = [{"timestamp": row["bucket"], "value": float(row["value"])} for row in rows]
+            primary = aggregates[0]
+            points = [{"timestamp": ts, "value": values[primary], **values} for ts, values in rows]
             stats = {
                 "latest": float(stats_row["latest_value"]) if stats_row["latest_value"] is not None else None,
                 "min": float(stats_row["min_value"]) if stats_row["min_value"] is not None else None,
@@ -0,0 +1,400 @@
+"""Benchmark de fan-out WebSocket: cuantos dashboards soporta una instancia del bridge.
+
+Levanta la app FastAPI con uvicorn en este proceso, sin broker MQTT real ni Firebase:
+los tokens se aceptan sin verificar y los mensajes se inyectan por
+`BrokerManager._make_on_message`, el mismo camino que usa paho. Los clientes
+WebSocket corren en procesos aparte para no competir por el GIL con el servidor.
+
+Uso (desde backend/):
+    python -m scripts.bench_ws_fanout --clients 500 --rate 1000 --duration 20
+    python -m scripts.bench_ws_fanout --clients 200 --protocol msgpack --output baseline.json
+
+Mide latencia de entrega (publicacion -> recepcion en el cliente), CPU del servidor
+por mensaje inyectado y por entrega, y memoria residente por cliente conectado.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import random
+import resource
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parents[1]
+TOPIC_BASE = "scada/customers"
+CONNECT_CONCURRENCY = 50
+INJECT_TICK_SECONDS = 0.005
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark de fan-out WebSocket del bridge MQTT")
+    parser.add_argument("--clients", type=int, default=200, help="conexiones WebSocket simultaneas")
+    parser.add_argument("--rate", type=float, default=500, help="mensajes MQTT inyectados por segundo")
+    parser.add_argument("--duration", type=float, default=10, help="segundos de inyeccion")
+    parser.add_argument("--warmup", type=float, default=2, help="segundos de inyeccion descartados al inicio")
+    parser.add_argument("--companies", type=int, default=10)
+    parser.add_argument("--plants", type=int, default=4, help="plantas por empresa")
+    parser.add_argument("--tags", type=int, default=50, help="tags por planta")
+    parser.add_argument("--widgets", type=int, default=20, help="tags por planta en el dashboard (0 = prefijos completos)")
+    parser.add_argument("--restricted", type=float, default=0.3, help="fraccion de usuarios limitados a una planta")
+    parser.add_argument("--payload-bytes", type=int, default=120, help="tamano aproximado del payload JSON")
+    parser.add_argument("--protocol", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--conflate-ms", type=int, default=None, help="conflate por conexion (por defecto el del bridge)")
+    parser.add_argument("--client-procs", type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)))
+    parser.add_argument("--drain", type=float, default=2, help="segundos de espera tras la inyeccion")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, default=None, help="guarda el resultado en JSON")
+    return parser.parse_args(argv)
+
+
+# ---- Escenario ----
+def company_id(index: int) -> str:
+    return f"bench{index:03d}"
+
+
+def plant_id(index: int) -> str:
+    return f"p{index:02d}"
+
+
+def tag_name(index: int) -> str:
+    return f"tag{index:03d}"
+
+
+def client_token(index: int, args: argparse.Namespace) -> str:
+    """Token falso con la empresa y, para usuarios restringidos, su planta."""
+    rng = random.Random(args.seed * 1_000_003 + index)
+    company = company_id(index % args.companies)
+    plant = plant_id(rng.randrange(args.plants)) if rng.random() < args.restricted else "*"
+    return f"{index}.{company}.{plant}"
+
+
+def scada_config(args: argparse.Namespace) -> Dict[str, Any]:
+    plants = [{"id": plant_id(p), "serialCode": plant_id(p)} for p in range(args.plants)]
+    containers = [
+        {"plantId": plant_id(p), "objects": [{"topic": tag_name(t)} for t in range(min(args.widgets, args.tags))]}
+        for p in range(args.plants)
+    ]
+    return {"plants": plants, "containers": containers if args.widgets > 0 else []}
+
+
+# ---- Servidor ----
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as handle:
+            return int(handle.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # macOS reporta bytes, Linux KiB; solo el pico, pero sirve como aproximacion
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def prepare_environment() -> None:
+    os.environ.update(
+        {
+            "MQTT_CLIENT_MODE": "asyncio",
+            "HIVEMQ_HOST": "127.0.0.1",
+            "MQTT_TLS": "0",
+            "TOPIC_BASE": TOPIC_BASE,
+            "FIREBASE_PROJECT_ID": os.environ.get("FIREBASE_PROJECT_ID") or "bench",
+            "DATABASE_URL": "",
+            "LAST_VALUE_SNAPSHOT_ENABLED": "0",
+            "CLUSTER_MODE": "0",
+        }
+    )
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
+
+
+def install_stubs(bridge: Any, args: argparse.Namespace) -> None:
+    config = scada_config(args)
+
+    def decode_token(token: str) -> Dict[str, Any]:
+        index, company, plant = token.split(".")
+        return {"uid": f"bench-{index}", "empresaId": company, "benchPlant": plant}
+
+    def allowed_prefixes(uid: str, company: str, decoded: Optional[Dict[str, Any]] = None, **_: Any) -> List[str]:
+        plant = (decoded or {}).get("benchPlant", "*")
+        return [f"{TOPIC_BASE}/{company}" if plant == "*" else f"{TOPIC_BASE}/{company}/{plant}"]
+
+    bridge.decode_firebase_token = decode_token
+    bridge.extract_company_id = lambda decoded: decoded["empresaId"]
+    bridge.allowed_prefixes_for_user = allowed_prefixes
+    bridge.load_scada_config = lambda company: config
+    bridge.broker_key_for_company = lambda company: bridge.DEFAULT_BROKER_KEY
+    # El broker real se reemplaza por el inyector: ninguna conexion MQTT sale del proceso
+    bridge.broker_manager.connections = []
+
+
+def mark_connected(bridge: Any) -> str:
+    manager = bridge.broker_manager
+    key = manager.resolve_key(None)
+    manager.connected_events[key].set()
+    manager.async_connected[key].set()
+    return key
+
+
+def make_message(mqtt: Any, topic: str, payload: bytes) -> Any:
+    message = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+    message.payload = payload
+    message.qos = 0
+    message.retain = False
+    return message
+
+
+async def inject(handler: Any, mqtt: Any, args: argparse.Namespace, rng: random.Random, duration: float) -> int:
+    topics = [
+        f"{TOPIC_BASE}/{company_id(c)}/{plant_id(p)}/{tag_name(t)}"
+        for c in range(args.companies)
+        for p in range(args.plants)
+        for t in range(args.tags)
+    ]
+    pad = "x" * max(0, args.payload_bytes - 40)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    sent = 0
+    while True:
+        elapsed = loop.time() - started
+        if elapsed >= duration:
+            return sent
+        due = int(elapsed * args.rate)
+        while sent < due:
+            payload = json.dumps({"value": rng.random() * 100, "t": time.time(), "pad": pad}).encode("utf-8")
+            handler(None, None, make_message(mqtt, rng.choice(topics), payload))
+            sent += 1
+        await asyncio.sleep(INJECT_TICK_SECONDS)
+
+
+async def run_server(args: argparse.Namespace) -> Dict[str, Any]:
+    prepare_environment()
+    import paho.mqtt.client as mqtt
+    import uvicorn
+
+    import app as bridge
+
+    install_stubs(bridge, args)
+    # Sin base de datos cada conexion advierte que omite el control de sesiones
+    logging.getLogger("bridge").setLevel(logging.ERROR)
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(bridge.app, host="127.0.0.1", port=port, log_level="warning", ws="websockets"))
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if serve_task.done():
+            serve_task.result()
+        await asyncio.sleep(0.05)
+    broker_key = mark_connected(bridge)
+    handler = bridge.broker_manager._make_on_message(broker_key)
+
+    gc.collect()
+    rss_before = rss_bytes()
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    stop = ctx.Event()
+    procs = max(1, min(args.client_procs, args.clients))
+    workers = [
+        ctx.Process(target=client_process, args=(port, list(range(i, args.clients, procs)), vars(args), results, stop))
+        for i in range(procs)
+    ]
+    loop = asyncio.get_running_loop()
+    import numpy as np
+
+    latencies: List[np.ndarray] = []
+    received = 0
+    try:
+        for worker in workers:
+            worker.start()
+        connect_started = time.perf_counter()
+        connected = 0
+        for _ in workers:
+            kind, value = await loop.run_in_executor(None, next_result, results, workers)
+            if kind != "ready":
+                raise RuntimeError(f"Cliente fallo al conectar: {value}")
+            connected += value
+        connect_seconds = time.perf_counter() - connect_started
+        gc.collect()
+        rss_connected = rss_bytes()
+
+        rng = random.Random(args.seed)
+        warmup = min(args.warmup, args.duration)
+        if warmup > 0:
+            await inject(handler, mqtt, args, rng, warmup)
+        counters_before = bridge.mqtt_counters.snapshot()
+        cpu_before = time.process_time()
+        wall_before = time.perf_counter()
+        measure_from = time.time()
+        injected = await inject(handler, mqtt, args, rng, args.duration - warmup)
+        wall = time.perf_counter() - wall_before
+        cpu_injecting = time.process_time() - cpu_before
+        await asyncio.sleep(args.drain)
+        cpu_total = time.process_time() - cpu_before
+        counters_after = bridge.mqtt_counters.snapshot()
+        rss_after = rss_bytes()
+
+        stop.set()
+        for _ in workers:
+            kind, value = await loop.run_in_executor(None, next_result, results, workers)
+            if kind == "done":
+                samples = np.frombuffer(value["samples"], dtype=np.float64).reshape(-1, 2)
+                # Solo mensajes publicados despues del calentamiento
+                latencies.append(samples[samples[:, 0] >= measure_from, 1])
+                received += value["received"]
+    finally:
+        # Tambien si un cliente fallo: sin esto los procesos y el servidor mantienen vivo el interprete
+        stop.set()
+        for worker in workers:
+            if worker.pid is None:
+                continue
+            await loop.run_in_executor(None, worker.join, 10)
+            if worker.is_alive():
+                worker.terminate()
+                await loop.run_in_executor(None, worker.join, 5)
+        server.should_exit = True
+        await serve_task
+
+    measured = np.concatenate(latencies) if latencies else np.empty(0)
+    deliveries = int(measured.size)
+    percentiles = {}
+    if deliveries:
+        for label, q in (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9)):
+            percentiles[label] = round(float(np.percentile(measured, q)) * 1000, 3)
+        percentiles["max"] = round(float(measured.max()) * 1000, 3)
+    counter_delta = {key: counters_after.get(key, 0) - counters_before.get(key, 0) for key in counters_after}
+    return {
+        "scenario": {
+            key: (str(value) if isinstance(value, Path) else value)
+            for key, value in vars(args).items()
+            if key != "output"
+        },
+        "python": sys.version.split()[0],
+        "connected": connected,
+        "connectSeconds": round(connect_seconds, 3),
+        "injected": injected,
+        "injectRate": round(injected / wall, 1) if wall > 0 else None,
+        "deliveries": deliveries,
+        "fanoutPerMessage": round(deliveries / injected, 2) if injected else None,
+        "latencyMs": percentiles,
+        "cpu": {
+            "seconds": round(cpu_total, 3),
+            "utilization": round(cpu_injecting / wall, 3) if wall > 0 else None,
+            "usPerMessage": round(cpu_total / injected * 1e6, 2) if injected else None,
+            "usPerDelivery": round(cpu_total / deliveries * 1e6, 2) if deliveries else None,
+        },
+        "memory": {
+            "rssBeforeMb": round(rss_before / 2**20, 1),
+            "rssConnectedMb": round(rss_connected / 2**20, 1),
+            "rssAfterMb": round(rss_after / 2**20, 1),
+            "kbPerClient": round((rss_connected - rss_before) / max(1, connected) / 1024, 1),
+        },
+        "counters": counter_delta,
+        "receivedTotal": received,
+    }
+
+
+def next_result(results: Any, workers: List[Any]) -> Tuple[str, Any]:
+    """Siguiente reporte de un cliente; falla si todos terminaron sin reportar."""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError("Los procesos cliente terminaron sin reportar")
+
+
+# ---- Clientes ----
+def client_process(port: int, indexes: List[int], options: Dict[str, Any], results: Any, stop: Any) -> None:
+    try:
+        asyncio.run(_client_main(port, indexes, argparse.Namespace(**options), results, stop))
+    except Exception as exc:
+        results.put(("error", repr(exc)))
+
+
+async def _client_main(port: int, indexes: List[int], args: argparse.Namespace, results: Any, stop: Any) -> None:
+    import msgpack
+    import numpy as np
+    import websockets
+
+    latencies: List[Tuple[float, float]] = []
+    received = 0
+    query = f"&protocol={args.protocol}"
+    if args.conflate_ms is not None:
+        query += f"&conflate={args.conflate_ms}"
+
+    def decode(frame: Any) -> Any:
+        return msgpack.unpackb(frame, raw=False) if isinstance(frame, bytes) else json.loads(frame)
+
+    def record(message: Dict[str, Any], now: float) -> None:
+        nonlocal received
+        payload = message.get("payload")
+        if isinstance(payload, dict) and "t" in payload:
+            received += 1
+            latencies.append((payload["t"], now - payload["t"]))
+
+    async def run_one(index: int, ready: asyncio.Event, gate: asyncio.Semaphore, connected: List[int]) -> None:
+        url = f"ws://127.0.0.1:{port}/ws?token={client_token(index, args)}{query}"
+        async with gate:
+            ws = await websockets.connect(url, max_size=None, ping_interval=None)
+            hello = decode(await ws.recv())
+            if hello.get("type") != "hello":
+                raise RuntimeError(f"Respuesta inesperada: {hello}")
+        connected[0] += 1
+        if connected[0] == len(indexes):
+            ready.set()
+        try:
+            async for frame in ws:
+                now = time.time()
+                message = decode(frame)
+                if message.get("type") == "batch":
+                    for item in message.get("messages") or []:
+                        record(item, now)
+                else:
+                    record(message, now)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            await ws.close()
+
+    ready = asyncio.Event()
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    connected = [0]
+    tasks = [asyncio.create_task(run_one(index, ready, gate, connected)) for index in indexes]
+    waiter = asyncio.create_task(ready.wait())
+    await asyncio.wait([waiter, *tasks], return_when=asyncio.FIRST_COMPLETED)
+    failed = [task for task in tasks if task.done() and task.exception() is not None]
+    if failed:
+        results.put(("error", repr(failed[0].exception())))
+        return
+    results.put(("ready", connected[0]))
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, stop.wait)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # (publicado_en, latencia): el servidor descarta lo publicado durante el calentamiento
+    data = np.array(latencies, dtype=np.float64).reshape(-1, 2)
+    results.put(("done", {"received": received, "samples": data.tobytes()}))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    result = asyncio.run(run_server(args))
+    print(json.dumps(result, indent=2))
+    if args.output is not None:
+        args.output.write_text(json.dumps(result, indent=2) + "\n", encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
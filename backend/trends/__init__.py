@@ -0,0 +1,3 @@
+"""Consultas y exportacion de series historicas (tabla trends)."""
+
+__all__ = ["align", "export", "service"]
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import math
+from datetime import datetime
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+from .service import TagSamples
+
+ALIGN_METHODS = ("previous", "linear", "bucket")
+
+
+def _grid_origin(start: datetime, step_seconds: int) -> int:
+    return math.floor(start.timestamp() / step_seconds) * step_seconds
+
+
+def grid_size(start: datetime, end: datetime, step_seconds: int) -> int:
+    return int((end.timestamp() - _grid_origin(start, step_seconds)) // step_seconds) + 1
+
+
+def build_grid(start: datetime, end: datetime, step_seconds: int) -> np.ndarray:
+    """Grilla comun en epoch (segundos) alineada a multiplos de `step_seconds`."""
+    origin = _grid_origin(start, step_seconds)
+    return origin + np.arange(grid_size(start, end, step_seconds), dtype=np.float64) * step_seconds
+
+
+def _as_arrays(samples: TagSamples, with_seed: bool) -> "tuple[np.ndarray, np.ndarray]":
+    ts = np.asarray(samples.timestamps, dtype=np.float64)
+    values = np.asarray(samples.values, dtype=np.float64)
+    if with_seed and samples.seed_timestamp is not None and samples.seed_value is not None:
+        ts = np.concatenate(([samples.seed_timestamp], ts))
+        values = np.concatenate(([float(samples.seed_value)], values))
+    return ts, values
+
+
+def align_previous(ts: np.ndarray, values: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    out = np.full(grid.shape, np.nan)
+    if ts.size == 0:
+        return out
+    idx = np.searchsorted(ts, grid, side="right") - 1
+    valid = idx >= 0
+    out[valid] = values[idx[valid]]
+    return out
+
+
+def align_linear(ts: np.ndarray, values: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    if ts.size == 0:
+        return np.full(grid.shape, np.nan)
+    # Fuera del rango muestreado no se extrapola
+    return np.interp(grid, ts, values, left=np.nan, right=np.nan)
+
+
+def align_buckets(ts: np.ndarray, values: np.ndarray, grid: np.ndarray, step_seconds: int) -> np.ndarray:
+    out = np.full(grid.shape, np.nan)
+    if ts.size == 0 or grid.size == 0:
+        return out
+    idx = np.rint((ts - grid[0]) / step_seconds).astype(np.int64)
+    valid = (idx >= 0) & (idx < grid.size)
+    out[idx[valid]] = values[valid]
+    return out
+
+
+def align_samples(samples: TagSamples, grid: np.ndarray, method: str, step_seconds: int) -> np.ndarray:
+    if method == "bucket":
+        ts, values = _as_arrays(samples, with_seed=False)
+        return align_buckets(ts, values, grid, step_seconds)
+    ts, values = _as_arrays(samples, with_seed=True)
+    if method == "linear":
+        aligned = align_linear(ts, values, grid)
+    elif method == "previous":
+        aligned = align_previous(ts, values, grid)
+    else:
+        raise ValueError(f"Alineacion no soportada: {method}")
+    if samples.truncated and ts.size:
+        # Mas alla de la ultima muestra leida no hay informacion confiable
+        aligned[grid > ts[-1]] = np.nan
+    return aligned
+
+
+def build_matrix(
+    samples: Dict[str, TagSamples],
+    tags: Sequence[str],
+    grid: np.ndarray,
+    method: str,
+    step_seconds: int,
+) -> np.ndarray:
+    """Matriz (len(tags), len(grid)) con NaN donde no hay valor."""
+    matrix = np.full((len(tags), grid.size), np.nan)
+    for row, tag in enumerate(tags):
+        entry = samples.get(tag)
+        if entry is not None:
+            matrix[row] = align_samples(entry, grid, method, step_seconds)
+    return matrix
+
+
+def to_json_rows(matrix: np.ndarray) -> List[Any]:
+    """Convierte a listas JSON reemplazando NaN por None (sirve para 1 o 2 dimensiones)."""
+    as_objects = matrix.astype(object)
+    as_objects[np.isnan(matrix)] = None
+    return as_objects.tolist()
+
+
+def grid_timestamps(grid: np.ndarray) -> List[str]:
+    stamps = np.datetime_as_string(grid.astype("datetime64[s]"), unit="s")
+    return [f"{stamp}Z" for stamp in stamps.tolist()]
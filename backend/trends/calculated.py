@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import ast
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from .align import align_samples
+from .service import TagSamples
+
+MAX_EXPRESSION_LENGTH = 500
+MAX_EXPRESSION_NODES = 200
+MAX_CALCULATED_TAGS = 200
+CACHE_SIZE = 128
+
+# `{planta/tag}` permite referenciar tags que no son identificadores validos
+_BRACED_TAG = re.compile(r"\{([^{}]+)\}")
+
+_FUNCTIONS: Dict[str, Callable[..., Any]] = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "log10": np.log10,
+    "exp": np.exp,
+    "min": np.fmin,
+    "max": np.fmax,
+    "clip": np.clip,
+    "where": np.where,
+}
+_FUNCTION_ARITY: Dict[str, Tuple[int, int]] = {
+    "abs": (1, 1),
+    "sqrt": (1, 1),
+    "log": (1, 1),
+    "log10": (1, 1),
+    "exp": (1, 1),
+    "min": (2, 2),
+    "max": (2, 2),
+    "clip": (3, 3),
+    "where": (3, 3),
+}
+_BIN_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow)
+_UNARY_OPS = (ast.UAdd, ast.USub)
+_COMPARE_OPS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+
+@dataclass
+class CalculatedTag:
+    tag: str
+    expression: str
+    dependencies: Tuple[str, ...]
+    code: Any
+    variables: Dict[str, str]
+
+
+@dataclass
+class CalculatedTagSet:
+    version: str
+    tags: Dict[str, CalculatedTag]
+    order: List[str]
+
+    def __contains__(self, tag: str) -> bool:
+        return tag in self.tags
+
+    def raw_dependencies(self, requested: Sequence[str]) -> List[str]:
+        """Tags almacenados necesarios para evaluar `requested` (expande anidados)."""
+        raw: List[str] = []
+        seen: Set[str] = set()
+        pending = [tag for tag in requested if tag in self.tags]
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            for dep in self.tags[current].dependencies:
+                if dep in self.tags:
+                    pending.append(dep)
+                elif dep not in raw:
+                    raw.append(dep)
+        return raw
+
+    def truncated(self, requested: Sequence[str], samples: Dict[str, Any]) -> List[str]:
+        """Tags calculados de `requested` con alguna dependencia cortada por el limite de filas."""
+        result: List[str] = []
+        for tag in requested:
+            if tag not in self.tags:
+                continue
+            if any(getattr(samples.get(dep), "truncated", False) for dep in self.raw_dependencies([tag])):
+                result.append(tag)
+        return result
+
+    def evaluate(self, requested: Sequence[str], columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Evalua en orden topologico sobre arreglos alineados; `columns` se extiende."""
+        needed = set(requested)
+        for tag in reversed(self.order):
+            if tag in needed:
+                needed.update(dep for dep in self.tags[tag].dependencies if dep in self.tags)
+        values = dict(columns)
+        for tag in self.order:
+            if tag not in needed:
+                continue
+            item = self.tags[tag]
+            scope: Dict[str, Any] = dict(_FUNCTIONS)
+            for name, dep in item.variables.items():
+                scope[name] = values[dep]
+            try:
+                with np.errstate(all="ignore"):
+                    result = eval(item.code, {"__builtins__": {}}, scope)  # noqa: S307 - AST validado
+            except ArithmeticError:
+                result = np.nan
+            values[tag] = np.asarray(result, dtype=np.float64)
+        return values
+
+
+class _Validator(ast.NodeTransformer):
+    def __init__(self) -> None:
+        self.variables: Dict[str, str] = {}
+        self.nodes = 0
+
+    def _variable_for(self, tag: str) -> str:
+        for name, existing in self.variables.items():
+            if existing == tag:
+                return name
+        name = f"_t{len(self.variables)}"
+        self.variables[name] = tag
+        return name
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        self.nodes += 1
+        if self.nodes > MAX_EXPRESSION_NODES:
+            raise ValueError("Expresion demasiado compleja")
+        return super().generic_visit(node)
+
+    def visit_Expression(self, node: ast.Expression) -> ast.AST:
+        return self.generic_visit(node)
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        if not isinstance(node.op, _BIN_OPS):
+            raise ValueError(f"Operador no permitido: {node.op.__class__.__name__}")
+        return self.generic_visit(node)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        if not isinstance(node.op, _UNARY_OPS):
+            raise ValueError(f"Operador no permitido: {node.op.__class__.__name__}")
+        return self.generic_visit(node)
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        if len(node.ops) != 1 or not isinstance(node.ops[0], _COMPARE_OPS):
+            raise ValueError("Solo se permite una comparacion simple")
+        return self.generic_visit(node)
+
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        self.nodes += 1
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError(f"Constante no permitida: {node.value!r}")
+        # Las constantes se evaluan como float para evitar enteros arbitrariamente grandes
+        return ast.copy_location(ast.Constant(value=float(node.value)), node)
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        self.nodes += 1
+        if node.id in _FUNCTIONS:
+            raise ValueError(f"{node.id} debe usarse como funcion")
+        return ast.copy_location(ast.Name(id=self._variable_for(node.id), ctx=ast.Load()), node)
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        func = node.func
+        if isinstance(func, ast.Name) and func.id == "tag":
+            if len(node.args) != 1 or node.keywords:
+                raise ValueError("tag() recibe un unico nombre de tag")
+            arg = node.args[0]
+            if not isinstance(arg, ast.Constant) or not isinstance(arg.value, str) or not arg.value.strip():
+                raise ValueError("tag() requiere un nombre de tag como texto")
+            self.nodes += 1
+            return ast.copy_location(ast.Name(id=self._variable_for(arg.value.strip()), ctx=ast.Load()), node)
+        if not isinstance(func, ast.Name) or func.id not in _FUNCTIONS:
+            raise ValueError("Funcion no permitida")
+        if node.keywords:
+            raise ValueError(f"{func.id}() no acepta argumentos con nombre")
+        low, high = _FUNCTION_ARITY[func.id]
+        if not low <= len(node.args) <= high:
+            raise ValueError(f"{func.id}() recibe {low} argumento(s)")
+        self.nodes += 1
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit(self, node: ast.AST) -> ast.AST:
+        allowed = (
+            ast.Expression,
+            ast.BinOp,
+            ast.UnaryOp,
+            ast.Compare,
+            ast.Constant,
+            ast.Name,
+            ast.Call,
+            ast.operator,
+            ast.unaryop,
+            ast.cmpop,
+            ast.expr_context,
+        )
+        if not isinstance(node, allowed):
+            raise ValueError(f"Sintaxis no permitida: {node.__class__.__name__}")
+        return super().visit(node)
+
+
+def _rewrite_braces(expression: str) -> str:
+    return _BRACED_TAG.sub(lambda match: f"tag({json.dumps(match.group(1).strip())})", expression)
+
+
+def compile_expression(tag: str, expression: str) -> CalculatedTag:
+    text = (expression or "").strip()
+    if not text:
+        raise ValueError(f"El tag calculado {tag} requiere una expresion")
+    if len(text) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"La expresion de {tag} supera {MAX_EXPRESSION_LENGTH} caracteres")
+    try:
+        parsed = ast.parse(_rewrite_braces(text), mode="eval")
+    except SyntaxError as exc:
+        raise ValueError(f"Expresion invalida en {tag}: {exc.msg}") from exc
+    validator = _Validator()
+    try:
+        tree = validator.visit(parsed)
+    except ValueError as exc:
+        raise ValueError(f"Expresion invalida en {tag}: {exc}") from exc
+    ast.fix_missing_locations(tree)
+    code = compile(tree, f"<calculado:{tag}>", "eval")
+    return CalculatedTag(
+        tag=tag,
+        expression=text,
+        dependencies=tuple(dict.fromkeys(validator.variables.values())),
+        code=code,
+        variables=dict(validator.variables),
+    )
+
+
+def definitions_version(definitions: Sequence[Dict[str, Any]]) -> str:
+    canonical = json.dumps(
+        [(item.get("tag"), item.get("expression")) for item in definitions],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def _topological_order(tags: Dict[str, CalculatedTag]) -> List[str]:
+    order: List[str] = []
+    state: Dict[str, int] = {}
+
+    def visit(tag: str, path: List[str]) -> None:
+        mark = state.get(tag)
+        if mark == 2:
+            return
+        if mark == 1:
+            cycle = " -> ".join(path + [tag])
+            raise ValueError(f"Dependencia circular entre tags calculados: {cycle}")
+        state[tag] = 1
+        for dep in tags[tag].dependencies:
+            if dep in tags:
+                visit(dep, path + [tag])
+        state[tag] = 2
+        order.append(tag)
+
+    for tag in tags:
+        visit(tag, [])
+    return order
+
+
+def build_tag_set(definitions: Sequence[Dict[str, Any]]) -> CalculatedTagSet:
+    if len(definitions) > MAX_CALCULATED_TAGS:
+        raise ValueError(f"Maximo {MAX_CALCULATED_TAGS} tags calculados")
+    compiled: Dict[str, CalculatedTag] = {}
+    for item in definitions:
+        tag = str(item.get("tag") or "").strip()
+        if not tag:
+            raise ValueError("Cada tag calculado requiere un nombre")
+        if tag in compiled:
+            raise ValueError(f"Tag calculado duplicado: {tag}")
+        compiled[tag] = compile_expression(tag, str(item.get("expression") or ""))
+    return CalculatedTagSet(
+        version=definitions_version(definitions),
+        tags=compiled,
+        order=_topological_order(compiled),
+    )
+
+
+_cache: "OrderedDict[str, CalculatedTagSet]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compiled_tag_set(definitions: Optional[Sequence[Dict[str, Any]]]) -> Optional[CalculatedTagSet]:
+    """Compila (o reutiliza) las definiciones; la version es el hash del contenido."""
+    if not definitions:
+        return None
+    version = definitions_version(definitions)
+    with _cache_lock:
+        cached = _cache.get(version)
+        if cached is not None:
+            _cache.move_to_end(version)
+            return cached
+    tag_set = build_tag_set(definitions)
+    with _cache_lock:
+        _cache[version] = tag_set
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return tag_set
+
+
+def union_timeline(samples: Dict[str, TagSamples], tags: Sequence[str]) -> np.ndarray:
+    parts = [np.asarray(samples[tag].timestamps, dtype=np.float64) for tag in tags if tag in samples]
+    if not parts:
+        return np.empty(0)
+    return np.unique(np.concatenate(parts))
+
+
+def evaluate_series(
+    tag_set: CalculatedTagSet,
+    tag: str,
+    samples: Dict[str, TagSamples],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Serie (epoch, valor) del tag calculado sobre la union de instantes de sus dependencias."""
+    dependencies = tag_set.raw_dependencies([tag])
+    timeline = union_timeline(samples, dependencies)
+    if timeline.size == 0:
+        return timeline, np.empty(0)
+    columns = {dep: align_samples(samples[dep], timeline, "previous", 1) for dep in dependencies}
+    values = tag_set.evaluate([tag], columns)[tag]
+    values = np.broadcast_to(values, timeline.shape)
+    # Solo instantes en que todas las dependencias ya tienen valor
+    mask = np.isfinite(values)
+    for column in columns.values():
+        mask &= ~np.isnan(column)
+    return timeline[mask], np.asarray(values[mask], dtype=np.float64)
+
+
+def bucket_aggregates(
+    timestamps: np.ndarray,
+    values: np.ndarray,
+    interval_seconds: int,
+    aggregates: Sequence[str],
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Agrega una serie ordenada por buckets alineados a epoch, igual que la consulta SQL."""
+    if timestamps.size == 0:
+        return np.empty(0), {key: np.empty(0) for key in aggregates}
+    bucket_ids = np.floor(timestamps / interval_seconds).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+    ends = np.r_[starts[1:], bucket_ids.size]
+    counts = ends - starts
+    sums = np.add.reduceat(values, starts)
+    result: Dict[str, np.ndarray] = {}
+    for key in aggregates:
+        if key == "avg":
+            result[key] = sums / counts
+        elif key == "min":
+            result[key] = np.minimum.reduceat(values, starts)
+        elif key == "max":
+            result[key] = np.maximum.reduceat(values, starts)
+        elif key == "first":
+            result[key] = values[starts]
+        elif key == "last":
+            result[key] = values[ends - 1]
+        elif key == "count":
+            result[key] = counts.astype(np.float64)
+        elif key == "stddev":
+            squares = np.add.reduceat(values * values, starts)
+            with np.errstate(all="ignore"):
+                variance = (squares - sums * sums / counts) / (counts - 1)
+            result[key] = np.where(counts > 1, np.sqrt(np.maximum(variance, 0.0)), np.nan)
+        else:
+            raise ValueError(f"Agregado no soportado: {key}")
+    return bucket_ids[starts].astype(np.float64) * interval_seconds, result
+
+
+def series_stats(timestamps: np.ndarray, values: np.ndarray) -> Optional[Dict[str, Any]]:
+    if values.size == 0:
+        return None
+    return {
+        "latest": float(values[-1]),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "avg": float(values.mean()),
+        "latestTimestamp": float(timestamps[-1]),
+        "count": int(values.size),
+    }
+
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterable, List
+
+from .service import ExportRow
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+GZIP_MEDIA_TYPE = "application/gzip"
+CHUNK_TARGET_BYTES = 64 * 1024
+
+
+def format_timestamp(value: datetime) -> str:
+    target = value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return target.isoformat().replace("+00:00", "Z")
+
+
+def export_filename(export_format: str, compressed: bool) -> str:
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    suffix = f".{export_format}.gz" if compressed else f".{export_format}"
+    return f"tendencias_{stamp}{suffix}"
+
+
+def media_type_for(export_format: str, compressed: bool) -> str:
+    if compressed:
+        return GZIP_MEDIA_TYPE
+    return EXPORT_FORMATS[export_format]
+
+
+def _encode_csv(rows: Iterable[ExportRow]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for tag, ts, value in rows:
+        writer.writerow((tag, format_timestamp(ts), repr(value)))
+    return buffer.getvalue()
+
+
+def _encode_ndjson(rows: Iterable[ExportRow]) -> str:
+    lines: List[str] = []
+    for tag, ts, value in rows:
+        lines.append(json.dumps({"tag": tag, "timestamp": format_timestamp(ts), "value": value}, separators=(",", ":")))
+        lines.append("\n")
+    return "".join(lines)
+
+
+async def encode_pages(pages: AsyncIterator[List[ExportRow]], export_format: str) -> AsyncIterator[bytes]:
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Formato de exportacion no soportado: {export_format}")
+    encoder = _encode_csv if export_format == "csv" else _encode_ndjson
+    if export_format == "csv":
+        yield b"tag,timestamp,value\n"
+    async for page in pages:
+        if page:
+            yield encoder(page).encode("utf-8")
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    # wbits=31 produce un stream gzip (cabecera + crc) sin bufferizar el archivo completo
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = bytearray()
+    async for chunk in chunks:
+        pending += compressor.compress(chunk)
+        if len(pending) >= CHUNK_TARGET_BYTES:
+            yield bytes(pending)
+            pending.clear()
+    pending += compressor.flush()
+    if pending:
+        yield bytes(pending)
+
+
+def stream_export(pages: AsyncIterator[List[ExportRow]], export_format: str, compressed: bool) -> AsyncIterator[bytes]:
+    encoded = encode_pages(pages, export_format)
+    return gzip_chunks(encoded) if compressed else encoded
@@ -0,0 +1,356 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+from asyncpg.pool import Pool
+
+DEFAULT_PAGE_SIZE = 5000
+
+
+def _coerce_page_size(value: Optional[str]) -> int:
+    try:
+        parsed = int(value) if value is not None else DEFAULT_PAGE_SIZE
+    except (TypeError, ValueError):
+        parsed = DEFAULT_PAGE_SIZE
+    return max(100, parsed)
+
+
+EXPORT_PAGE_SIZE = _coerce_page_size(os.getenv("TRENDS_EXPORT_PAGE_SIZE"))
+
+ExportRow = Tuple[str, datetime, float]
+
+# first/last usan MIN/MAX sobre ARRAY[epoch, valor]: se resuelven en el mismo
+# recorrido que el resto de agregados y sin acumular arreglos por bucket.
+AGGREGATE_EXPRESSIONS: Dict[str, str] = {
+    "avg": "AVG(valor)",
+    "min": "MIN(valor)",
+    "max": "MAX(valor)",
+    "first": "(MIN(ARRAY[extract(epoch FROM timestamp)::double precision, valor]))[2]",
+    "last": "(MAX(ARRAY[extract(epoch FROM timestamp)::double precision, valor]))[2]",
+    "count": "COUNT(*)",
+    "stddev": "STDDEV_SAMP(valor)",
+}
+DEFAULT_AGGREGATES: Tuple[str, ...] = ("avg",)
+
+
+@dataclass
+class TagSamples:
+    """Muestras de un tag como arreglos paralelos (epoch en segundos, valor)."""
+
+    tag: str
+    timestamps: List[float] = field(default_factory=list)
+    values: List[Optional[float]] = field(default_factory=list)
+    seed_timestamp: Optional[float] = None
+    seed_value: Optional[float] = None
+    truncated: bool = False
+
+
+def _planta_clause(plantas: Optional[Sequence[str]], position: int) -> str:
+    if plantas is None:
+        return ""
+    return f"AND planta_id = ANY(${position})"
+
+
+def _bucket_start(value: datetime, interval_seconds: int) -> datetime:
+    epoch = int(value.timestamp())
+    return datetime.fromtimestamp(epoch - (epoch % interval_seconds), tz=timezone.utc)
+
+
+def normalize_aggregates(raw: Optional[Sequence[str]]) -> List[str]:
+    """Acepta `agg=min&agg=max` o `agg=min,max`; conserva el orden pedido."""
+    if not raw:
+        return list(DEFAULT_AGGREGATES)
+    normalized: List[str] = []
+    for item in raw:
+        if item is None:
+            continue
+        for part in str(item).split(","):
+            key = part.strip().lower()
+            if not key:
+                continue
+            if key not in AGGREGATE_EXPRESSIONS:
+                raise ValueError(f"Agregado no soportado: {part.strip()}")
+            if key not in normalized:
+                normalized.append(key)
+    return normalized or list(DEFAULT_AGGREGATES)
+
+
+def _aggregate_value(key: str, value: Any) -> Any:
+    if value is None:
+        return None
+    if key == "count":
+        return int(value)
+    return float(value)
+
+
+async def fetch_bucket_rows(
+    conn: asyncpg.Connection,
+    *,
+    empresa_id: str,
+    plantas: Optional[Sequence[str]],
+    tag: str,
+    start: datetime,
+    end: datetime,
+    interval_seconds: int,
+    aggregates: Sequence[str],
+    limit: int,
+) -> List[Tuple[datetime, Dict[str, Any]]]:
+    select_list = ",\n               ".join(
+        f"{AGGREGATE_EXPRESSIONS[key]} AS agg_{key}" for key in aggregates
+    )
+    query = """
+        SELECT to_timestamp(floor(extract(epoch FROM timestamp)/$5)*$5) AS bucket,
+               {select_list}
+        FROM trends
+        WHERE empresa_id = $1
+          AND tag = $2
+          {planta_filter}
+          AND timestamp BETWEEN $3 AND $4
+        GROUP BY bucket
+        ORDER BY bucket ASC
+        LIMIT $6
+    """.format(select_list=select_list, planta_filter=_planta_clause(plantas, 7))
+    params: List[Any] = [empresa_id, tag, start, end, interval_seconds, limit]
+    if plantas is not None:
+        params.append(list(plantas))
+    rows = await conn.fetch(query, *params)
+    return [
+        (row["bucket"], {key: _aggregate_value(key, row[f"agg_{key}"]) for key in aggregates})
+        for row in rows
+    ]
+
+
+def bucket_columns(rows: Sequence[Tuple[datetime, Dict[str, Any]]], aggregates: Sequence[str]) -> Dict[str, List[Any]]:
+    columns: Dict[str, List[Any]] = {key: [] for key in aggregates}
+    for _, values in rows:
+        for key in aggregates:
+            columns[key].append(values.get(key))
+    return columns
+
+
+async def fetch_tag_samples(
+    conn: asyncpg.Connection,
+    *,
+    empresa_id: str,
+    plantas: Optional[Sequence[str]],
+    tags: Sequence[str],
+    start: datetime,
+    end: datetime,
+    max_rows_per_tag: int,
+) -> Dict[str, TagSamples]:
+    # Una sola consulta para todos los tags: cada LATERAL recorre el indice del
+    # tag y devuelve arreglos, ademas del ultimo valor previo al rango (semilla).
+    planta_filter = _planta_clause(plantas, 6)
+    query = """
+        SELECT t.tag,
+               d.ts,
+               d.vals,
+               d.total,
+               s.seed_ts,
+               s.seed_value
+        FROM unnest($2::text[]) AS t(tag)
+        CROSS JOIN LATERAL (
+            SELECT array_agg(extract(epoch FROM r.timestamp)::double precision ORDER BY r.timestamp) AS ts,
+                   array_agg(r.valor ORDER BY r.timestamp) AS vals,
+                   COUNT(*) AS total
+            FROM (
+                SELECT timestamp, valor
+                FROM trends
+                WHERE empresa_id = $1
+                  AND tag = t.tag
+                  {planta_filter}
+                  AND timestamp BETWEEN $3 AND $4
+                ORDER BY timestamp ASC
+                LIMIT $5
+            ) AS r
+        ) AS d
+        LEFT JOIN LATERAL (
+            SELECT extract(epoch FROM timestamp)::double precision AS seed_ts,
+                   valor AS seed_value
+            FROM trends
+            WHERE empresa_id = $1
+              AND tag = t.tag
+              {planta_filter}
+              AND timestamp < $3
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ) AS s ON true
+    """.format(planta_filter=planta_filter)
+    params: List[Any] = [empresa_id, list(tags), start, end, max_rows_per_tag]
+    if plantas is not None:
+        params.append(list(plantas))
+    rows = await conn.fetch(query, *params)
+    samples: Dict[str, TagSamples] = {tag: TagSamples(tag=tag) for tag in tags}
+    for row in rows:
+        entry = samples[row["tag"]]
+        entry.timestamps = list(row["ts"] or [])
+        entry.values = list(row["vals"] or [])
+        entry.truncated = int(row["total"] or 0) >= max_rows_per_tag
+        if row["seed_ts"] is not None:
+            entry.seed_timestamp = float(row["seed_ts"])
+            entry.seed_value = row["seed_value"]
+    return samples
+
+
+async def fetch_bucket_samples(
+    conn: asyncpg.Connection,
+    *,
+    empresa_id: str,
+    plantas: Optional[Sequence[str]],
+    tags: Sequence[str],
+    start: datetime,
+    end: datetime,
+    interval_seconds: int,
+    aggregate: str,
+) -> Dict[str, TagSamples]:
+    expression = AGGREGATE_EXPRESSIONS[aggregate]
+    query = """
+        SELECT b.tag,
+               array_agg(extract(epoch FROM b.bucket)::double precision ORDER BY b.bucket) AS ts,
+               array_agg(b.value ORDER BY b.bucket) AS vals
+        FROM (
+            SELECT tag,
+                   to_timestamp(floor(extract(epoch FROM timestamp)/$5)*$5) AS bucket,
+                   ({expression})::double precision AS value
+            FROM trends
+            WHERE empresa_id = $1
+              AND tag = ANY($2::text[])
+              {planta_filter}
+              AND timestamp BETWEEN $3 AND $4
+            GROUP BY tag, bucket
+        ) AS b
+        GROUP BY b.tag
+    """.format(expression=expression, planta_filter=_planta_clause(plantas, 6))
+    params: List[Any] = [empresa_id, list(tags), start, end, interval_seconds]
+    if plantas is not None:
+        params.append(list(plantas))
+    rows = await conn.fetch(query, *params)
+    samples: Dict[str, TagSamples] = {tag: TagSamples(tag=tag) for tag in tags}
+    for row in rows:
+        entry = samples[row["tag"]]
+        entry.timestamps = list(row["ts"] or [])
+        entry.values = list(row["vals"] or [])
+    return samples
+
+
+async def iter_raw_points(
+    pool: Pool,
+    *,
+    empresa_id: str,
+    plantas: Optional[Sequence[str]],
+    tag: str,
+    start: datetime,
+    end: datetime,
+    page_size: int = EXPORT_PAGE_SIZE,
+) -> AsyncIterator[List[Tuple[datetime, float]]]:
+    # Paginacion keyset sobre (timestamp, id): cada pagina usa el indice
+    # (empresa_id, planta_id, tag, timestamp) y la conexion se libera entre paginas.
+    query = """
+        SELECT id, timestamp, valor
+        FROM trends
+        WHERE empresa_id = $1
+          AND tag = $2
+          AND timestamp BETWEEN $3 AND $4
+          AND (timestamp, id) > ($5, $6)
+          {planta_filter}
+        ORDER BY timestamp ASC, id ASC
+        LIMIT $7
+    """.format(planta_filter=_planta_clause(plantas, 8))
+    cursor_ts: datetime = start
+    cursor_id: int = -1
+    while True:
+        params: List[Any] = [empresa_id, tag, start, end, cursor_ts, cursor_id, page_size]
+        if plantas is not None:
+            params.append(list(plantas))
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(query, *params)
+        if not rows:
+            return
+        yield [(row["timestamp"], float(row["valor"])) for row in rows]
+        if len(rows) < page_size:
+            return
+        last = rows[-1]
+        cursor_ts, cursor_id = last["timestamp"], int(last["id"])
+
+
+async def iter_bucket_points(
+    pool: Pool,
+    *,
+    empresa_id: str,
+    plantas: Optional[Sequence[str]],
+    tag: str,
+    start: datetime,
+    end: datetime,
+    interval_seconds: int,
+    page_size: int = EXPORT_PAGE_SIZE,
+) -> AsyncIterator[List[Tuple[datetime, float]]]:
+    # Los buckets estan alineados a epoch, por lo que la siguiente pagina
+    # parte en el inicio del bucket posterior al ultimo entregado.
+    query = """
+        SELECT to_timestamp(floor(extract(epoch FROM timestamp)/$5)*$5) AS bucket,
+               AVG(valor) AS value
+        FROM trends
+        WHERE empresa_id = $1
+          AND tag = $2
+          AND timestamp >= $3
+          AND timestamp <= $4
+          {planta_filter}
+        GROUP BY bucket
+        ORDER BY bucket ASC
+        LIMIT $6
+    """.format(planta_filter=_planta_clause(plantas, 7))
+    cursor = start
+    while cursor <= end:
+        params: List[Any] = [empresa_id, tag, cursor, end, interval_seconds, page_size]
+        if plantas is not None:
+            params.append(list(plantas))
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(query, *params)
+        if not rows:
+            return
+        yield [(row["bucket"], float(row["value"])) for row in rows]
+        if len(rows) < page_size:
+            return
+        cursor = _bucket_start(rows[-1]["bucket"], interval_seconds) + timedelta(seconds=interval_seconds)
+
+
+async def iter_export_rows(
+    pool: Pool,
+    *,
+    empresa_id: str,
+    plantas: Optional[Sequence[str]],
+    tags: Sequence[str],
+    start: datetime,
+    end: datetime,
+    interval_seconds: Optional[int] = None,
+    page_size: int = EXPORT_PAGE_SIZE,
+) -> AsyncIterator[List[ExportRow]]:
+    """Entrega paginas de filas (tag, timestamp, valor) ordenadas por tag y timestamp."""
+    for tag in tags:
+        if interval_seconds is None:
+            pages = iter_raw_points(
+                pool,
+                empresa_id=empresa_id,
+                plantas=plantas,
+                tag=tag,
+                start=start,
+                end=end,
+                page_size=page_size,
+            )
+        else:
+            pages = iter_bucket_points(
+                pool,
+                empresa_id=empresa_id,
+                plantas=plantas,
+                tag=tag,
+                start=start,
+                end=end,
+                interval_seconds=interval_seconds,
+                page_size=page_size,
+            )
+        async for page in pages:
+            yield [(tag, ts, value) for ts, value in page]
@@ -1,5 +1,9 @@
 ﻿const BACKEND_HTTP = "https://scadawebdesk.onrender.com";
 const BACKEND_WS = "wss://scadawebdesk.onrender.com/ws";
+// Los widgets solo necesitan el ultimo valor: el backend agrupa cambios cada N ms
+const WS_CONFLATE_MS = 200;
+// Frames binarios MessagePack: mas compactos que JSON en enlaces celulares
+const WS_PROTOCOL = "msgpack";
 const DEFAULT_MAIN_TITLE = "SurNex SCADA Web";
 const MAIN_TITLE_STORAGE_KEY = "scada-main-title";
 const PLANT_SELECTION_STORAGE_KEY = "scada-plant-selection";
@@ -50,6 +54,14 @@ const alarmEventsPlantSelect = document.getElementById("alarm-events-plant-selec
 
 const topicElementMap = new Map();
 const topicStateCache = new Map();
+// Momento (ms) de la ultima actualizacion conocida por topic; 0 = ya venia desactualizado
+const topicUpdatedAt = new Map();
+const topicWidgetElements = new Map();
+const STALE_CHECK_INTERVAL_MS = 15000;
+let staleAfterMs = 0;
+// Reanudacion: ultima secuencia recibida y proceso del backend que la emitio
+let streamEpoch = null;
+let lastSeq = null;
 const controlElements = new Set();
 const widgetBindings = [];
 const containerNodes = [];
@@ -401,8 +413,13 @@ async function connectWs(user) {
     lastToken = idToken;
     disconnectWs();
 
-    const url = `${BACKEND_WS}?token=${encodeURIComponent(idToken)}`;
+    let url = `${BACKEND_WS}?token=${encodeURIComponent(idToken)}&conflate=${WS_CONFLATE_MS}&protocol=${WS_PROTOCOL}`;
+    if (streamEpoch && lastSeq !== null) {
+      // El backend envia solo lo perdido desde lastSeq, o un snapshot si ya no lo tiene
+      url += `&resume_from=${lastSeq}&epoch=${encodeURIComponent(streamEpoch)}`;
+    }
     ws = new WebSocket(url);
+    ws.binaryType = "arraybuffer";
 
     ws.onopen = () => {
       console.info("WS abierto");
@@ -412,13 +429,19 @@ async function connectWs(user) {
 
     ws.onmessage = (event) => {
       try {
-        const msg = JSON.parse(event.data);
+        const msg = typeof event.data === "string" ? JSON.parse(event.data) : decodeMsgpack(event.data);
         if (msg.type === "hello") {
           handleHello(msg);
         } else if (msg.type === "ack") {
           console.debug(`ACK ${msg.topic}`);
+        } else if (msg.type === "subscribed") {
+          handleSubscribed(msg);
         } else if (msg.type === "error") {
           console.error(`ERROR ${msg.error}`);
+        } else if (msg.type === "batch") {
+          (msg.messages || []).forEach((item) => {
+            if (item && item.topic) handleTopicMessage(item);
+          });
         } else if (msg.topic) {
           handleTopicMessage(msg);
         }
@@ -447,6 +470,78 @@ async function connectWs(user) {
   }
 }
 
+const msgpackTextDecoder = new TextDecoder();
+
+function decodeMsgpack(buffer) {
+  const bytes = new Uint8Array(buffer);
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  let offset = 0;
+
+  const readString = (length) => {
+    const value = msgpackTextDecoder.decode(bytes.subarray(offset, offset + length));
+    offset += length;
+    return value;
+  };
+  const readArray = (length) => {
+    const out = new Array(length);
+    for (let i = 0; i < length; i += 1) out[i] = read();
+    return out;
+  };
+  const readMap = (length) => {
+    const out = {};
+    for (let i = 0; i < length; i += 1) {
+      const key = read();
+      out[key] = read();
+    }
+    return out;
+  };
+  const readBin = (length) => {
+    const value = bytes.slice(offset, offset + length);
+    offset += length;
+    return value;
+  };
+
+  function read() {
+    const type = bytes[offset];
+    offset += 1;
+    if (type <= 0x7f) return type;
+    if (type <= 0x8f) return readMap(type & 0x0f);
+    if (type <= 0x9f) return readArray(type & 0x0f);
+    if (type <= 0xbf) return readString(type & 0x1f);
+    if (type >= 0xe0) return type - 0x100;
+    let value;
+    switch (type) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: value = view.getUint8(offset); offset += 1; return readBin(value);
+      case 0xc5: value = view.getUint16(offset); offset += 2; return readBin(value);
+      case 0xc6: value = view.getUint32(offset); offset += 4; return readBin(value);
+      case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+      case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+      case 0xcc: value = view.getUint8(offset); offset += 1; return value;
+      case 0xcd: value = view.getUint16(offset); offset += 2; return value;
+      case 0xce: value = view.getUint32(offset); offset += 4; return value;
+      case 0xcf: value = Number(view.getBigUint64(offset)); offset += 8; return value;
+      case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+      case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+      case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+      case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+      case 0xd9: value = view.getUint8(offset); offset += 1; return readString(value);
+      case 0xda: value = view.getUint16(offset); offset += 2; return readString(value);
+      case 0xdb: value = view.getUint32(offset); offset += 4; return readString(value);
+      case 0xdc: value = view.getUint16(offset); offset += 2; return readArray(value);
+      case 0xdd: value = view.getUint32(offset); offset += 4; return readArray(value);
+      case 0xde: value = view.getUint16(offset); offset += 2; return readMap(value);
+      case 0xdf: value = view.getUint32(offset); offset += 4; return readMap(value);
+      default:
+        throw new Error(`Tipo MessagePack no soportado 0x${type.toString(16)}`);
+    }
+  }
+
+  return read();
+}
+
 function scheduleReconnect() {
   clearTimeout(reconnectTimer);
   reconnectTimer = setTimeout(() => {
@@ -463,6 +558,9 @@ function handleHello(msg) {
     currentCompanyId = msg.empresaId;
   }
   console.debug(`HELLO uid=${uid} empresa=${currentCompanyId || ""}`);
+  staleAfterMs = Number(msg.staleAfterSeconds || 0) * 1000;
+  streamEpoch = msg.epoch || null;
+  lastSeq = typeof msg.seq === "number" ? msg.seq : null;
   const helloCompany = msg.empresaId || null;
   if (helloCompany && scadaConfig && scadaConfig.empresaId && scadaConfig.empresaId !== helloCompany) {
     const user = firebase.auth().currentUser;
@@ -475,15 +573,64 @@ function handleHello(msg) {
   if (Array.isArray(msg.last_values)) {
     msg.last_values.forEach((entry) => {
       if (entry && entry.topic) {
-        handleTopicMessage({ topic: entry.topic, payload: entry.payload });
+        handleTopicMessage({ topic: entry.topic, payload: entry.payload, stale: entry.stale, ts: entry.ts });
       }
     });
   }
+  if (Array.isArray(msg.replay)) {
+    msg.replay.forEach((entry) => {
+      if (entry && entry.topic) handleTopicMessage(entry);
+    });
+  }
   applyScopedTopics();
 }
 
-function handleTopicMessage({ topic, payload }) {
+function handleSubscribed(msg) {
+  if (Array.isArray(msg.rejected) && msg.rejected.length) {
+    console.warn(`Suscripciones rechazadas: ${msg.rejected.join(", ")}`);
+  }
+  if (Array.isArray(msg.last_values)) {
+    msg.last_values.forEach((entry) => {
+      if (entry && entry.topic) {
+        handleTopicMessage({ topic: entry.topic, payload: entry.payload, stale: entry.stale, ts: entry.ts });
+      }
+    });
+  }
+}
+
+function syncSubscriptions() {
+  if (!ws || ws.readyState !== WebSocket.OPEN || !uid) return;
+  const topics = Array.from(topicElementMap.keys());
+  if (!topics.length) return;
+  // Solo pedimos al backend los topics que realmente se renderizan
+  ws.send(JSON.stringify({ type: "subscribe", replace: true, topics }));
+}
+
+function isTopicStale(topic) {
+  if (!staleAfterMs || !topicUpdatedAt.has(topic)) return false;
+  return Date.now() - topicUpdatedAt.get(topic) > staleAfterMs;
+}
+
+function refreshStaleWidgets() {
+  topicWidgetElements.forEach((elements, topic) => {
+    const stale = isTopicStale(topic);
+    elements.forEach((el) => el.classList.toggle("widget-stale", stale));
+  });
+}
+
+setInterval(refreshStaleWidgets, STALE_CHECK_INTERVAL_MS);
+
+function handleTopicMessage({ topic, payload, stale = false, seq, ts }) {
+  if (typeof seq === "number" && (lastSeq === null || seq > lastSeq)) {
+    lastSeq = seq;
+  }
   topicStateCache.set(topic, payload);
+  // Valores restaurados (snapshot/replay) conservan su hora real de actualización
+  const updatedAt = typeof ts === "number" ? ts : Date.now();
+  topicUpdatedAt.set(topic, stale ? 0 : updatedAt);
+  (topicWidgetElements.get(topic) || []).forEach((el) =>
+    el.classList.toggle("widget-stale", Boolean(stale) || isTopicStale(topic))
+  );
   const handlers = topicElementMap.get(topic);
   if (handlers) {
     handlers.forEach((updateFn) => {
@@ -498,18 +645,25 @@ function handleTopicMessage({ topic, payload }) {
 
 function applyScopedTopics() {
   topicElementMap.clear();
+  topicWidgetElements.clear();
   widgetBindings.forEach((binding) => {
     const fullTopic = scopedTopic(binding.topic);
     if (!fullTopic) return;
     if (!topicElementMap.has(fullTopic)) {
       topicElementMap.set(fullTopic, []);
+      topicWidgetElements.set(fullTopic, []);
     }
     topicElementMap.get(fullTopic).push(binding.update);
+    if (binding.element) {
+      topicWidgetElements.get(fullTopic).push(binding.element);
+    }
     const cached = topicStateCache.get(fullTopic);
     if (cached !== undefined) {
       binding.update(cached);
     }
   });
+  refreshStaleWidgets();
+  syncSubscriptions();
 }
 
 function updateRoleUI() {
@@ -798,6 +952,7 @@ function clearDashboard() {
   widgetBindings.length = 0;
   controlElements.clear();
   topicElementMap.clear();
+  topicWidgetElements.clear();
   generalContainerNodes.forEach((node) => {
     if (node && node.remove) {
       node.remove();
@@ -891,6 +1046,7 @@ function renderDashboard() {
       if (widget) {
         bodyEl.appendChild(widget.element);
         if (widget.binding) {
+          widget.binding.element = widget.element;
           widgetBindings.push(widget.binding);
         }
         if (widget.control) {
@@ -1812,6 +1968,8 @@ if (logoutBtn) {
   logoutBtn.addEventListener("click", async () => {
     clearTimeout(reconnectTimer);
     lastToken = null;
+    streamEpoch = null;
+    lastSeq = null;
     disconnectWs("logout");
     await firebase.auth().signOut();
   });